@@ -16,12 +16,14 @@ from aws_cdk import (
   aws_elasticsearch,
   aws_kinesisfirehose,
   aws_elasticache,
-  aws_neptune
+  aws_neptune,
+  aws_sqs
 )
 
 from aws_cdk.aws_lambda_event_sources import (
   S3EventSource,
-  KinesisEventSource
+  KinesisEventSource,
+  SqsEventSource
 )
 
 S3_BUCKET_LAMBDA_LAYER_LIB = os.getenv('S3_BUCKET_LAMBDA_LAYER_LIB', 'octember-resources')
@@ -252,7 +254,44 @@ class OctemberBizcardStack(core.Stack):
       write_capacity=5
     )
 
+    #XXX: sparse index on the ETag of processed images to find duplicate uploads
+    ddb_table.add_global_secondary_index(index_name="s3_etag-index",
+      partition_key=dynamodb.Attribute(name="s3_etag", type=dynamodb.AttributeType.STRING),
+      projection_type=dynamodb.ProjectionType.ALL,
+      read_capacity=15,
+      write_capacity=5
+    )
+
+    #XXX: multi-index hashing table of image dHashes ({owner}#{chunk index}#{chunk value} -> image_id)
+    img_hash_ddb_table = dynamodb.Table(self, "BizcardImageHashDdbTable",
+      table_name="OctemberBizcardImgHash",
+      partition_key=dynamodb.Attribute(name="hash_key", type=dynamodb.AttributeType.STRING),
+      sort_key=dynamodb.Attribute(name="image_id", type=dynamodb.AttributeType.STRING),
+      billing_mode=dynamodb.BillingMode.PROVISIONED,
+      read_capacity=15,
+      write_capacity=5
+    )
+
+    #XXX: modules shared by all the lambda functions (ex: lazily created clients)
+    common_lib_layer = _lambda.LayerVersion(self, "OctemberCommonLib",
+      layer_version_name="octember-common-lib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.asset("./src/main/python/OctemberCommonLib")
+    )
+
+    #XXX: https://github.com/aws/aws-cdk/issues/1342
+    s3_lib_bucket = s3.Bucket.from_bucket_name(self, id, S3_BUCKET_LAMBDA_LAYER_LIB)
+
+    #XXX: Pillow for the image hash (PHASH_ENABLED) and the preprocessing (PREPROCESS_ENABLED) of GetTextFromImage;
+    # it has native extensions, so the package must be built for the lambda runtime (python3.7, manylinux x86_64)
+    pillow_lib_layer = _lambda.LayerVersion(self, "PillowLib",
+      layer_version_name="pillow-lib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_bucket(s3_lib_bucket, "var/octember-pillow-lib.zip")
+    )
+
     img_kinesis_stream = kinesis.Stream(self, "BizcardImagePath", stream_name="octember-bizcard-image")
+    text_kinesis_stream = kinesis.Stream(self, "BizcardTextData", stream_name="octember-bizcard-txt")
 
     # create lambda function
     trigger_textract_lambda_fn = _lambda.Function(self, "TriggerTextExtractorFromImage",
@@ -264,14 +303,18 @@ class OctemberBizcardStack(core.Stack):
       environment={
         'REGION_NAME': kwargs['env'].region,
         'DDB_TABLE_NAME': ddb_table.table_name,
-        'KINESIS_STREAM_NAME': img_kinesis_stream.stream_name
+        'KINESIS_STREAM_NAME': img_kinesis_stream.stream_name,
+        'KINESIS_PARTITION_KEY_STRATEGY': 'spread',
+        'TEXT_KINESIS_STREAM_NAME': text_kinesis_stream.stream_name,
+        'DDB_ETAG_INDEX_NAME': 's3_etag-index'
       },
-      timeout=core.Duration.minutes(5)
+      timeout=core.Duration.minutes(5),
+      layers=[common_lib_layer]
     )
 
     ddb_table_rw_policy_statement = aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
-      resources=[ddb_table.table_arn],
+      resources=[ddb_table.table_arn, "{}/index/*".format(ddb_table.table_arn)],
       actions=[
         "dynamodb:BatchGetItem",
         "dynamodb:Describe*",
@@ -299,7 +342,7 @@ class OctemberBizcardStack(core.Stack):
     trigger_textract_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
     trigger_textract_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
-      resources=[img_kinesis_stream.stream_arn],
+      resources=[img_kinesis_stream.stream_arn, text_kinesis_stream.stream_arn],
       actions=["kinesis:Get*",
         "kinesis:List*",
         "kinesis:Describe*",
@@ -308,6 +351,14 @@ class OctemberBizcardStack(core.Stack):
       ]
     ))
 
+    trigger_textract_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(**{
+      "effect": aws_iam.Effect.ALLOW,
+      "resources": [s3_bucket.bucket_arn, "{}/*".format(s3_bucket.bucket_arn)],
+      "actions": ["s3:GetObject",
+        "s3:ListBucket",
+        "s3:PutObject"]
+    }))
+
     # assign notification for the s3 event type (ex: OBJECT_CREATED)
     s3_event_filter = s3.NotificationKeyFilter(prefix="bizcard-raw-img/", suffix=".jpg")
     s3_event_source = S3EventSource(s3_bucket, events=[s3.EventType.OBJECT_CREATED], filters=[s3_event_filter])
@@ -321,8 +372,6 @@ class OctemberBizcardStack(core.Stack):
       retention=aws_logs.RetentionDays.THREE_DAYS)
     log_group.grant_write(trigger_textract_lambda_fn)
 
-    text_kinesis_stream = kinesis.Stream(self, "BizcardTextData", stream_name="octember-bizcard-txt")
-
     textract_lambda_fn = _lambda.Function(self, "GetTextFromImage",
       runtime=_lambda.Runtime.PYTHON_3_7,
       function_name="GetTextFromImage",
@@ -332,12 +381,30 @@ class OctemberBizcardStack(core.Stack):
       environment={
         'REGION_NAME': kwargs['env'].region,
         'DDB_TABLE_NAME': ddb_table.table_name,
-        'KINESIS_STREAM_NAME': text_kinesis_stream.stream_name
+        'KINESIS_STREAM_NAME': text_kinesis_stream.stream_name,
+        'KINESIS_PARTITION_KEY_STRATEGY': 'spread',
+        'MAX_WORKERS': '8',
+        'OCR_STORE_PREFIX': 'bizcard-ocr',
+        'PHASH_ENABLED': 'false',
+        'PHASH_DDB_TABLE_NAME': img_hash_ddb_table.table_name,
+        'PHASH_MAX_DISTANCE': '3',
+        'PREPROCESS_ENABLED': 'false',
+        'PREPROCESS_PREFIX': 'bizcard-preprocessed',
+        'PREPROCESS_TARGET_DPI': '300'
       },
-      timeout=core.Duration.minutes(5)
+      timeout=core.Duration.minutes(5),
+      layers=[pillow_lib_layer, common_lib_layer]
     )
 
     textract_lambda_fn.add_to_role_policy(ddb_table_rw_policy_statement)
+    textract_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[img_hash_ddb_table.table_arn],
+      actions=["dynamodb:Query",
+        "dynamodb:BatchWriteItem",
+        "dynamodb:PutItem"
+      ]
+    ))
     textract_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
       resources=[text_kinesis_stream.stream_arn],
@@ -456,8 +523,6 @@ class OctemberBizcardStack(core.Stack):
     )
     core.Tag.add(es_cfn_domain, 'Name', 'octember-bizcard-es')
 
-    #XXX: https://github.com/aws/aws-cdk/issues/1342
-    s3_lib_bucket = s3.Bucket.from_bucket_name(self, id, S3_BUCKET_LAMBDA_LAYER_LIB)
     es_lib_layer = _lambda.LayerVersion(self, "ESLib",
       layer_version_name="es-lib",
       compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
@@ -471,6 +536,38 @@ class OctemberBizcardStack(core.Stack):
     )
 
     #XXX: Deploy lambda in VPC - https://github.com/aws/aws-cdk/issues/1342
+    #XXX: install the index template (explicit mappings, owner routing and index sorting) and create the index
+    # before any document is indexed
+    bootstrap_es_index_lambda_fn = _lambda.Function(self, "BootstrapBizcardES",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="BootstrapBizcardElasticSearchIndex",
+      handler="bootstrap_es_index.lambda_handler",
+      description="Install the index template and create the bizcard index of elasticsearch",
+      code=_lambda.Code.asset("./src/main/python/BootstrapBizcardES"),
+      environment={
+        'ES_HOST': es_cfn_domain.attr_domain_endpoint,
+        'ES_INDEX': 'octember_bizcard',
+        'ES_READ_ALIAS': 'octember_bizcard-read',
+        'ES_WRITE_ALIAS': 'octember_bizcard-write',
+        'ES_NUMBER_OF_SHARDS': '2',
+        'ES_NUMBER_OF_REPLICAS': '1'
+      },
+      #XXX: an index created before the index template is reindexed while the custom resource is created
+      timeout=core.Duration.minutes(15),
+      layers=[es_lib_layer, common_lib_layer],
+      security_groups=[sg_use_bizcard_es],
+      vpc=vpc
+    )
+
+    es_index_bootstrap = core.CustomResource(self, "BizcardESIndexBootstrap",
+      service_token=bootstrap_es_index_lambda_fn.function_arn,
+      properties={
+        'index': 'octember_bizcard',
+        #XXX: change the template version to re-install the index template on update
+        'template_version': '1'
+      }
+    )
+
     upsert_to_es_lambda_fn = _lambda.Function(self, "UpsertBizcardToES",
       runtime=_lambda.Runtime.PYTHON_3_7,
       function_name="UpsertBizcardToElasticSearch",
@@ -480,14 +577,22 @@ class OctemberBizcardStack(core.Stack):
       environment={
         'ES_HOST': es_cfn_domain.attr_domain_endpoint,
         'ES_INDEX': 'octember_bizcard',
-        'ES_TYPE': 'bizcard'
+        'ES_READ_ALIAS': 'octember_bizcard-read',
+        'ES_WRITE_ALIAS': 'octember_bizcard-write',
+        'ES_BULK_MAX_ACTIONS': '500',
+        'ES_BULK_MAX_BYTES': '{}'.format(5 * 1024 * 1024),
+        #XXX: a bulk request waiting for the refresh must return well within the lambda timeout (5 minutes)
+        'ES_BULK_REQUEST_TIMEOUT': '60',
+        'ES_REFRESH_POLICY': 'false'
       },
       timeout=core.Duration.minutes(5),
-      layers=[es_lib_layer],
+      layers=[es_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_es],
       vpc=vpc
     )
 
+    upsert_to_es_lambda_fn.node.add_dependency(es_index_bootstrap)
+
     text_kinesis_event_source = KinesisEventSource(text_kinesis_stream, batch_size=99, starting_position=_lambda.StartingPosition.LATEST)
     upsert_to_es_lambda_fn.add_event_source(text_kinesis_event_source)
 
@@ -611,6 +716,13 @@ class OctemberBizcardStack(core.Stack):
     # https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-elasticache-cache-cluster.html#cfn-elasticache-cachecluster-cachesubnetgroupname
     es_query_cache.add_depends_on(es_query_cache_subnet_group)
 
+    #XXX: UpsertBizcardToES keeps the content hashes of indexed documents in the search query cache
+    # to skip re-indexing unchanged documents
+    upsert_to_es_lambda_fn.add_environment('ELASTICACHE_HOST', es_query_cache.attr_redis_endpoint_address)
+    upsert_to_es_lambda_fn.add_environment('SKIP_UNCHANGED_ENABLED', 'true')
+    upsert_to_es_lambda_fn.add_layers(redis_lib_layer)
+    upsert_to_es_lambda_fn.connections.add_security_group(sg_use_bizcard_es_cache)
+
     #XXX: add more than 2 security groups
     # https://github.com/aws/aws-cdk/blob/ea10f0d141a48819ec0000cd7905feda993870a9/packages/%40aws-cdk/aws-lambda/lib/function.ts#L387
     # https://github.com/aws/aws-cdk/issues/1555
@@ -624,14 +736,59 @@ class OctemberBizcardStack(core.Stack):
       environment={
         'ES_HOST': es_cfn_domain.attr_domain_endpoint,
         'ES_INDEX': 'octember_bizcard',
-        'ES_TYPE': 'bizcard',
-        'ELASTICACHE_HOST': es_query_cache.attr_redis_endpoint_address
+        'ES_READ_ALIAS': 'octember_bizcard-read',
+        'ES_WRITE_ALIAS': 'octember_bizcard-write',
+        'ELASTICACHE_HOST': es_query_cache.attr_redis_endpoint_address,
+        'SEARCH_CACHE_TTL': '{}'.format(10*60),
+        'SEARCH_NEGATIVE_CACHE_TTL': '30',
+        'SEARCH_CACHE_PAGE_SIZE': '50',
+        'SEARCH_CACHE_COMPRESS_LEVEL': '6',
+        'SUGGEST_CACHE_PREFIX_MAX_LEN': '3',
+        'SEARCH_HIT_RATE_LIMIT': '20',
+        'SEARCH_MISS_RATE_LIMIT': '2',
+        'SUGGEST_MISS_RATE_LIMIT': '10',
+        'LOCAL_CACHE_TTL': '30',
+        'OWNER_VERSION_CHECK_INTERVAL': '1'
+      },
+      timeout=core.Duration.minutes(1),
+      layers=[es_lib_layer, redis_lib_layer, common_lib_layer],
+      security_groups=[sg_use_bizcard_es, sg_use_bizcard_es_cache],
+      vpc=vpc
+    )
+
+    #XXX: UpsertBizcardToES sends the owners of the indexed documents to this queue, and the warmer
+    # (the same code as the search server) stores their owner-only search result pages in the search query cache
+    cache_warm_queue = aws_sqs.Queue(self, "BizcardSearchCacheWarmQueue",
+      queue_name="octember-bizcard-search-cache-warm",
+      visibility_timeout=core.Duration.minutes(6),
+      retention_period=core.Duration.hours(1)
+    )
+
+    bizcard_search_cache_warmer_lambda_fn = _lambda.Function(self, "BizcardSearchCacheWarmer",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="BizcardSearchCacheWarmer",
+      handler="es_search_bizcard.warm_handler",
+      description="Warm the search query cache with the owner-only search results",
+      code=_lambda.Code.asset("./src/main/python/SearchBizcard"),
+      environment={
+        'ES_HOST': es_cfn_domain.attr_domain_endpoint,
+        'ES_INDEX': 'octember_bizcard',
+        'ES_READ_ALIAS': 'octember_bizcard-read',
+        'ELASTICACHE_HOST': es_query_cache.attr_redis_endpoint_address,
+        'SEARCH_CACHE_TTL': '{}'.format(10*60),
+        'SEARCH_NEGATIVE_CACHE_TTL': '30',
+        'SEARCH_CACHE_PAGE_SIZE': '50',
+        'SEARCH_CACHE_COMPRESS_LEVEL': '6'
       },
       timeout=core.Duration.minutes(1),
-      layers=[es_lib_layer, redis_lib_layer],
+      layers=[es_lib_layer, redis_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_es, sg_use_bizcard_es_cache],
       vpc=vpc
     )
+    bizcard_search_cache_warmer_lambda_fn.add_event_source(SqsEventSource(cache_warm_queue, batch_size=10))
+
+    upsert_to_es_lambda_fn.add_environment('CACHE_WARM_QUEUE_URL', cache_warm_queue.queue_url)
+    cache_warm_queue.grant_send_messages(upsert_to_es_lambda_fn)
 
     #XXX: create API Gateway + LambdaProxy
     search_api = apigw.LambdaRestApi(self, "BizcardSearchAPI",
@@ -640,6 +797,9 @@ class OctemberBizcardStack(core.Stack):
       rest_api_name="BizcardSearch",
       description="This service serves searching bizcard text.",
       endpoint_types=[apigw.EndpointType.REGIONAL],
+      #XXX: api gateway compresses the responses larger than 1KB with gzip or deflate,
+      # when the client sends the Accept-Encoding header
+      minimum_compression_size=1024,
       deploy=True,
       deploy_options=apigw.StageOptions(stage_name="v1")
     )
@@ -656,6 +816,31 @@ class OctemberBizcardStack(core.Stack):
       ]
     )
 
+    #XXX: batch mode - many queries in one request body
+    bizcard_search.add_method("POST",
+      method_responses=[apigw.MethodResponse(status_code="200",
+          response_models={
+            'application/json': apigw.EmptyModel()
+          }
+        ),
+        apigw.MethodResponse(status_code="400"),
+        apigw.MethodResponse(status_code="500")
+      ]
+    )
+
+    #XXX: typeahead api served by the same lambda function
+    bizcard_suggest = search_api.root.add_resource('suggest')
+    bizcard_suggest.add_method("GET",
+      method_responses=[apigw.MethodResponse(status_code="200",
+          response_models={
+            'application/json': apigw.EmptyModel()
+          }
+        ),
+        apigw.MethodResponse(status_code="400"),
+        apigw.MethodResponse(status_code="500")
+      ]
+    )
+
     sg_use_bizcard_graph_db = aws_ec2.SecurityGroup(self, "BizcardGraphDbClientSG",
       vpc=vpc,
       allow_all_outbound=True,
@@ -734,7 +919,7 @@ class OctemberBizcardStack(core.Stack):
         'NEPTUNE_PORT': bizcard_graph_db.attr_port
       },
       timeout=core.Duration.minutes(5),
-      layers=[gremlinpython_lib_layer],
+      layers=[gremlinpython_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_graph_db],
       vpc=vpc
     )
@@ -798,10 +983,14 @@ class OctemberBizcardStack(core.Stack):
         'REGION_NAME': kwargs['env'].region,
         'NEPTUNE_ENDPOINT': bizcard_graph_db.attr_read_endpoint,
         'NEPTUNE_PORT': bizcard_graph_db.attr_port,
-        'ELASTICACHE_HOST': recomm_query_cache.attr_redis_endpoint_address
+        'ELASTICACHE_HOST': recomm_query_cache.attr_redis_endpoint_address,
+        'PYMK_CACHE_TTL': '{}'.format(10*60),
+        'PYMK_HIT_RATE_LIMIT': '20',
+        'PYMK_MISS_RATE_LIMIT': '1',
+        'LOCAL_CACHE_TTL': '30'
       },
       timeout=core.Duration.minutes(1),
-      layers=[gremlinpython_lib_layer, redis_lib_layer],
+      layers=[gremlinpython_lib_layer, redis_lib_layer, common_lib_layer],
       security_groups=[sg_use_bizcard_graph_db, sg_use_bizcard_neptune_cache],
       vpc=vpc
     )
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: backfill (or rebuild) elasticsearch and neptune from the text records archived by Kinesis Data Firehose
+# into s3://{bucket}/bizcard-text/ without calling Textract again.
+# - the gzip objects are streamed, and their records are read ahead into a bounded queue
+# - the records are fed to the lambda handlers of UpsertBizcardToES and UpsertBizcardToGraphDB in a process pool
+# - the finished objects are checkpointed, so an interrupted run resumes where it stopped
+# - it has to run where elasticsearch, neptune and elasticache are reachable (ex: an EC2 instance in the VPC)
+#
+# ex) python3 backfill_bizcard_text.py --bucket octember-bizcard-us-east-1-123456789012 --prefix bizcard-text/2020/07/ \
+#       --targets es graph --es-host {es endpoint} --neptune-endpoint {neptune endpoint} --checkpoint-file backfill.ckpt
+#
+# - with --elasticache-host, UpsertBizcardToES skips the documents whose content hash is still cached,
+#   so a rebuild of a wiped or new index needs --force to re-send every document
+#
+
+import sys
+import json
+import os
+import base64
+import codecs
+import collections
+import concurrent.futures
+import gzip
+import argparse
+import multiprocessing.util
+import contextlib
+import queue
+import threading
+
+import boto3
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MODULES = {
+  'es': ('UpsertBizcardToES', 'upsert_bizcard_to_es'),
+  'graph': ('UpsertBizcardToGraphDB', 'upsert_bizcard_to_graph_db')
+}
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+READ_AHEAD_RECORDS = 1000
+READ_AHEAD_PUT_TIMEOUT = 0.1
+
+_JSON_DECODER = json.JSONDecoder()
+_END_OF_OBJECT = object()
+
+_handlers = {}
+
+
+def list_archived_objects(s3_client, bucket, prefix):
+  #XXX: the keys of Firehose (prefix/YYYY/MM/DD/HH/...) are listed in chronological order
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      if obj['Size'] > 0:
+        yield obj['Key']
+
+
+def iter_json_records(fileobj, chunk_size=STREAM_CHUNK_SIZE):
+  #XXX: Firehose concatenates the records without any delimiter (ex: {...}{...}{...}),
+  # so the records are decoded one by one from a sliding buffer instead of splitting lines
+  utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+  buf, pos, eof = '', 0, False
+  while True:
+    while pos < len(buf) and buf[pos].isspace():
+      pos += 1
+
+    if pos < len(buf):
+      try:
+        record, pos = _JSON_DECODER.raw_decode(buf, pos)
+        yield record
+        continue
+      except ValueError as ex:
+        #XXX: the last record in the buffer is incomplete, unless the object is fully read
+        if eof:
+          raise ex
+
+    if eof:
+      return
+
+    chunk = fileobj.read(chunk_size)
+    eof = not chunk
+    buf = buf[pos:] + utf8_decoder.decode(chunk, final=eof)
+    pos = 0
+
+
+def read_ahead(iterable, max_size=READ_AHEAD_RECORDS, put_timeout=READ_AHEAD_PUT_TIMEOUT):
+  #XXX: a reader thread keeps at most max_size records ahead of the consumer,
+  # so the download and decompression overlap with indexing without loading a whole object
+  buffered = queue.Queue(maxsize=max_size)
+  stopped = threading.Event()
+  errors = []
+
+  def _put(e):
+    #XXX: the reader does not block on a full queue forever, because the consumer may have stopped
+    while not stopped.is_set():
+      try:
+        buffered.put(e, timeout=put_timeout)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _reader():
+    try:
+      for e in iterable:
+        if not _put(e):
+          return
+    except Exception as ex:
+      errors.append(ex)
+    finally:
+      _put(_END_OF_OBJECT)
+
+  reader = threading.Thread(target=_reader, name='read-ahead', daemon=True)
+  reader.start()
+  try:
+    while True:
+      e = buffered.get()
+      if e is _END_OF_OBJECT:
+        break
+      yield e
+  finally:
+    #XXX: the consumer stops early on an error or by closing this generator
+    stopped.set()
+    reader.join()
+  if errors:
+    raise errors[0]
+
+
+def init_worker(targets, env):
+  os.environ.update(env)
+  sys.path.insert(0, os.path.join(SRC_DIR, 'OctemberCommonLib', 'python'))
+  for target in targets:
+    module_dir, module_name = TARGET_MODULES[target]
+    sys.path.insert(0, os.path.join(SRC_DIR, module_dir))
+    _handlers[target] = __import__(module_name).lambda_handler
+
+  #XXX: the worker exits without an interpreter shutdown (atexit handlers do not run),
+  # so the connections of the handlers (ex: the neptune websocket) are closed by a multiprocessing finalizer
+  from octember_connections import close_all
+  multiprocessing.util.Finalize(None, close_all, exitpriority=10)
+
+
+def _to_kinesis_event(records):
+  return {'Records': [{'kinesis': {'data': base64.b64encode(json.dumps(e, ensure_ascii=False).encode('utf-8'))}} for e in records]}
+
+
+def backfill_object(bucket, key, batch_size, region_name=AWS_REGION):
+  counter = collections.Counter()
+
+  def _flush(records):
+    event = _to_kinesis_event(records)
+    for lambda_handler in _handlers.values():
+      res = lambda_handler(event, {}) or {}
+      #XXX: the documents rejected or failed by elasticsearch (ex: the cluster is unreachable), the records failed to
+      # parse and the records failed to upsert into neptune are errors, so the object is not checkpointed and can be retried
+      counter['errors'] += sum(res.get(k, 0) for k in ('rejected', 'failed', 'errors'))
+    counter['records'] += len(records)
+
+  s3_client = boto3.client('s3', region_name=region_name)
+  response = s3_client.get_object(Bucket=bucket, Key=key)
+  with gzip.GzipFile(fileobj=response['Body'], mode='rb') as fileobj:
+    #XXX: the reader thread is stopped before the object is closed, even if a flush fails
+    with contextlib.closing(read_ahead(iter_json_records(fileobj))) as json_records:
+      records = []
+      for record in json_records:
+        records.append(record)
+        if len(records) >= batch_size:
+          _flush(records)
+          records = []
+      if records:
+        _flush(records)
+
+  if counter['errors']:
+    raise RuntimeError('{} records are not written'.format(counter['errors']))
+  return key, counter
+
+
+def load_checkpoint(checkpoint_file):
+  if not checkpoint_file or not os.path.exists(checkpoint_file):
+    return set()
+  with open(checkpoint_file) as fp:
+    return set(line.strip() for line in fp if line.strip())
+
+
+def append_checkpoint(checkpoint_fp, key):
+  #XXX: one finished object key per line; a line is appended only after all the records of the object are written
+  if checkpoint_fp is not None:
+    checkpoint_fp.write('{}\n'.format(key))
+    checkpoint_fp.flush()
+
+
+def backfill(bucket, prefix, targets, env, checkpoint_file=None, max_workers=None, max_pending=None,
+    batch_size=500, region_name=AWS_REGION):
+  counter = collections.OrderedDict([('objects', 0),
+      ('skipped', 0),
+      ('records', 0),
+      ('errors', 0)])
+
+  done_keys = load_checkpoint(checkpoint_file)
+  max_workers = max_workers or os.cpu_count()
+  #XXX: bound the number of submitted objects, so listing a large archive does not queue it all up
+  max_pending = max_pending or max_workers * 2
+
+  s3_client = boto3.client('s3', region_name=region_name)
+  checkpoint_fp = open(checkpoint_file, 'a') if checkpoint_file else None
+  with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+      initargs=(targets, env)) as executor:
+    pending = {}
+
+    def _wait(return_when):
+      finished, _ = concurrent.futures.wait(pending, return_when=return_when)
+      for future in finished:
+        key = pending.pop(future)
+        try:
+          _, object_counter = future.result()
+          counter['objects'] += 1
+          counter['records'] += object_counter['records']
+          append_checkpoint(checkpoint_fp, key)
+        except Exception as ex:
+          counter['errors'] += 1
+          print('[ERROR] failed to backfill s3://{}/{}: {}'.format(bucket, key, ex), file=sys.stderr)
+      print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+
+    for key in list_archived_objects(s3_client, bucket, prefix):
+      if key in done_keys:
+        counter['skipped'] += 1
+        continue
+
+      pending[executor.submit(backfill_object, bucket, key, batch_size, region_name)] = key
+      if len(pending) >= max_pending:
+        _wait(concurrent.futures.FIRST_COMPLETED)
+
+    if pending:
+      _wait(concurrent.futures.ALL_COMPLETED)
+
+  if checkpoint_fp is not None:
+    checkpoint_fp.close()
+  return counter
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--region-name', default=AWS_REGION, help='aws region name')
+  parser.add_argument('--bucket', required=True, help='s3 bucket of the Firehose archive')
+  parser.add_argument('--prefix', default='bizcard-text/', help='s3 key prefix of the archive (default: bizcard-text/)')
+  parser.add_argument('--targets', nargs='+', choices=sorted(TARGET_MODULES.keys()), default=sorted(TARGET_MODULES.keys()))
+  parser.add_argument('--es-host', default=os.getenv('ES_HOST'), help='elasticsearch endpoint')
+  parser.add_argument('--elasticache-host', default=os.getenv('ELASTICACHE_HOST'),
+    help='redis endpoint of the content hashes of UpsertBizcardToES (optional)')
+  parser.add_argument('--force', action='store_true',
+    help='index every document even if its content hash is unchanged (ex: rebuild a new or wiped index)')
+  parser.add_argument('--neptune-endpoint', default=os.getenv('NEPTUNE_ENDPOINT'), help='neptune endpoint')
+  parser.add_argument('--checkpoint-file', help='file of the finished objects to resume from')
+  parser.add_argument('--max-workers', type=int, help='number of worker processes (default: number of cpus)')
+  parser.add_argument('--max-pending', type=int, help='max number of objects submitted to the workers (default: 2 x workers)')
+  parser.add_argument('--batch-size', type=int, default=500, help='number of records per lambda handler call')
+
+  options = parser.parse_args()
+
+  env = {'REGION_NAME': options.region_name}
+  if 'es' in options.targets:
+    assert options.es_host, '--es-host is required'
+    env['ES_HOST'] = options.es_host
+    if options.elasticache_host:
+      env['ELASTICACHE_HOST'] = options.elasticache_host
+    if options.force:
+      env['SKIP_UNCHANGED_ENABLED'] = 'false'
+  if 'graph' in options.targets:
+    assert options.neptune_endpoint, '--neptune-endpoint is required'
+    env['NEPTUNE_ENDPOINT'] = options.neptune_endpoint
+
+  backfill(options.bucket, options.prefix, options.targets, env, checkpoint_file=options.checkpoint_file,
+    max_workers=options.max_workers, max_pending=options.max_pending, batch_size=options.batch_size,
+    region_name=options.region_name)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: manages the octember_bizcard indices behind the read and write aliases
+# - bootstrap: installs the index template and creates the first index ({index}-000001) with the aliases;
+#   an index created before the template ({index}) is reindexed into the first index
+# - no rollover: documents are upserted by doc_id, so every document must live in exactly one index
+#   (a rolled over index would keep the old copy of a re-emitted card behind the read alias)
+# - reindex: copies the documents into a new index in parallel slices and swaps the aliases without downtime;
+#   the write alias is moved only after the new index has its replicas and refresh interval back
+# - lambda function: invoked by the CDK stack as a CloudFormation custom resource (or invoked directly)
+# - command line: python3 bootstrap_es_index.py --es-host {es endpoint} bootstrap
+
+import sys
+import json
+import os
+import argparse
+import traceback
+import time
+import urllib.request
+
+import boto3
+from elasticsearch import Elasticsearch
+from elasticsearch import RequestsHttpConnection
+from requests_aws4auth import AWS4Auth
+
+ES_INDEX = os.getenv('ES_INDEX', 'octember_bizcard')
+ES_READ_ALIAS = os.getenv('ES_READ_ALIAS', '{}-read'.format(ES_INDEX))
+ES_WRITE_ALIAS = os.getenv('ES_WRITE_ALIAS', '{}-write'.format(ES_INDEX))
+ES_HOST = os.getenv('ES_HOST')
+ES_NUMBER_OF_SHARDS = int(os.getenv('ES_NUMBER_OF_SHARDS', '2'))
+ES_NUMBER_OF_REPLICAS = int(os.getenv('ES_NUMBER_OF_REPLICAS', '1'))
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+#XXX: text fields are analyzed for full text search, and have a keyword sub-field for exact match, sort and aggregation
+TEXT_FIELD_MAPPING = {
+  "type": "text",
+  "fields": {
+    "keyword": {"type": "keyword", "ignore_above": 256}
+  }
+}
+
+#XXX: the typeahead fields have an edge-ngram sub-field (suggest), so a prefix matches the indexed grams
+# of a term (ex: "ki" matches "kim") without a prefix query at search time
+SUGGEST_TEXT_FIELD_MAPPING = {
+  "type": "text",
+  "fields": {
+    "keyword": {"type": "keyword", "ignore_above": 256},
+    "suggest": {"type": "text", "analyzer": "autocomplete", "search_analyzer": "autocomplete_search"}
+  }
+}
+
+AUTOCOMPLETE_ANALYSIS = {
+  "filter": {
+    "autocomplete_filter": {"type": "edge_ngram", "min_gram": 1, "max_gram": 20}
+  },
+  "analyzer": {
+    "autocomplete": {
+      "type": "custom",
+      "tokenizer": "standard",
+      "filter": ["lowercase", "asciifolding", "autocomplete_filter"]
+    },
+    "autocomplete_search": {
+      "type": "custom",
+      "tokenizer": "standard",
+      "filter": ["lowercase", "asciifolding"]
+    }
+  }
+}
+
+
+def es_connect(es_host=ES_HOST, region_name=AWS_REGION):
+  session = boto3.Session(region_name=region_name)
+  credentials = session.get_credentials()
+  credentials = credentials.get_frozen_credentials()
+  access_key = credentials.access_key
+  secret_key = credentials.secret_key
+  token = credentials.token
+
+  aws_auth = AWS4Auth(
+    access_key,
+    secret_key,
+    region_name,
+    'es',
+    session_token=token
+  )
+
+  es_client = Elasticsearch(
+    hosts = [{'host': es_host, 'port': 443}],
+    http_auth=aws_auth,
+    use_ssl=True,
+    verify_certs=True,
+    connection_class=RequestsHttpConnection
+  )
+  print('[INFO] ElasticSearch Service: {}'.format(es_host), file=sys.stderr)
+  return es_client
+
+
+def gen_index_template(index_name=ES_INDEX, number_of_shards=ES_NUMBER_OF_SHARDS,
+    number_of_replicas=ES_NUMBER_OF_REPLICAS):
+  #XXX: documents are routed by owner, so a search filtered by owner hits only one shard
+  # and the segments are sorted by owner, so the documents of an owner are stored next to each other
+  return {
+    "index_patterns": ["{}*".format(index_name)],
+    "settings": {
+      "index": {
+        "number_of_shards": number_of_shards,
+        "number_of_replicas": number_of_replicas,
+        "sort.field": ["owner"],
+        "sort.order": ["asc"],
+        "analysis": AUTOCOMPLETE_ANALYSIS
+      }
+    },
+    "mappings": {
+      "_routing": {"required": True},
+      "dynamic_templates": [{
+        "strings_as_text": {
+          "match_mapping_type": "string",
+          "mapping": TEXT_FIELD_MAPPING
+        }
+      }],
+      "properties": {
+        "doc_id": {"type": "keyword"},
+        "image_id": {"type": "keyword"},
+        "owner": {"type": "keyword"},
+        "content_id": {"type": "keyword"},
+        "is_alive": {"type": "byte"},
+        "name": SUGGEST_TEXT_FIELD_MAPPING,
+        "job_title": SUGGEST_TEXT_FIELD_MAPPING,
+        "company": SUGGEST_TEXT_FIELD_MAPPING,
+        "addr": TEXT_FIELD_MAPPING,
+        "email": {
+          "type": "keyword",
+          "fields": {
+            "text": {"type": "text"}
+          }
+        },
+        "phone_number": {
+          "type": "keyword",
+          "fields": {
+            "text": {"type": "text"}
+          }
+        },
+        "created_at": {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+      }
+    }
+  }
+
+
+def put_index_template(es_client, index_name=ES_INDEX, **kwargs):
+  template = gen_index_template(index_name, **kwargs)
+  res = es_client.indices.put_template(name=index_name, body=template)
+  print('[INFO] put index template: {}, {}'.format(index_name, json.dumps(res)), file=sys.stderr)
+  return res
+
+
+def versioned_index_name(index_name, version):
+  return '{}-{:06d}'.format(index_name, version)
+
+
+def get_alias_indices(es_client, alias_name):
+  if not es_client.indices.exists_alias(name=alias_name):
+    return []
+  return sorted(es_client.indices.get_alias(name=alias_name).keys())
+
+
+def get_write_index(es_client, write_alias=ES_WRITE_ALIAS):
+  if not es_client.indices.exists_alias(name=write_alias):
+    return None
+  aliases = es_client.indices.get_alias(name=write_alias)
+  #XXX: is_write_index is not set when only one index is behind the alias
+  write_indices = [k for k, v in aliases.items() if v['aliases'][write_alias].get('is_write_index', len(aliases) == 1)]
+  return write_indices[0] if write_indices else None
+
+
+def next_index_name(es_client, index_name=ES_INDEX):
+  versions = []
+  for name in es_client.indices.get(index='{}-*'.format(index_name)).keys():
+    suffix = name[len(index_name) + 1:]
+    if suffix.isdigit():
+      versions.append(int(suffix))
+  return versioned_index_name(index_name, max(versions or [0]) + 1)
+
+
+def has_template_mappings(es_client, index_name):
+  #XXX: the owner routing and the edge-ngram sub-fields (suggest) come only from the index template
+  mappings = es_client.indices.get_mapping(index=index_name).get(index_name, {}).get('mappings', {})
+  name_fields = mappings.get('properties', {}).get('name', {}).get('fields', {})
+  return bool(mappings.get('_routing', {}).get('required')) and 'suggest' in name_fields
+
+
+def create_index(es_client, index_name=ES_INDEX, read_alias=ES_READ_ALIAS, write_alias=ES_WRITE_ALIAS):
+  write_index = get_write_index(es_client, write_alias)
+  if write_index:
+    print('[INFO] {} -> {}'.format(write_alias, write_index), file=sys.stderr)
+    return {'index': write_index, 'created': False}
+
+  if es_client.indices.exists(index=index_name):
+    if has_template_mappings(es_client, index_name):
+      es_client.indices.update_aliases(body={"actions": [
+        {"add": {"index": index_name, "alias": read_alias}},
+        {"add": {"index": index_name, "alias": write_alias, "is_write_index": True}}
+      ]})
+      return {'index': index_name, 'created': False}
+
+    #XXX: the index created (by dynamic mapping) before the index template has neither the owner routing
+    # nor the suggest sub-fields, so it is reindexed into a versioned index, which gets the aliases
+    print('[WARN] index {} was created without the index template - reindex it'.format(index_name), file=sys.stderr)
+    res = reindex(es_client, index_name, read_alias, write_alias, source_indices=[index_name], write_index=index_name)
+    return {'index': res['index'], 'created': True}
+
+  new_index_name = next_index_name(es_client, index_name)
+  res = es_client.indices.create(index=new_index_name, body={
+    "aliases": {
+      read_alias: {},
+      write_alias: {"is_write_index": True}
+    }
+  })
+  print('[INFO] create index: {}, {}'.format(new_index_name, json.dumps(res)), file=sys.stderr)
+  return {'index': new_index_name, 'created': True}
+
+
+def bootstrap(es_client, index_name=ES_INDEX, **kwargs):
+  put_index_template(es_client, index_name, **kwargs)
+  return create_index(es_client, index_name)
+
+
+def wait_for_task(es_client, task_id, poll_interval=10):
+  while True:
+    res = es_client.tasks.get(task_id=task_id)
+    status = res['task']['status']
+    print('[INFO] task {}: total={}, created={}, updated={}, version_conflicts={}, throttled_millis={}'.format(task_id,
+      status.get('total'), status.get('created'), status.get('updated'), status.get('version_conflicts'),
+      status.get('throttled_millis')), file=sys.stderr)
+    if res.get('completed'):
+      return res
+    time.sleep(poll_interval)
+
+
+def copy_documents(es_client, source_index, dest_index, op_type, query=None, slices='auto', requests_per_second=-1):
+  #XXX: the routing of the documents in the index created before the template (without routing)
+  # is set to the owner, which the template requires
+  body = {
+    "conflicts": "proceed",
+    "source": {"index": source_index},
+    "dest": {"index": dest_index, "op_type": op_type},
+    "script": {"lang": "painless", "source": "ctx._routing = ctx._source.owner"}
+  }
+  if query:
+    body['source']['query'] = query
+
+  res = es_client.reindex(body=body, slices=slices, requests_per_second=requests_per_second,
+    wait_for_completion=False, refresh=False)
+  task = wait_for_task(es_client, res['task'])
+  failures = task.get('response', {}).get('failures', [])
+  if failures or task.get('error'):
+    print('[ERROR] reindex failed: {}'.format(json.dumps(failures or task.get('error'))[:1024]), file=sys.stderr)
+    raise RuntimeError('failed to reindex {} into {}'.format(source_index, dest_index))
+  return task['task']['status'].get('total') or 0
+
+
+def reindex(es_client, index_name=ES_INDEX, read_alias=ES_READ_ALIAS, write_alias=ES_WRITE_ALIAS,
+    number_of_shards=ES_NUMBER_OF_SHARDS, number_of_replicas=ES_NUMBER_OF_REPLICAS,
+    slices='auto', requests_per_second=-1, delete_source=False, delta_margin_seconds=15*60,
+    source_indices=None, write_index=None):
+  #XXX: source_indices and write_index are given for an index without the aliases (ex: the index created before
+  # the index template); otherwise they are the indices behind the aliases
+  source_indices = source_indices or get_alias_indices(es_client, read_alias)
+  assert source_indices, 'no index behind the read alias: {}'.format(read_alias)
+  write_index = write_index or get_write_index(es_client, write_alias)
+  assert write_index, 'no write index behind the write alias: {}'.format(write_alias)
+
+  #XXX: the new index is created by the index template (ex: new mappings, number of shards);
+  # no replicas and no refresh while bulk copying, and they are restored before the new index takes any write
+  dest_index = next_index_name(es_client, index_name)
+  es_client.indices.create(index=dest_index, body={
+    "settings": {
+      "index": {
+        "number_of_shards": number_of_shards,
+        "number_of_replicas": 0,
+        "refresh_interval": "-1"
+      }
+    }
+  })
+  print('[INFO] reindex: {} -> {}'.format(','.join(source_indices), dest_index), file=sys.stderr)
+
+  #XXX: the writes keep going to the source (write) index during the bulk copy.
+  # created_at is set on every emission of a document, so the documents written since the copy started
+  # are the ones with created_at after it (minus a margin for the records lagging in the streams)
+  def _written_since(timestamp):
+    since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp - delta_margin_seconds))
+    return {"range": {"created_at": {"gte": since}}}
+
+  #XXX: with op_type=create the first copy of a document wins, so the source indices are copied one by one
+  # from the newest to the oldest
+  copy_started_at = time.time()
+  total = 0
+  for source_index in sorted(source_indices, reverse=True):
+    total += copy_documents(es_client, source_index, dest_index, 'create',
+      slices=slices, requests_per_second=requests_per_second)
+
+  #XXX: keep the refresh interval of the write index (ex: set by ES_REFRESH_POLICY of UpsertBizcardToES)
+  source_settings = es_client.indices.get_settings(index=write_index, name='index.refresh_interval')
+  refresh_interval = source_settings.get(write_index, {}).get('settings', {}).get('index', {}).get('refresh_interval')
+  es_client.indices.put_settings(index=dest_index, body={"index": {"number_of_replicas": number_of_replicas, "refresh_interval": refresh_interval}})
+  es_client.cluster.health(index=dest_index, wait_for_status='green', timeout='30m', request_timeout=30*60)
+
+  #XXX: catch up with the documents written (or updated) during the bulk copy; nothing else writes to
+  # the new index yet, so the newer copies overwrite (op_type=index)
+  catch_up_started_at = time.time()
+  total += copy_documents(es_client, write_index, dest_index, 'index', query=_written_since(copy_started_at),
+    slices=slices, requests_per_second=requests_per_second)
+
+  #XXX: the writes go to the new index from now on, and the documents written to the source index
+  # during the catch-up are copied without overwriting the live writes (op_type=create)
+  write_alias_actions = [{"remove": {"index": e, "alias": write_alias}} for e in get_alias_indices(es_client, write_alias)]
+  write_alias_actions.append({"add": {"index": dest_index, "alias": write_alias, "is_write_index": True}})
+  es_client.indices.update_aliases(body={"actions": write_alias_actions})
+  print('[INFO] {} -> {}'.format(write_alias, dest_index), file=sys.stderr)
+  try:
+    total += copy_documents(es_client, write_index, dest_index, 'create', query=_written_since(catch_up_started_at),
+      slices=slices, requests_per_second=requests_per_second)
+  except RuntimeError as ex:
+    print('[WARN] the documents written to {} since {} may be missing in {} - backfill them'.format(write_index,
+      time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(catch_up_started_at)), dest_index), file=sys.stderr)
+    raise ex
+  es_client.indices.refresh(index=dest_index)
+
+  #XXX: swap the read alias atomically
+  read_alias_actions = [{"remove": {"index": e, "alias": read_alias}} for e in get_alias_indices(es_client, read_alias)]
+  read_alias_actions.append({"add": {"index": dest_index, "alias": read_alias}})
+  es_client.indices.update_aliases(body={"actions": read_alias_actions})
+  print('[INFO] {} -> {}'.format(read_alias, dest_index), file=sys.stderr)
+
+  if delete_source:
+    es_client.indices.delete(index=','.join(source_indices))
+  return {'index': dest_index, 'source_indices': source_indices, 'total': total}
+
+
+def send_cfn_response(event, context, status, data=None, reason=None):
+  #XXX: https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/crpg-ref-responses.html
+  body = json.dumps({
+    'Status': status,
+    'Reason': reason or 'See CloudWatch Log Stream: {}'.format(getattr(context, 'log_stream_name', '')),
+    'PhysicalResourceId': event.get('PhysicalResourceId', 'es-index-{}'.format(ES_INDEX)),
+    'StackId': event['StackId'],
+    'RequestId': event['RequestId'],
+    'LogicalResourceId': event['LogicalResourceId'],
+    'Data': data or {}
+  }).encode('utf-8')
+
+  req = urllib.request.Request(event['ResponseURL'], data=body, method='PUT',
+    headers={'Content-Type': '', 'Content-Length': str(len(body))})
+  with urllib.request.urlopen(req) as res:
+    print('[INFO] CloudFormation response: {}'.format(res.status), file=sys.stderr)
+
+
+def lambda_handler(event, context):
+  is_custom_resource = 'RequestType' in event
+  params = event.get('ResourceProperties', event)
+  index_name = params.get('index', ES_INDEX)
+  try:
+    #XXX: the index is kept when the stack is deleted
+    if is_custom_resource and event['RequestType'] == 'Delete':
+      result = {'index': index_name}
+    else:
+      es_client = es_connect()
+      result = bootstrap(es_client, index_name)
+  except Exception as ex:
+    traceback.print_exc()
+    if not is_custom_resource:
+      raise ex
+    send_cfn_response(event, context, 'FAILED', reason=str(ex))
+    return
+
+  if is_custom_resource:
+    send_cfn_response(event, context, 'SUCCESS', data={'index': result['index']})
+  return result
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--es-host', default=ES_HOST, help='elasticsearch endpoint')
+  parser.add_argument('--region-name', default=AWS_REGION, help='aws region name')
+  parser.add_argument('--index', default=ES_INDEX, help='index name')
+  parser.add_argument('--number-of-shards', type=int, default=ES_NUMBER_OF_SHARDS)
+  parser.add_argument('--number-of-replicas', type=int, default=ES_NUMBER_OF_REPLICAS)
+  parser.add_argument('--slices', default='auto', help='number of parallel reindex slices (default: auto, a slice per shard)')
+  parser.add_argument('--requests-per-second', type=float, default=-1, help='reindex throttle in docs/sec (default: -1, no throttle)')
+  parser.add_argument('--delete-source', action='store_true', help='delete the source indices after reindex')
+  parser.add_argument('command', choices=['show-template', 'put-template', 'create-index', 'bootstrap', 'reindex'])
+
+  options = parser.parse_args()
+  template_options = {'number_of_shards': options.number_of_shards, 'number_of_replicas': options.number_of_replicas}
+
+  if options.command == 'show-template':
+    print(json.dumps(gen_index_template(options.index, **template_options), indent=2))
+    sys.exit(0)
+
+  es_client = es_connect(options.es_host, options.region_name)
+  if options.command == 'put-template':
+    put_index_template(es_client, options.index, **template_options)
+  elif options.command == 'create-index':
+    print(json.dumps(create_index(es_client, options.index)))
+  elif options.command == 'reindex':
+    #XXX: install the template first, so the new index gets the latest mappings
+    put_index_template(es_client, options.index, **template_options)
+    slices = int(options.slices) if options.slices.isdigit() else options.slices
+    requests_per_second = int(options.requests_per_second) if options.requests_per_second.is_integer() else options.requests_per_second
+    print(json.dumps(reindex(es_client, options.index, slices=slices,
+      requests_per_second=requests_per_second, delete_source=options.delete_source, **template_options)))
+  else:
+    print(json.dumps(bootstrap(es_client, options.index, **template_options)))
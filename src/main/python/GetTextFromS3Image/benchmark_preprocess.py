@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: compare the original and the pre-processed biz card images
+#  - without --bucket: bytes and pre-processing time only (no aws calls)
+#  - with --bucket: upload both images and compare the Textract latency and the extracted lines
+#  - the pre-processed path also pays an S3 GET of the original and an S3 PUT of the processed image
+#    (s3://{bucket}/{PREPROCESS_PREFIX}/{image_id}), which are included in its latency and cost
+#
+# ex) python3 benchmark_preprocess.py --samples ../../../../resources/samples --bucket octember-use1 --repeat 3
+#
+
+import sys
+import os
+import glob
+import time
+import argparse
+import statistics
+
+import boto3
+
+from get_text_from_s3_image import (
+  AWS_REGION,
+  PREPROCESS_PREFIX,
+  Image,
+  preprocess_image,
+  detect_document_text,
+  get_detected_text
+)
+
+
+def _timeit(func, *args, **kwargs):
+  start = time.perf_counter()
+  ret = func(*args, **kwargs)
+  return (ret, (time.perf_counter() - start) * 1000)
+
+
+#XXX: on-demand prices in us-east-1 (USD); DetectDocumentText is charged per page, the same for both images
+S3_GET_PRICE_PER_1K = 0.0004
+S3_PUT_PRICE_PER_1K = 0.005
+TEXTRACT_PRICE_PER_1K = 1.5
+
+
+def _read_object(s3_client, bucket, key):
+  return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def benchmark_textract(s3_client, textract_client, bucket, prefix, image_id, original_bytes, processed_bytes, repeat):
+  result = {}
+  for name, image_bytes in (('original', original_bytes), ('processed', processed_bytes)):
+    key = '{prefix}/{name}/{image_id}'.format(prefix=prefix, name=name, image_id=image_id)
+    _, put_ms = _timeit(s3_client.put_object, Bucket=bucket, Key=key, Body=image_bytes, ContentType='image/jpeg')
+
+    get_latencies, latencies, lines = [], [], []
+    for _ in range(repeat):
+      _, get_ms = _timeit(_read_object, s3_client, bucket, key)
+      get_latencies.append(get_ms)
+      response, elapsed_ms = _timeit(detect_document_text, textract_client, bucket, key)
+      latencies.append(elapsed_ms)
+      lines = get_detected_text(response['Blocks'])
+    result[name] = {'get_ms': statistics.median(get_latencies), 'put_ms': put_ms,
+      'textract_ms': statistics.median(latencies), 'lines': lines}
+    s3_client.delete_object(Bucket=bucket, Key=key)
+  return result
+
+
+def estimated_cost_per_1k(s3_get_price=S3_GET_PRICE_PER_1K, s3_put_price=S3_PUT_PRICE_PER_1K,
+    textract_price=TEXTRACT_PRICE_PER_1K):
+  #XXX: the original image is read by Textract from S3 (no request of the lambda function), and the pre-processed
+  # image costs one GET of the original and one PUT of the processed image on top of the same Textract call
+  return {'original': textract_price, 'processed': s3_get_price + s3_put_price + textract_price}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--samples', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../../resources/samples'),
+    help='directory of the sample biz card images')
+  parser.add_argument('--region-name', default=AWS_REGION, help='aws region name')
+  parser.add_argument('--bucket', default=None, help='s3 bucket to upload the images for the Textract benchmark')
+  parser.add_argument('--prefix', default='bizcard-benchmark', help='s3 key prefix of the uploaded images')
+  parser.add_argument('--repeat', default=3, type=int, help='number of Textract calls per image')
+  parser.add_argument('--s3-get-price', default=S3_GET_PRICE_PER_1K, type=float, help='USD per 1,000 S3 GET requests')
+  parser.add_argument('--s3-put-price', default=S3_PUT_PRICE_PER_1K, type=float, help='USD per 1,000 S3 PUT requests')
+  parser.add_argument('--textract-price', default=TEXTRACT_PRICE_PER_1K, type=float, help='USD per 1,000 Textract pages')
+
+  options = parser.parse_args()
+
+  if Image is None:
+    print('[ERROR] Pillow is required: pip install Pillow', file=sys.stderr)
+    sys.exit(1)
+
+  if options.bucket:
+    s3_client = boto3.client('s3', region_name=options.region_name)
+    textract_client = boto3.client('textract', region_name=options.region_name)
+
+  header = ['image_id', 's3_get_bytes', 'textract_bytes', 'preprocess_ms']
+  if options.bucket:
+    header += ['s3_get_ms', 's3_put_ms', 'textract_ms(original)', 'textract_ms(processed)',
+      'total_ms(original)', 'total_ms(processed)', 'same_lines']
+  print('\t'.join(header))
+
+  totals = {'original': 0, 'processed': 0, 'total_ms(original)': [], 'total_ms(processed)': []}
+  for path in sorted(glob.glob(os.path.join(options.samples, '*.jpg'))):
+    image_id = os.path.basename(path)
+    with open(path, 'rb') as fp:
+      original_bytes = fp.read()
+
+    processed_bytes, preprocess_ms = _timeit(preprocess_image, original_bytes)
+    totals['original'] += len(original_bytes)
+    totals['processed'] += len(processed_bytes)
+
+    row = [image_id, str(len(original_bytes)), '{} ({:.0%})'.format(len(processed_bytes), len(processed_bytes) / len(original_bytes)),
+      '{:.1f}'.format(preprocess_ms)]
+    if options.bucket:
+      result = benchmark_textract(s3_client, textract_client, options.bucket, options.prefix, image_id,
+        original_bytes, processed_bytes, options.repeat)
+      #XXX: without pre-processing Textract reads the original object directly; with it, the lambda function
+      # reads the original, pre-processes it and writes the processed image before calling Textract
+      original_ms = result['original']['textract_ms']
+      processed_ms = result['original']['get_ms'] + preprocess_ms + result['processed']['put_ms'] + \
+        result['processed']['textract_ms']
+      totals['total_ms(original)'].append(original_ms)
+      totals['total_ms(processed)'].append(processed_ms)
+      row += ['{:.1f}'.format(result['original']['get_ms']), '{:.1f}'.format(result['processed']['put_ms']),
+        '{:.1f}'.format(result['original']['textract_ms']), '{:.1f}'.format(result['processed']['textract_ms']),
+        '{:.1f}'.format(original_ms), '{:.1f}'.format(processed_ms),
+        str(result['original']['lines'] == result['processed']['lines'])]
+    print('\t'.join(row))
+
+  print('[INFO] bytes sent to Textract: original={}, processed={} ({:.0%})'.format(totals['original'], totals['processed'],
+    totals['processed'] / max(1, totals['original'])), file=sys.stderr)
+  if options.bucket:
+    print('[INFO] median latency(ms) including the S3 GET, pre-processing and S3 PUT: original={:.1f}, processed={:.1f}'.format(
+      statistics.median(totals['total_ms(original)']), statistics.median(totals['total_ms(processed)'])), file=sys.stderr)
+  else:
+    print('[INFO] S3 GET/PUT and Textract latencies are measured only with --bucket', file=sys.stderr)
+
+  cost = estimated_cost_per_1k(options.s3_get_price, options.s3_put_price, options.textract_price)
+  print('[INFO] estimated cost per 1,000 images(USD): original={:.4f}, processed={:.4f} (+1 S3 GET, +1 S3 PUT per image)'.format(
+    cost['original'], cost['processed']), file=sys.stderr)
+  print('[INFO] S3 storage added under {}/: {} bytes'.format(PREPROCESS_PREFIX, totals['processed']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
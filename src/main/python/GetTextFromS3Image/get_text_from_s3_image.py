@@ -9,41 +9,110 @@ import re
 import base64
 import traceback
 import datetime
+import collections
+import threading
+import time
+import random
+import gzip
+import io
 
 import boto3
+from botocore.exceptions import ClientError
+
+from octember_connections import LazyConnection
+from octember_kinesis import KINESIS_MAX_RECORDS_PER_REQUEST, write_records_to_kinesis
+
+try:
+  #XXX: Pillow is not part of the lambda runtime; it should be deployed as a lambda layer
+  from PIL import Image, ImageChops, ImageOps
+except ImportError:
+  Image = None
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 KINESIS_STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'octember-bizcard-text')
 DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME', 'OctemberBizcardImg')
+KINESIS_PARTITION_KEY_STRATEGY = os.getenv('KINESIS_PARTITION_KEY_STRATEGY', 'spread')
 
-def parse_textract_data(lines):
-  def _get_email(s):
-    email_re = re.compile(r'[a-zA-Z0-9+_\-\.]+@[0-9a-zA-Z][.-0-9a-zA-Z]*.[a-zA-Z]+')
-    emails = email_re.findall(s)
-    return emails[0] if emails else ''
-
-  def _get_addr(s):
-    ko_addr_stopwords = ['-gu', '-ro', '-do', ' gu', ' ro', ' do', ' seoul', ' korea']
-    addr_txt = s.lower()
-    score = sum([1 if e in addr_txt else 0 for e in ko_addr_stopwords])
-    return s if score >= 3 else ''
-
-  def _get_phone_number(s):
-    #phone_number_re = re.compile(r'(?:\+ *)?\d[\d\- ]{7,}\d')
-    phone_number_re = re.compile(r'\({0,1}\+{0,1}[\d ]*[\d]{2,}\){0,1}[\d\- ]{7,}')
-    phones = phone_number_re.findall(s)
-    return phones[0] if phones else ''
-
-  funcs = {
-    'email': _get_email,
-    'addr': _get_addr,
-    'phone_number': _get_phone_number
-  }
+#XXX: number of records processed concurrently (1 means sequential processing)
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+TEXTRACT_MAX_RETRY_COUNT = int(os.getenv('TEXTRACT_MAX_RETRY_COUNT', '5'))
+
+TEXTRACT_THROTTLING_ERROR_CODES = ('ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException')
+
+#XXX: raw Textract responses are kept as gzipped json under s3://{OCR_STORE_BUCKET or image bucket}/{OCR_STORE_PREFIX}/
+OCR_STORE_ENABLED = (os.getenv('OCR_STORE_ENABLED', 'true') == 'true')
+OCR_STORE_BUCKET = os.getenv('OCR_STORE_BUCKET', '')
+OCR_STORE_PREFIX = os.getenv('OCR_STORE_PREFIX', 'bizcard-ocr')
+
+#XXX: near-duplicate detection by 256-bit dHash; an already processed image of the same owner within
+# PHASH_MAX_DISTANCE bits is only a candidate - cards printed from the same template are as close as
+# re-uploads of one card (cropped or rotated), so the new image is still OCRed, and it is a duplicate
+# only if its extracted document is the same as the candidate's (then the downstream upserts are skipped).
+# PHASH_MAX_DISTANCE must be less than PHASH_CHUNK_COUNT.
+PHASH_ENABLED = (os.getenv('PHASH_ENABLED', 'false') == 'true')
+PHASH_DDB_TABLE_NAME = os.getenv('PHASH_DDB_TABLE_NAME', 'OctemberBizcardImgHash')
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', '3'))
+PHASH_HASH_SIZE = 16
+PHASH_BITS = PHASH_HASH_SIZE * PHASH_HASH_SIZE
+PHASH_CHUNK_COUNT = 8
+
+#XXX: optional pre-processing (downscale to PREPROCESS_TARGET_DPI, grayscale, auto-crop, re-encode)
+# before Textract; the processed image is written to s3://{image bucket}/{PREPROCESS_PREFIX}/{image_id}
+PREPROCESS_ENABLED = (os.getenv('PREPROCESS_ENABLED', 'false') == 'true')
+PREPROCESS_PREFIX = os.getenv('PREPROCESS_PREFIX', 'bizcard-preprocessed')
+PREPROCESS_TARGET_DPI = int(os.getenv('PREPROCESS_TARGET_DPI', '300'))
+PREPROCESS_JPEG_QUALITY = int(os.getenv('PREPROCESS_JPEG_QUALITY', '80'))
+#XXX: the long edge of a business card (ISO/IEC 7810 ID-1: 85.60 x 53.98 mm)
+BIZCARD_LONG_EDGE_INCHES = 3.37
+
+TEXTRACT_CLIENT = LazyConnection('textract', lambda: boto3.client('textract', region_name=AWS_REGION))
+KINESIS_CLIENT = LazyConnection('kinesis', lambda: boto3.client('kinesis', region_name=AWS_REGION))
+DDB_CLIENT = LazyConnection('dynamodb', lambda: boto3.client('dynamodb', region_name=AWS_REGION))
+S3_CLIENT = LazyConnection('s3', lambda: boto3.client('s3', region_name=AWS_REGION))
+
+EMAIL_RE = re.compile(r'[a-zA-Z0-9+_\-\.]+@[0-9a-zA-Z][.-0-9a-zA-Z]*.[a-zA-Z]+')
+#PHONE_NUMBER_RE = re.compile(r'(?:\+ *)?\d[\d\- ]{7,}\d')
+PHONE_NUMBER_RE = re.compile(r'\({0,1}\+{0,1}[\d ]*[\d]{2,}\){0,1}[\d\- ]{7,}')
+KO_ADDR_STOPWORDS = ('-gu', '-ro', '-do', ' gu', ' ro', ' do', ' seoul', ' korea')
+
+#XXX: field name -> extractor(line, lower_line); an extractor returns '' if the line has no such field.
+# Extractors are applied in registration order and the last matching line wins.
+FIELD_EXTRACTORS = collections.OrderedDict()
+
+
+def register_field_extractor(field_name):
+  def _register(func):
+    FIELD_EXTRACTORS[field_name] = func
+    return func
+  return _register
+
+
+@register_field_extractor('email')
+def _get_email(line, lower_line):
+  m = EMAIL_RE.search(line)
+  return m.group(0) if m else ''
+
+
+@register_field_extractor('addr')
+def _get_addr(line, lower_line):
+  score = sum(1 for e in KO_ADDR_STOPWORDS if e in lower_line)
+  return line if score >= 3 else ''
+
+
+@register_field_extractor('phone_number')
+def _get_phone_number(line, lower_line):
+  m = PHONE_NUMBER_RE.search(line)
+  return m.group(0) if m else ''
+
+
+def parse_textract_data(lines, extractors=None):
+  extractors = list((extractors or FIELD_EXTRACTORS).items())
 
   doc = {}
   for line in lines:
-    for k in ['email', 'addr', 'phone_number']:
-      ret = funcs[k](line)
+    lower_line = line.lower()
+    for k, extract in extractors:
+      ret = extract(line, lower_line)
       if ret:
         doc[k] = ret
 
@@ -56,93 +125,356 @@ def parse_textract_data(lines):
   return doc
 
 
-def get_textract_data(textract_client, bucketName, documentKey):
-  print('[DEBUG] Loading get_textract_data', file=sys.stderr)
+def parse_textract_data_batch(lines_list, extractors=None):
+  extractors = collections.OrderedDict(extractors or FIELD_EXTRACTORS)
+  return [parse_textract_data(lines, extractors) for lines in lines_list]
+
+
+class AdaptiveConcurrencyLimiter:
+  #XXX: AIMD(additive increase, multiplicative decrease) limit on the number of in-flight calls
+  # - halve the limit whenever a call is throttled
+  # - raise the limit by one after every `increase_after` consecutive successes
+  def __init__(self, max_limit, increase_after=10):
+    self.max_limit = max(1, max_limit)
+    self.limit = self.max_limit
+    self.increase_after = increase_after
+    self._in_flight = 0
+    self._successes = 0
+    self._cond = threading.Condition()
+
+  def __enter__(self):
+    with self._cond:
+      while self._in_flight >= self.limit:
+        self._cond.wait()
+      self._in_flight += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    with self._cond:
+      self._in_flight -= 1
+      self._cond.notify_all()
+    return False
+
+  def on_success(self):
+    with self._cond:
+      self._successes += 1
+      if self._successes >= self.increase_after and self.limit < self.max_limit:
+        self.limit += 1
+        self._successes = 0
+        self._cond.notify_all()
+
+  def on_throttle(self):
+    with self._cond:
+      self.limit = max(1, self.limit // 2)
+      self._successes = 0
+    print('[WARN] textract throttled, concurrency limit={}'.format(self.limit), file=sys.stderr)
+
+
+def detect_document_text(textract_client, bucketName, documentKey, limiter=None,
+    max_retry_count=TEXTRACT_MAX_RETRY_COUNT, base_backoff=0.5, max_backoff=8.0):
+  limiter = limiter or AdaptiveConcurrencyLimiter(1)
+  for attempt in range(max_retry_count):
+    try:
+      with limiter:
+        response = textract_client.detect_document_text(
+        Document={
+          'S3Object': {
+          'Bucket': bucketName,
+          'Name': documentKey
+          }
+        })
+      limiter.on_success()
+      return response
+    except ClientError as ex:
+      if ex.response['Error']['Code'] not in TEXTRACT_THROTTLING_ERROR_CODES or attempt + 1 >= max_retry_count:
+        raise ex
+      limiter.on_throttle()
+      time.sleep(random.uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+
+def get_s3_object_etag(s3_client, bucket, key):
+  response = s3_client.head_object(Bucket=bucket, Key=key)
+  return response['ETag'].strip('"')
+
+
+def ocr_store_location(bucket, key, etag):
+  store_bucket = OCR_STORE_BUCKET or bucket
+  store_key = '{prefix}/{bucket}/{key}/{etag}.json.gz'.format(prefix=OCR_STORE_PREFIX,
+    bucket=bucket, key=key, etag=etag)
+  return (store_bucket, store_key)
+
+
+def load_ocr_result(s3_client, bucket, key, etag):
+  store_bucket, store_key = ocr_store_location(bucket, key, etag)
+  try:
+    response = s3_client.get_object(Bucket=store_bucket, Key=store_key)
+  except ClientError as ex:
+    if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+      return None
+    raise ex
+  ocr_result = json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+  print('[DEBUG] OCR result store hit: s3://{}/{}'.format(store_bucket, store_key), file=sys.stderr)
+  return ocr_result
+
+
+def save_ocr_result(s3_client, bucket, key, etag, textract_response):
+  store_bucket, store_key = ocr_store_location(bucket, key, etag)
+  ocr_result = {
+    's3_bucket': bucket,
+    's3_key': key,
+    's3_etag': etag,
+    'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'DocumentMetadata': textract_response.get('DocumentMetadata', {}),
+    'Blocks': textract_response['Blocks']
+  }
+  body = gzip.compress(json.dumps(ocr_result, ensure_ascii=False).encode('utf-8'))
+  s3_client.put_object(Bucket=store_bucket, Key=store_key, Body=body,
+    ContentType='application/json', ContentEncoding='gzip')
+  return ocr_result
 
-  response = textract_client.detect_document_text(
-  Document={
-    'S3Object': {
-    'Bucket': bucketName,
-    'Name': documentKey
-    }
-  })
 
-  detected_text_list = [item['Text'] for item in response['Blocks'] if item['BlockType'] == 'LINE']
-  return detected_text_list
+def get_detected_text(blocks):
+  return [item['Text'] for item in blocks if item['BlockType'] == 'LINE']
+
 
+def _autocrop_bbox(gray_image, threshold=48, min_area_ratio=0.3, margin_ratio=0.05):
+  #XXX: estimate the background color from the image border and
+  # crop to the bounding box of the pixels that differ from it
+  width, height = gray_image.size
+  border = [gray_image.getpixel((x, y)) for x in (0, width - 1) for y in range(0, height, max(1, height // 16))]
+  border += [gray_image.getpixel((x, y)) for y in (0, height - 1) for x in range(0, width, max(1, width // 16))]
+  background = sorted(border)[len(border) // 2]
 
-def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records):
-  import random
-  random.seed(47)
+  diff = ImageChops.difference(gray_image, Image.new('L', gray_image.size, background))
+  bbox = diff.point(lambda v: 255 if v > threshold else 0).getbbox()
+  if not bbox:
+    return None
 
-  def gen_records():
-    record_list = []
-    for rec in records:
-      payload = json.dumps(rec, ensure_ascii=False)
-      partition_key = 'part-{:05}'.format(random.randint(1, 1024))
-      record_list.append({'Data': payload, 'PartitionKey': partition_key})
-    return record_list
+  left, upper, right, lower = bbox
+  if (right - left) * (lower - upper) < min_area_ratio * width * height:
+    return None
 
-  MAX_RETRY_COUNT = 3
+  margin_x, margin_y = int(width * margin_ratio), int(height * margin_ratio)
+  return (max(0, left - margin_x), max(0, upper - margin_y),
+    min(width, right + margin_x), min(height, lower + margin_y))
 
-  record_list = gen_records()
-  for i in range(MAX_RETRY_COUNT):
+
+def preprocess_image(image_bytes, target_dpi=PREPROCESS_TARGET_DPI, quality=PREPROCESS_JPEG_QUALITY):
+  max_long_edge = int(BIZCARD_LONG_EDGE_INCHES * target_dpi)
+
+  image = Image.open(io.BytesIO(image_bytes))
+  image.draft('L', (max_long_edge, max_long_edge))
+  image = ImageOps.exif_transpose(image) if hasattr(ImageOps, 'exif_transpose') else image
+  image = image.convert('L')
+
+  bbox = _autocrop_bbox(image)
+  if bbox:
+    image = image.crop(bbox)
+
+  if max(image.size) > max_long_edge:
+    image.thumbnail((max_long_edge, max_long_edge), Image.LANCZOS)
+
+  output = io.BytesIO()
+  image.save(output, format='JPEG', quality=quality, optimize=True)
+  return output.getvalue()
+
+
+def preprocess_bizcard_image(s3_client, bucket, key, image_bytes=None):
+  if image_bytes is None:
+    image_bytes = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+  processed_bytes = preprocess_image(image_bytes)
+  print('[DEBUG] preprocess_image: {} bytes -> {} bytes'.format(len(image_bytes), len(processed_bytes)), file=sys.stderr)
+  if len(processed_bytes) >= len(image_bytes):
+    return key
+
+  processed_key = '{prefix}/{image_id}'.format(prefix=PREPROCESS_PREFIX, image_id=os.path.basename(key))
+  s3_client.put_object(Bucket=bucket, Key=processed_key, Body=processed_bytes, ContentType='image/jpeg')
+  return processed_key
+
+
+def get_textract_data(textract_client, bucketName, documentKey, s3_client=None, etag=None, limiter=None,
+    preprocess=False, image_bytes=None):
+  print('[DEBUG] Loading get_textract_data', file=sys.stderr)
+
+  use_ocr_store = OCR_STORE_ENABLED and s3_client is not None
+  if use_ocr_store:
+    etag = etag or get_s3_object_etag(s3_client, bucketName, documentKey)
+    ocr_result = load_ocr_result(s3_client, bucketName, documentKey, etag)
+    if ocr_result is not None:
+      return get_detected_text(ocr_result['Blocks'])
+
+  textract_document_key = documentKey
+  if preprocess and Image is not None and s3_client is not None:
     try:
-      response = kinesis_client.put_records(Records=record_list, StreamName=kinesis_stream_name)
-      print('[DEBUG]', response, file=sys.stderr)
-      break
+      textract_document_key = preprocess_bizcard_image(s3_client, bucketName, documentKey, image_bytes)
     except Exception as ex:
-      import time
+      traceback.print_exc()
 
+  response = detect_document_text(textract_client, bucketName, textract_document_key, limiter)
+  if use_ocr_store:
+    try:
+      save_ocr_result(s3_client, bucketName, documentKey, etag, response)
+    except Exception as ex:
       traceback.print_exc()
-      time.sleep(2)
-  else:
-    raise RuntimeError('[ERROR] Failed to put_records into kinesis stream: {}'.format(kinesis_stream_name))
 
+  detected_text_list = get_detected_text(response['Blocks'])
+  return detected_text_list
+
+
+def compute_dhash(image_bytes, hash_size=PHASH_HASH_SIZE):
+  image = Image.open(io.BytesIO(image_bytes))
+  #XXX: let the jpeg decoder downscale while decoding; the hash needs only (hash_size + 1) x hash_size pixels
+  image.draft('L', (hash_size * 8, hash_size * 8))
+  pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+  dhash = 0
+  for row in range(hash_size):
+    for col in range(hash_size):
+      left, right = pixels[row * (hash_size + 1) + col], pixels[row * (hash_size + 1) + col + 1]
+      dhash = (dhash << 1) | (1 if left > right else 0)
+  return dhash
+
+
+def hamming_distance(a, b):
+  return bin(a ^ b).count('1')
+
+
+def _dhash_chunks(dhash, chunk_count=PHASH_CHUNK_COUNT):
+  #XXX: multi-index hashing - if two hashes differ in fewer than chunk_count bits,
+  # at least one of their chunk_count disjoint chunks is identical (pigeonhole principle)
+  chunk_bits = PHASH_BITS // chunk_count
+  mask = (1 << chunk_bits) - 1
+  return [(idx, (dhash >> (idx * chunk_bits)) & mask) for idx in range(chunk_count)]
 
-def update_process_status(ddb_client, table_name, item):
-  def ddb_update_item():
-    s3_bucket = item['s3_bucket']
-    s3_key = item['s3_key']
-    image_id = os.path.basename(s3_key)
-    status = item['status']
-    modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
 
-    response = ddb_client.update_item(
+def _dhash_index_key(owner, chunk_idx, chunk_value):
+  return '{owner}#{idx}#{value:0{width}x}'.format(owner=owner, idx=chunk_idx, value=chunk_value,
+    width=PHASH_BITS // PHASH_CHUNK_COUNT // 4)
+
+
+def find_near_duplicate_image(ddb_client, table_name, owner, image_id, dhash, max_distance=PHASH_MAX_DISTANCE):
+  assert max_distance < PHASH_CHUNK_COUNT
+
+  candidates = {}
+  for chunk_idx, chunk_value in _dhash_chunks(dhash):
+    response = ddb_client.query(
       TableName=table_name,
-      Key={
-        "image_id": {
-          "S": image_id
-        }
-      },
-      UpdateExpression="SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status",
-      ExpressionAttributeNames={
-        '#status': 'status'
-      },
+      KeyConditionExpression="hash_key = :hash_key",
       ExpressionAttributeValues={
-        ":s3_bucket": {
-          "S": s3_bucket
-        },
-        ":s3_key": {
-          "S":  s3_key
-        },
-        ":mts": {
-          "N": "{}".format(modified_time)
-        },
-        ":status": {
-          "S": status
+        ":hash_key": {
+          "S": _dhash_index_key(owner, chunk_idx, chunk_value)
         }
       }
     )
-    return response
+    for item in response['Items']:
+      candidates[item['image_id']['S']] = int(item['dhash']['S'], 16)
+
+  matches = [(hamming_distance(dhash, v), k) for k, v in candidates.items() if k != image_id]
+  matches = sorted(e for e in matches if e[0] <= max_distance)
+  return matches[0][1] if matches else None
+
+
+def register_image_dhash(ddb_client, table_name, owner, image_id, dhash):
+  put_requests = [{'PutRequest': {'Item': {
+      'hash_key': {'S': _dhash_index_key(owner, chunk_idx, chunk_value)},
+      'image_id': {'S': image_id},
+      'dhash': {'S': '{:0{width}x}'.format(dhash, width=PHASH_BITS // 4)}
+    }}} for chunk_idx, chunk_value in _dhash_chunks(dhash)]
+
+  request_items = {table_name: put_requests}
+  for _ in range(3):
+    response = ddb_client.batch_write_item(RequestItems=request_items)
+    request_items = response.get('UnprocessedItems', {})
+    if not request_items:
+      break
+    time.sleep(0.1)
 
-  try:
-    res = ddb_update_item()
-    print('[DEBUG]', res, file=sys.stderr)
-  except Exception as ex:
-    traceback.print_exc()
-    print('[ERROR]', res, file=sys.stderr)
-    raise ex
+
+def is_same_document(doc, other_doc, excluded_fields=('created_at',)):
+  #XXX: the fields that change on every extraction are not compared
+  return {k: v for k, v in doc.items() if k not in excluded_fields} == \
+    {k: v for k, v in other_doc.items() if k not in excluded_fields}
+
+
+def get_processed_text_data(ddb_client, table_name, image_id):
+  response = ddb_client.get_item(
+    TableName=table_name,
+    Key={
+      "image_id": {
+        "S": image_id
+      }
+    }
+  )
+  item = response.get('Item', {})
+  if item.get('status', {}).get('S') != 'END' or 'text_data' not in item:
+    return None
+  return json.loads(item['text_data']['S'])
+
+
+#XXX: CopyObject copies objects up to 5 GB in a single request
+S3_COPY_OBJECT_MAX_SIZE = 5 * 1024 ** 3
+
+
+def update_process_status(ddb_client, table_name, item, modified_time=None):
+  modified_time = modified_time or datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+  image_id = os.path.basename(item['s3_key'])
+
+  #XXX: UpdateItem only sets the given attributes, so the ones written by the others
+  # (e.g. s3_etag written by TriggerTextExtractFromS3Image) are kept
+  update_expression = "SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status"
+  expression_attribute_values = {
+    ":s3_bucket": {"S": item['s3_bucket']},
+    ":s3_key": {"S": item['s3_key']},
+    ":mts": {"N": "{}".format(modified_time)},
+    ":status": {"S": item['status']}
+  }
+  for attr_name in ('s3_etag', 'text_data', 'duplicate_of'):
+    if item.get(attr_name):
+      update_expression += ", {attr_name} = :{attr_name}".format(attr_name=attr_name)
+      expression_attribute_values[":{}".format(attr_name)] = {"S": item[attr_name]}
+
+  ddb_client.update_item(
+    TableName=table_name,
+    Key={
+      "image_id": {
+        "S": image_id
+      }
+    },
+    UpdateExpression=update_expression,
+    ExpressionAttributeNames={'#status': 'status'},
+    ExpressionAttributeValues=expression_attribute_values
+  )
+
+
+def batch_update_process_status(ddb_client, table_name, items, max_workers=None):
+  from concurrent.futures import ThreadPoolExecutor
+
+  modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+  #XXX: keep only the last status of an image
+  last_items = collections.OrderedDict()
+  for item in items:
+    last_items[os.path.basename(item['s3_key'])] = item
+  if not last_items:
+    return
+
+  #XXX: BatchWriteItem has no partial update (its PutRequest replaces the whole item),
+  # so the UpdateItem requests are sent concurrently instead
+  max_workers = max(1, min(max_workers or MAX_WORKERS, len(last_items)))
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(update_process_status, ddb_client, table_name, e, modified_time)
+      for e in last_items.values()]
+
+  failed = 0
+  for future in futures:
+    try:
+      future.result()
+    except Exception as ex:
+      failed += 1
+      traceback.print_exc()
+  if failed:
+    raise RuntimeError('[ERROR] Failed to update_item in dynamodb table: {}, failed={}'.format(table_name, failed))
 
 
 def copy_bizcard_to_user_photo_album(s3_client, params):
@@ -155,50 +487,147 @@ def copy_bizcard_to_user_photo_album(s3_client, params):
   image_id = os.path.basename(src_key)
   dest_s3_bucket = src_bucket
   dest_s3_key = 'bizcard-by-user/{owner}/{image_id}'.format(owner=owner, image_id=image_id)
-  s3_client.copy(copy_source, dest_s3_bucket, dest_s3_key)
+  if params.get('size', 0) < S3_COPY_OBJECT_MAX_SIZE:
+    #XXX: a single server-side CopyObject instead of the managed transfer (HeadObject + multipart copy)
+    s3_client.copy_object(CopySource=copy_source, Bucket=dest_s3_bucket, Key=dest_s3_key)
+  else:
+    s3_client.copy(copy_source, dest_s3_bucket, dest_s3_key)
   return {'s3_bucket': dest_s3_bucket, 's3_key': dest_s3_key, 'owner': owner}
 
 
+def build_text_data(bucket, key, doc):
+  doc['created_at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+  owner = os.path.basename(key).split('_')[0]
+  return {'s3_bucket': bucket, 's3_key': key, 'owner': owner, 'data': doc}
+
+
+def extract_text_data(clients, limiter, json_data):
+  textract_client, kinesis_client, ddb_client, s3_client = clients
+
+  bucket, key = (json_data['s3_bucket'], json_data['s3_key'])
+  image_id = os.path.basename(key)
+  owner = image_id.split('_')[0]
+  try:
+    dhash, image_bytes, candidate_id, candidate_doc = None, None, None, None
+    if PHASH_ENABLED and Image is not None:
+      try:
+        image_bytes = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        dhash = compute_dhash(image_bytes)
+        candidate_id = find_near_duplicate_image(ddb_client, PHASH_DDB_TABLE_NAME, owner, image_id, dhash)
+        candidate_doc = get_processed_text_data(ddb_client, DDB_TABLE_NAME, candidate_id) if candidate_id else None
+      except Exception as ex:
+        traceback.print_exc()
+        candidate_doc = None
+
+    detected_text = get_textract_data(textract_client, bucket, key, s3_client=s3_client,
+      etag=json_data.get('s3_etag'), limiter=limiter, preprocess=PREPROCESS_ENABLED, image_bytes=image_bytes)
+
+    text_data = build_text_data(bucket, key, parse_textract_data(detected_text))
+    print('[DEBUG]', json.dumps(text_data), file=sys.stderr)
+
+    if candidate_doc is not None and is_same_document(text_data['data'], candidate_doc):
+      #XXX: the same card has already been extracted and indexed,
+      # so the downstream elasticsearch/neptune upserts are not needed
+      print('[INFO] near-duplicate of {}: {}'.format(candidate_id, key), file=sys.stderr)
+      return {'text_data': text_data, 'duplicate_of': candidate_id, 'dhash': None}
+    return {'text_data': text_data, 'duplicate_of': None, 'dhash': dhash}
+  except Exception as ex:
+    print('[ERROR] getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket), file=sys.stderr)
+    raise ex
+
+
 def lambda_handler(event, context):
-  import collections
+  from concurrent.futures import ThreadPoolExecutor
 
-  textract_client = boto3.client('textract', region_name=AWS_REGION)
-  kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
-  ddb_client = boto3.client('dynamodb', region_name=AWS_REGION)
-  s3_client = boto3.client('s3', region_name=AWS_REGION)
+  #XXX: boto3 low-level clients are thread-safe, so they are shared by all the workers
+  textract_client = TEXTRACT_CLIENT.get()
+  kinesis_client = KINESIS_CLIENT.get()
+  ddb_client = DDB_CLIENT.get()
+  s3_client = S3_CLIENT.get()
+  clients = (textract_client, kinesis_client, ddb_client, s3_client)
 
   counter = collections.OrderedDict([('reads', 0),
       ('writes', 0), ('errors', 0)])
 
+  json_data_list = []
   for record in event['Records']:
     try:
       counter['reads'] += 1
-
       payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
-      json_data = json.loads(payload)
-
-      bucket, key = (json_data['s3_bucket'], json_data['s3_key'])
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': bucket, 's3_key': key, 'status': 'PROCESS'})
-
-      detected_text = get_textract_data(textract_client, bucket, key)
+      json_data_list.append(json.loads(payload))
+    except Exception as ex:
+      counter['errors'] += 1
+      traceback.print_exc()
 
-      doc = parse_textract_data(detected_text)
-      doc['created_at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+  if not json_data_list:
+    print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+    return
 
-      owner = os.path.basename(key).split('_')[0]
-      text_data = {'s3_bucket': bucket, 's3_key': key, 'owner': owner, 'data': doc}
-      print('[DEBUG]', json.dumps(text_data), file=sys.stderr)
+  max_workers = max(1, min(MAX_WORKERS, len(json_data_list)))
+  limiter = AdaptiveConcurrencyLimiter(max_workers)
 
-      write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, [text_data])
-      ret = copy_bizcard_to_user_photo_album(s3_client, {'s3_bucket': bucket, 's3_key': key, 'owner': owner})
+  def _extract_text_data(json_data):
+    try:
+      return extract_text_data(clients, limiter, json_data)
+    except Exception as ex:
+      traceback.print_exc()
+      return None
 
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': ret['s3_bucket'], 's3_key': ret['s3_key'], 'status': 'END'})
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    #XXX: the PROCESS status of the whole batch is updated while the images are OCRed
+    status_future = executor.submit(batch_update_process_status, ddb_client, DDB_TABLE_NAME,
+      [{'s3_bucket': e['s3_bucket'], 's3_key': e['s3_key'], 'status': 'PROCESS'} for e in json_data_list])
+    results = list(executor.map(_extract_text_data, json_data_list))
+    try:
+      status_future.result()
+    except Exception as ex:
+      traceback.print_exc()
 
-      counter['writes'] += 1
+    extracted = [(json_data, res) for json_data, res in zip(json_data_list, results) if res is not None]
+    counter['errors'] += len(results) - len(extracted)
+
+    #XXX: the kinesis put and the photo album copies do not depend on each other
+    new_text_data_list = [res['text_data'] for _, res in extracted if res['duplicate_of'] is None]
+    kinesis_future = executor.submit(write_records_to_kinesis, kinesis_client, KINESIS_STREAM_NAME, new_text_data_list,
+      partition_key_strategy=KINESIS_PARTITION_KEY_STRATEGY) \
+      if new_text_data_list else None
+    copy_futures = [executor.submit(copy_bizcard_to_user_photo_album, s3_client, res['text_data']) for _, res in extracted]
+
+    kinesis_outcomes = iter(kinesis_future.result() if kinesis_future else [])
+    end_status_items, dhash_items = [], []
+    for (json_data, res), copy_future in zip(extracted, copy_futures):
+      text_data = res['text_data']
+      outcome = next(kinesis_outcomes) if res['duplicate_of'] is None else {'ok': True}
+      try:
+        ret = copy_future.result()
+      except Exception as ex:
+        traceback.print_exc()
+        ret = None
+
+      if not outcome['ok'] or ret is None:
+        counter['errors'] += 1
+        print('[ERROR] Failed to process: {}, {}'.format(text_data['s3_key'], outcome), file=sys.stderr)
+        continue
+
+      end_status_items.append({'s3_bucket': ret['s3_bucket'], 's3_key': ret['s3_key'], 'status': 'END',
+        's3_etag': json_data.get('s3_etag'), 'text_data': json.dumps(text_data['data'], ensure_ascii=False),
+        'duplicate_of': res['duplicate_of']})
+      if res['dhash'] is not None:
+        dhash_items.append((text_data['owner'], os.path.basename(text_data['s3_key']), res['dhash']))
+
+    dhash_futures = [executor.submit(register_image_dhash, ddb_client, PHASH_DDB_TABLE_NAME, *e) for e in dhash_items]
+    try:
+      batch_update_process_status(ddb_client, DDB_TABLE_NAME, end_status_items)
+      counter['writes'] += len(end_status_items)
     except Exception as ex:
-      counter['errors'] += 1
-      print('[ERROR] getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket), file=sys.stderr)
+      counter['errors'] += len(end_status_items)
       traceback.print_exc()
+
+    for future in dhash_futures:
+      try:
+        future.result()
+      except Exception as ex:
+        traceback.print_exc()
   print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
 
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: re-parse the Textract results kept in the OCR result store and republish them
+# into the text kinesis stream (octember-bizcard-txt) without calling Textract again.
+# - the store keeps one result per version (ETag) of an image, and only the result of the current version is republished
+#
+# ex) python3 reparse_ocr_results.py --bucket octember-bizcard-us-east-1-123456789012 --prefix bizcard-ocr/
+#
+
+import sys
+import json
+import gzip
+import argparse
+import collections
+import traceback
+
+import boto3
+
+from get_text_from_s3_image import (
+  AWS_REGION,
+  KINESIS_STREAM_NAME,
+  OCR_STORE_BUCKET,
+  OCR_STORE_PREFIX,
+  KINESIS_MAX_RECORDS_PER_REQUEST,
+  KINESIS_PARTITION_KEY_STRATEGY,
+  get_detected_text,
+  parse_textract_data,
+  build_text_data,
+  write_records_to_kinesis,
+  get_s3_object_etag
+)
+
+OCR_RESULT_SUFFIX = '.json.gz'
+
+
+def current_image_etag(s3_client, image_path):
+  #XXX: image_path is {OCR_STORE_PREFIX}/{image bucket}/{image key}; None if the image is gone or not accessible
+  store_prefix = '{}/'.format(OCR_STORE_PREFIX)
+  if not image_path.startswith(store_prefix):
+    return None
+  image_bucket, _, image_key = image_path[len(store_prefix):].partition('/')
+  try:
+    return get_s3_object_etag(s3_client, image_bucket, image_key)
+  except Exception as ex:
+    print('[WARN] failed to get the ETag of s3://{}/{}: {}'.format(image_bucket, image_key, ex), file=sys.stderr)
+    return None
+
+
+def list_ocr_results(s3_client, bucket, prefix):
+  #XXX: the results are stored as {image path}/{etag}.json.gz, so an image re-uploaded with new contents has
+  # several results; only one per image is yielded - the result of the current ETag of the image,
+  # or the latest one (LastModified) if the image can not be looked up
+  ocr_results = collections.OrderedDict()
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      if obj['Key'].endswith(OCR_RESULT_SUFFIX):
+        image_path, _, etag = obj['Key'][:-len(OCR_RESULT_SUFFIX)].rpartition('/')
+        ocr_results.setdefault(image_path, {})[etag] = (obj['LastModified'], obj['Key'])
+
+  for image_path, results in ocr_results.items():
+    if len(results) > 1:
+      current_etag = current_image_etag(s3_client, image_path)
+      if current_etag in results:
+        yield results[current_etag][1]
+        continue
+    yield max(results.values())[1]
+
+
+def read_ocr_result(s3_client, bucket, key):
+  response = s3_client.get_object(Bucket=bucket, Key=key)
+  return json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+
+
+def reparse_ocr_results(s3_client, kinesis_client, bucket, prefix, kinesis_stream_name,
+    batch_size=KINESIS_MAX_RECORDS_PER_REQUEST, dry_run=False):
+  counter = collections.OrderedDict([('reads', 0),
+      ('writes', 0),
+      ('invalid', 0),
+      ('errors', 0)])
+
+  def _flush(text_data_list):
+    if dry_run:
+      for text_data in text_data_list:
+        print(json.dumps(text_data, ensure_ascii=False))
+      counter['writes'] += len(text_data_list)
+      return
+
+    outcomes = write_records_to_kinesis(kinesis_client, kinesis_stream_name, text_data_list,
+      partition_key_strategy=KINESIS_PARTITION_KEY_STRATEGY)
+    for outcome in outcomes:
+      counter['writes' if outcome['ok'] else 'errors'] += 1
+
+  text_data_list = []
+  for key in list_ocr_results(s3_client, bucket, prefix):
+    try:
+      counter['reads'] += 1
+      ocr_result = read_ocr_result(s3_client, bucket, key)
+
+      detected_text = get_detected_text(ocr_result['Blocks'])
+      if len(detected_text) < 3:
+        counter['invalid'] += 1
+        continue
+
+      doc = parse_textract_data(detected_text)
+      text_data_list.append(build_text_data(ocr_result['s3_bucket'], ocr_result['s3_key'], doc))
+    except Exception as ex:
+      counter['errors'] += 1
+      print('[ERROR] failed to re-parse s3://{}/{}'.format(bucket, key), file=sys.stderr)
+      traceback.print_exc()
+
+    if len(text_data_list) >= batch_size:
+      _flush(text_data_list)
+      text_data_list = []
+      print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+
+  if text_data_list:
+    _flush(text_data_list)
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+  return counter
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--region-name', default=AWS_REGION, help='aws region name')
+  parser.add_argument('--bucket', default=OCR_STORE_BUCKET, required=not OCR_STORE_BUCKET,
+    help='s3 bucket of the OCR result store')
+  parser.add_argument('--prefix', default='{}/'.format(OCR_STORE_PREFIX),
+    help='s3 key prefix of the OCR results to re-parse (default: {}/)'.format(OCR_STORE_PREFIX))
+  parser.add_argument('--stream-name', default=KINESIS_STREAM_NAME, help='kinesis stream to republish to')
+  parser.add_argument('--batch-size', default=KINESIS_MAX_RECORDS_PER_REQUEST, type=int,
+    help='number of records per put_records call')
+  parser.add_argument('--dry-run', action='store_true', help='print the re-parsed records instead of publishing them')
+
+  options = parser.parse_args()
+
+  s3_client = boto3.client('s3', region_name=options.region_name)
+  kinesis_client = boto3.client('kinesis', region_name=options.region_name)
+  reparse_ocr_results(s3_client, kinesis_client, options.bucket, options.prefix, options.stream_name,
+    batch_size=options.batch_size, dry_run=options.dry_run)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: in-container cache tier in front of ElastiCache (shared by the lambda functions of octember-common-lib layer)
+# - a warm container answers the repeated queries from its memory without a network round trip
+# - the entries are bounded by the total size of the values (max_bytes) and expire after ttl seconds
+# - hits/misses/evictions are counted for the logs
+
+import sys
+import time
+import threading
+import collections
+
+
+class LocalCache:
+  def __init__(self, name, max_bytes=16*1024*1024, ttl=30):
+    self.name = name
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.stats = collections.Counter()
+
+  @staticmethod
+  def _sizeof(key, value):
+    value_size = len(value) if isinstance(value, (str, bytes)) else sys.getsizeof(value)
+    return len(key) + value_size
+
+  def _evict(self, key):
+    _, _, size = self._entries.pop(key)
+    self._bytes -= size
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] <= time.time():
+        self._evict(key)
+        self.stats['expired'] += 1
+        entry = None
+
+      if entry is None:
+        self.stats['misses'] += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.stats['hits'] += 1
+      return entry[0]
+
+  def set(self, key, value, ttl=None):
+    size = self._sizeof(key, value)
+    if size > self.max_bytes:
+      return
+
+    ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+    with self._lock:
+      if key in self._entries:
+        self._evict(key)
+      self._entries[key] = (value, time.time() + ttl, size)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        self._evict(next(iter(self._entries)))
+        self.stats['evictions'] += 1
+
+  def delete(self, key):
+    with self._lock:
+      if key in self._entries:
+        self._evict(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  @property
+  def size_bytes(self):
+    return self._bytes
+
+  def stats_summary(self):
+    total = self.stats['hits'] + self.stats['misses']
+    hit_ratio = self.stats['hits'] / total if total else 0.0
+    return '{}: entries={}, bytes={}, hits={}, misses={}, expired={}, evictions={}, hit_ratio={:.2f}'.format(self.name,
+      len(self._entries), self._bytes, self.stats['hits'], self.stats['misses'], self.stats['expired'],
+      self.stats['evictions'], hit_ratio)
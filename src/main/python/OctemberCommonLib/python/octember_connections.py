@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: connection management shared by all the lambda functions (deployed as the octember-common-lib lambda layer)
+# - a connection is created lazily on first use and cached for the lifetime of the container,
+#   so warm invocations pay no setup cost and cold starts pay no unnecessary I/O
+# - an optional health check runs at most once per health_check_interval seconds
+# - a connection older than max_age seconds (ex: signed with expiring credentials) is re-created
+# - run() resets the connection and retries when the call fails with one of reconnect_on exceptions
+
+import sys
+import time
+import threading
+import traceback
+
+_CONNECTIONS = []
+
+
+class LazyConnection:
+  def __init__(self, name, connect, close=None, health_check=None, health_check_interval=60,
+      max_age=None, reconnect_on=(Exception,)):
+    self.name = name
+    self._connect = connect
+    self._close = close
+    self._health_check = health_check
+    self._health_check_interval = health_check_interval
+    self._max_age = max_age
+    self._reconnect_on = reconnect_on
+    self._conn = None
+    self._connected_at = 0
+    self._checked_at = 0
+    self._lock = threading.RLock()
+    _CONNECTIONS.append(self)
+
+  def _is_healthy(self, now):
+    if self._max_age is not None and now - self._connected_at >= self._max_age:
+      return False
+
+    if self._health_check is None or now - self._checked_at < self._health_check_interval:
+      return True
+
+    self._checked_at = now
+    try:
+      return bool(self._health_check(self._conn))
+    except Exception as ex:
+      traceback.print_exc()
+      return False
+
+  def _reconnect(self):
+    #XXX: the old connection (recycled by max_age or failed the health check) is closed before
+    # the new one is opened, so its sockets are not left to the garbage collector
+    print('[INFO] reconnecting {}'.format(self.name), file=sys.stderr)
+    self.close()
+    self._conn = self._connect()
+    self._connected_at = self._checked_at = time.time()
+
+  def get(self):
+    with self._lock:
+      now = time.time()
+      if self._conn is None:
+        self._conn = self._connect()
+        self._connected_at = self._checked_at = time.time()
+      elif not self._is_healthy(now):
+        self._reconnect()
+      return self._conn
+
+  def close(self):
+    with self._lock:
+      conn, self._conn = self._conn, None
+      if conn is not None and self._close is not None:
+        try:
+          self._close(conn)
+        except Exception as ex:
+          traceback.print_exc()
+
+  reset = close
+
+  def run(self, func, max_retry_count=1):
+    for attempt in range(max_retry_count + 1):
+      conn = self.get()
+      try:
+        return func(conn)
+      except self._reconnect_on as ex:
+        if attempt >= max_retry_count:
+          raise ex
+        traceback.print_exc()
+        with self._lock:
+          if self._conn is conn:
+            self.close()
+
+  @property
+  def connected(self):
+    return self._conn is not None
+
+
+def close_all():
+  #XXX: for the processes that exit (ex: the command line tools and the workers of BackfillBizcardText);
+  # a lambda container is frozen between invocations, so its connections are kept open
+  for conn in _CONNECTIONS:
+    conn.close()
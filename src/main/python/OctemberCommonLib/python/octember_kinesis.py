@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: Kinesis producer helpers (shared by the lambda functions of octember-common-lib layer)
+# - records are sent by PutRecords in requests of up to 500 records and 5 MB
+# - only the failed entries of a request are resent, with exponential backoff
+
+import sys
+import os
+import json
+import time
+import random
+import hashlib
+import traceback
+
+KINESIS_MAX_RECORDS_PER_REQUEST = 500
+KINESIS_MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+
+
+def gen_partition_key(record, strategy='spread'):
+  #XXX: Kinesis maps md5(partition key) onto the shard hash key ranges, so a key
+  # derived from the record content spreads the traffic over all open shards.
+  #  - spread: one key per image, records are evenly distributed over shards
+  #  - owner: one key per owner, records of the same owner keep their order
+  image_id = os.path.basename(record['s3_key'])
+  if strategy == 'owner':
+    hash_source = record.get('owner') or image_id.split('_')[0]
+  elif strategy == 'spread':
+    hash_source = image_id
+  else:
+    raise ValueError('unknown partition key strategy: {}'.format(strategy))
+  return hashlib.md5(hash_source.encode('utf-8')).hexdigest()
+
+
+def partition_key_distribution(partition_keys, shard_count):
+  #XXX: assume that the stream has shard_count shards with evenly split hash key ranges
+  # (i.e. created or resharded by UpdateShardCount with UNIFORM_SCALING)
+  hash_key_space = 2 ** 128
+  dist = [0] * shard_count
+  for partition_key in partition_keys:
+    hash_key = int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+    dist[hash_key * shard_count // hash_key_space] += 1
+  return dist
+
+
+def _chunk_kinesis_records(record_list, max_count=KINESIS_MAX_RECORDS_PER_REQUEST,
+    max_bytes=KINESIS_MAX_BYTES_PER_REQUEST):
+  #XXX: each PutRecords request can hold up to 500 records and 5 MB
+  # (the size of a record is the size of its data blob plus its partition key)
+  chunk, chunk_bytes = [], 0
+  for idx, rec in record_list:
+    rec_size = len(rec['Data'].encode('utf-8')) + len(rec['PartitionKey'].encode('utf-8'))
+    if chunk and (len(chunk) >= max_count or chunk_bytes + rec_size > max_bytes):
+      yield chunk
+      chunk, chunk_bytes = [], 0
+    chunk.append((idx, rec))
+    chunk_bytes += rec_size
+  if chunk:
+    yield chunk
+
+
+def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records, partition_key_strategy='spread',
+    max_retry_count=3, base_backoff=0.1, max_backoff=2.0):
+  def gen_records():
+    record_list = []
+    for idx, rec in enumerate(records):
+      payload = json.dumps(rec, ensure_ascii=False)
+      partition_key = gen_partition_key(rec, partition_key_strategy)
+      record_list.append((idx, {'Data': payload, 'PartitionKey': partition_key}))
+    return record_list
+
+  outcomes = [None] * len(records)
+  for chunk in _chunk_kinesis_records(gen_records()):
+    pending = chunk
+    for attempt in range(max_retry_count):
+      try:
+        response = kinesis_client.put_records(Records=[rec for _, rec in pending], StreamName=kinesis_stream_name)
+        print('[DEBUG] put_records: record_count={}, failed_record_count={}'.format(len(pending),
+          response.get('FailedRecordCount', 0)), file=sys.stderr)
+
+        failed = []
+        for (idx, rec), res in zip(pending, response['Records']):
+          if 'ErrorCode' in res:
+            outcomes[idx] = {'ok': False, 'error_code': res['ErrorCode'], 'error_message': res.get('ErrorMessage', '')}
+            failed.append((idx, rec))
+          else:
+            outcomes[idx] = {'ok': True, 'shard_id': res['ShardId'], 'sequence_number': res['SequenceNumber']}
+        pending = failed
+      except Exception as ex:
+        traceback.print_exc()
+        for idx, _ in pending:
+          outcomes[idx] = {'ok': False, 'error_code': type(ex).__name__, 'error_message': str(ex)}
+
+      if not pending:
+        break
+
+      #XXX: exponential backoff with full jitter - only the failed entries are resent
+      if attempt + 1 < max_retry_count:
+        time.sleep(random.uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+    if pending:
+      print('[ERROR] Failed to put {} records into kinesis stream: {}'.format(len(pending), kinesis_stream_name), file=sys.stderr)
+  return outcomes
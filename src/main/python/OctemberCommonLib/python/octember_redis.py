@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: redis client for the query caches in ElastiCache (shared by the lambda functions of octember-common-lib layer)
+# - a bounded connection pool with tight connect/read timeouts, so a slow or failing-over node costs milliseconds
+# - a circuit breaker opens after failure_threshold consecutive failures and bypasses redis for reset_timeout seconds,
+#   then lets one trial call through (half-open) to decide whether to close again
+# - run() raises CacheUnavailable instead of the redis errors, and the try_*/get*/set* helpers return a default,
+#   so a cache failure falls back to the source of truth instead of failing the request
+# - RateLimiter is a token bucket per identity, refilled and taken atomically by a lua script (fails open)
+# - the redis package is imported lazily, because it is deployed as a separate layer (octember-redis-lib)
+
+import sys
+import time
+import threading
+import collections
+
+from octember_connections import LazyConnection
+
+
+class CacheUnavailable(Exception):
+  pass
+
+
+class CircuitBreaker:
+  CLOSED, OPEN, HALF_OPEN = ('closed', 'open', 'half-open')
+
+  def __init__(self, name, failure_threshold=3, reset_timeout=10):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = self.CLOSED
+    self._failures = 0
+    self._opened_at = 0
+    self._lock = threading.Lock()
+
+  def allow(self):
+    with self._lock:
+      if self.state == self.CLOSED:
+        return True
+      if time.time() - self._opened_at >= self.reset_timeout:
+        #XXX: one trial call is let through per reset_timeout until it succeeds
+        self.state = self.HALF_OPEN
+        self._opened_at = time.time()
+        return True
+      return False
+
+  def record_success(self):
+    with self._lock:
+      if self.state != self.CLOSED:
+        print('[INFO] circuit {} closed'.format(self.name), file=sys.stderr)
+      self.state = self.CLOSED
+      self._failures = 0
+
+  def record_failure(self):
+    with self._lock:
+      self._failures += 1
+      if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+        if self.state != self.OPEN:
+          print('[WARN] circuit {} opened after {} failures'.format(self.name, self._failures), file=sys.stderr)
+        self.state = self.OPEN
+        self._opened_at = time.time()
+
+
+class RedisCache:
+  def __init__(self, name, host, port=6379, db=0, max_connections=8, connect_timeout=0.1, socket_timeout=0.1,
+      failure_threshold=3, reset_timeout=10):
+    self.name = name
+    self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+    self.stats = collections.Counter()
+
+    def _connect():
+      import redis
+
+      #XXX: a blocking pool waits (up to socket_timeout) for a free connection instead of opening unbounded connections
+      pool = redis.BlockingConnectionPool(host=host, port=port, db=db, max_connections=max_connections,
+        timeout=socket_timeout, socket_connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+      return redis.Redis(connection_pool=pool)
+
+    self._conn = LazyConnection(name, _connect,
+      close=lambda redis_client: redis_client.connection_pool.disconnect(),
+      reconnect_on=())
+
+  @property
+  def available(self):
+    return self.breaker.state != CircuitBreaker.OPEN
+
+  def run(self, func):
+    import redis
+
+    if not self.breaker.allow():
+      self.stats['bypassed'] += 1
+      raise CacheUnavailable('{} circuit is open'.format(self.name))
+
+    try:
+      result = func(self._conn.get())
+    except redis.exceptions.RedisError as ex:
+      self.stats['failures'] += 1
+      self.breaker.record_failure()
+      print('[WARN] {}: {}'.format(self.name, repr(ex)), file=sys.stderr)
+      raise CacheUnavailable(repr(ex)) from ex
+    self.breaker.record_success()
+    return result
+
+  def try_run(self, func, default=None):
+    try:
+      return self.run(func)
+    except CacheUnavailable:
+      return default
+
+  def pipeline(self, func):
+    def _pipeline(redis_client):
+      pipeline = redis_client.pipeline(transaction=False)
+      func(pipeline)
+      return pipeline.execute()
+    return self.run(_pipeline)
+
+  def get(self, key, default=None):
+    return self.try_run(lambda redis_client: redis_client.get(key), default)
+
+  def get_with_ttl(self, key):
+    #XXX: the remaining ttl (seconds) bounds the ttl of a copy kept in the in-container cache
+    try:
+      value, ttl = self.pipeline(lambda pipeline: (pipeline.get(key), pipeline.ttl(key)))
+    except CacheUnavailable:
+      return (None, None)
+    return (value, ttl if ttl is not None and ttl >= 0 else None)
+
+  def mget(self, keys):
+    return self.try_run(lambda redis_client: redis_client.mget(keys), [None] * len(keys))
+
+  def set(self, key, value, ex=None, nx=False):
+    return bool(self.try_run(lambda redis_client: redis_client.set(key, value, ex=ex, nx=nx), False))
+
+  def set_many(self, items):
+    #XXX: items of (key, value, ex) are written in one round trip
+    def _set_many(pipeline):
+      for key, value, ex in items:
+        pipeline.set(key, value, ex=ex)
+    try:
+      self.pipeline(_set_many)
+      return True
+    except CacheUnavailable:
+      return False
+
+  def close(self):
+    self._conn.close()
+
+  def stats_summary(self):
+    return '{}: circuit={}, failures={}, bypassed={}'.format(self.name, self.breaker.state,
+      self.stats['failures'], self.stats['bypassed'])
+
+
+#XXX: token bucket in redis - the bucket is refilled and taken in one atomic script, so concurrent lambda containers
+# share one budget per identity; the bucket expires when it would be full again
+_TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+
+local allowed, retry_after_ms = 0, 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  retry_after_ms = math.ceil((cost - tokens) * 1000 / rate)
+end
+
+redis.call('hmset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('pexpire', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return {allowed, retry_after_ms}
+'''
+
+
+class RateLimited(Exception):
+  def __init__(self, name, identity, retry_after_ms):
+    super().__init__('{} rate limit exceeded: {}'.format(name, identity))
+    self.retry_after_ms = retry_after_ms
+
+  @property
+  def retry_after(self):
+    return max(1, -(-self.retry_after_ms // 1000))
+
+
+class RateLimiter:
+  def __init__(self, cache, name, rate, capacity, key_prefix='ratelimit'):
+    self.cache = cache
+    self.name = name
+    self.rate = rate
+    self.capacity = capacity
+    self.key_prefix = key_prefix
+    self._script = None
+
+  def acquire(self, identity, cost=1):
+    #XXX: the limiter fails open - requests are admitted while redis is unavailable
+    if self.rate <= 0:
+      return
+
+    #XXX: a request costing more than the bucket can ever hold (ex: a large batch) takes the whole bucket,
+    # otherwise it could never be admitted and its retry hint would be wrong
+    cost = min(cost, self.capacity)
+    key = '{}:{}:{}'.format(self.key_prefix, self.name, identity)
+    args = [self.rate, self.capacity, int(time.time() * 1000), cost]
+
+    def _acquire(redis_client):
+      if self._script is None:
+        self._script = redis_client.register_script(_TOKEN_BUCKET_SCRIPT)
+      return self._script(keys=[key], args=args, client=redis_client)
+
+    try:
+      allowed, retry_after_ms = self.cache.run(_acquire)
+    except CacheUnavailable:
+      return
+    if not allowed:
+      raise RateLimited(self.name, identity, int(retry_after_ms))
+
+
+def request_identity(event, user=None):
+  #XXX: an api key identifies the client, or the source ip when the api does not require api keys
+  identity = (event.get('requestContext') or {}).get('identity') or {}
+  client_id = identity.get('apiKey') or identity.get('sourceIp') or 'anonymous'
+  return '{}:{}'.format(client_id, user or '')
@@ -10,7 +10,6 @@ import traceback
 import pprint
 
 import boto3
-import redis
 
 from gremlin_python import statics
 from gremlin_python.structure.graph import Graph
@@ -19,40 +18,83 @@ from gremlin_python.process.strategies import *
 from gremlin_python.process.traversal import T, P, Operator, Scope, Column, Order
 from gremlin_python.process.anonymous_traversal import traversal
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from tornado.httpclient import HTTPError
+from tornado.websocket import WebSocketClosedError
+from tornado.iostream import StreamClosedError
+from tornado.gen import TimeoutError as TornadoTimeoutError
+
+from octember_connections import LazyConnection, close_all
+from octember_cache import LocalCache
+from octember_redis import RedisCache, RateLimiter, RateLimited, request_identity
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 NEPTUNE_ENDPOINT = os.getenv('NEPTUNE_ENDPOINT')
 NEPTUNE_PORT = int(os.getenv('NEPTUNE_PORT', '8182'))
 
-NEPTUNE_CONN = None
-
 ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
-redis_client = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+#XXX: a slow or failing redis costs at most the timeouts, and after consecutive failures
+# the cache is bypassed (recommendations come from neptune directly) until the circuit closes again
+REDIS_CACHE = RedisCache('redis', ELASTICACHE_HOST,
+  max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '8')),
+  connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', '0.1')),
+  socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.1')),
+  failure_threshold=int(os.getenv('REDIS_CIRCUIT_FAILURE_THRESHOLD', '3')),
+  reset_timeout=float(os.getenv('REDIS_CIRCUIT_RESET_TIMEOUT', '10')))
+
+#XXX: per-client admission control (token buckets keyed by the api key and the user parameter);
+# every request takes a token from the hit budget, and a request that runs the gremlin traversal
+# also takes one from the smaller miss budget (rate <= 0 disables)
+PYMK_HIT_LIMITER = RateLimiter(REDIS_CACHE, 'pymk_hit',
+  rate=float(os.getenv('PYMK_HIT_RATE_LIMIT', '20')),
+  capacity=float(os.getenv('PYMK_HIT_BURST', '40')))
+PYMK_MISS_LIMITER = RateLimiter(REDIS_CACHE, 'pymk_miss',
+  rate=float(os.getenv('PYMK_MISS_RATE_LIMIT', '1')),
+  capacity=float(os.getenv('PYMK_MISS_BURST', '5')))
+
+PYMK_CACHE_TTL = int(os.getenv('PYMK_CACHE_TTL', '{}'.format(10*60)))
+
+#XXX: in-container cache tier checked before redis; its entries expire no later than the redis ones
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', '{}'.format(16*1024*1024)))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', '30'))
+LOCAL_PYMK_CACHE = LocalCache('pymk', max_bytes=LOCAL_CACHE_MAX_BYTES, ttl=min(LOCAL_CACHE_TTL, PYMK_CACHE_TTL))
+
+
+def remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
+  neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='ws',
+    neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
+
+  if show_endpoint:
+    print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
+  retry_count = 0
+  while True:
+    try:
+      return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
+    except HTTPError as ex:
+      exc_info = sys.exc_info()
+      if retry_count < 3:
+        retry_count += 1
+        print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
+      else:
+        raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
 
-def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
-  def _remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
-    neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='ws',
-      neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
-
-    if show_endpoint:
-      print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
-    retry_count = 0
-    while True:
-      try:
-        return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
-      except HTTPError as ex:
-        exc_info = sys.exc_info()
-        if retry_count < 3:
-          retry_count += 1
-          print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
-        else:
-          raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
 
+def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
   if connection is None:
-    connection = _remote_connection(neptune_endpoint, neptune_port, show_endpoint)
+    connection = remote_connection(neptune_endpoint, neptune_port, show_endpoint)
   return traversal().withRemote(connection)
 
 
+#XXX: one websocket connection per container; it is checked at most once a minute,
+# re-opened when the check fails or a traversal fails on the transport, and closed by close();
+# a traversal that fails on the server (ex: GremlinServerError) is not retried on a new connection
+NEPTUNE_CONN = LazyConnection('neptune',
+  lambda: remote_connection(NEPTUNE_ENDPOINT, NEPTUNE_PORT),
+  close=lambda conn: conn.close(),
+  health_check=lambda conn: graph_traversal(connection=conn).V().limit(1).count().next() is not None,
+  health_check_interval=60,
+  reconnect_on=(HTTPError, WebSocketClosedError, StreamClosedError, TornadoTimeoutError, OSError))
+
+
 def people_you_may_know(g, user_name, limit=10):
   from gremlin_python.process.traversal import Scope, Column, Order
 
@@ -74,29 +116,33 @@ def people_you_may_know(g, user_name, limit=10):
 
 
 def lambda_handler(event, context):
-  global NEPTUNE_CONN
-
-  if NEPTUNE_CONN is None:
-    NEPTUNE_CONN = graph_traversal(NEPTUNE_ENDPOINT, NEPTUNE_PORT, connection=None)
-  graph_db = NEPTUNE_CONN
- 
   try:
     user_name = event['queryStringParameters']['user']
     limit = int(event['queryStringParameters'].get('limit', 10))
+    identity = request_identity(event, user_name)
+    PYMK_HIT_LIMITER.acquire(identity)
 
     query_hash_code = hashlib.md5(user_name.lower().encode('utf-8')).hexdigest()[:8]
     query_id = 'pymk:query_id:{}'.format(query_hash_code)
     print('[DEBUG] PYMK query id: {}'.format(query_id))
 
-    results = redis_client.get(query_id)
-    results = results.decode('utf-8') if results != None else None
+    results = LOCAL_PYMK_CACHE.get(query_id)
     if results is None:
-      ret = people_you_may_know(graph_db, user_name, limit)
-      total_count = len(ret)
-      print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
-      results = json.dumps(ret)
-      if total_count > 0:
-        redis_client.set(query_id, results, ex=10*60, nx=True)
+      #XXX: get and ttl in one round trip; the local copy expires no later than the redis one
+      results, ttl = REDIS_CACHE.get_with_ttl(query_id)
+      results = results.decode('utf-8') if results != None else None
+      if results is None:
+        PYMK_MISS_LIMITER.acquire(identity)
+        ret = NEPTUNE_CONN.run(lambda conn: people_you_may_know(graph_traversal(connection=conn), user_name, limit))
+        total_count = len(ret)
+        print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
+        results = json.dumps(ret)
+        if total_count > 0:
+          REDIS_CACHE.set(query_id, results, ex=PYMK_CACHE_TTL, nx=True)
+          LOCAL_PYMK_CACHE.set(query_id, results)
+      else:
+        LOCAL_PYMK_CACHE.set(query_id, results, ttl=ttl)
+    print('[DEBUG] {}, {}'.format(LOCAL_PYMK_CACHE.stats_summary(), REDIS_CACHE.stats_summary()), file=sys.stderr)
 
     #XXX: https://aws.amazon.com/ko/premiumsupport/knowledge-center/malformed-502-api-gateway/
     response = {
@@ -105,6 +151,14 @@ def lambda_handler(event, context):
       'isBase64Encoded': False
     }
     return response
+  except RateLimited as ex:
+    print('[WARN] {}'.format(ex), file=sys.stderr)
+    return {
+      'statusCode': 429,
+      'headers': {'Content-Type': 'application/json; charset=utf-8', 'Retry-After': str(ex.retry_after)},
+      'body': json.dumps({'message': 'Too Many Requests', 'retry_after_ms': ex.retry_after_ms}),
+      'isBase64Encoded': False
+    }
   except Exception as ex:
     traceback.print_exc()
 
@@ -169,4 +223,4 @@ if __name__ == '__main__':
 
   res = lambda_handler(event, {})
   pprint.pprint(res)
-
+  close_all()
@@ -5,96 +5,679 @@
 import sys
 import json
 import os
+import base64
 import hashlib
 import traceback
 import pprint
+import time
+import uuid
+import unicodedata
+import zlib
+import collections
 
 import boto3
 from elasticsearch import Elasticsearch
 from elasticsearch import RequestsHttpConnection
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, AuthorizationException
 from requests_aws4auth import AWS4Auth
-import redis
+
+from octember_connections import LazyConnection
+from octember_cache import LocalCache
+from octember_redis import RedisCache, CacheUnavailable, RateLimiter, RateLimited, request_identity
 
 ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
-redis_client = redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0)
+#XXX: a slow or failing redis costs at most the timeouts, and after consecutive failures
+# the cache is bypassed (searches go to ES directly) until the circuit closes again
+REDIS_CACHE = RedisCache('redis', ELASTICACHE_HOST,
+  max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '8')),
+  connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', '0.1')),
+  socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.1')),
+  failure_threshold=int(os.getenv('REDIS_CIRCUIT_FAILURE_THRESHOLD', '3')),
+  reset_timeout=float(os.getenv('REDIS_CIRCUIT_RESET_TIMEOUT', '10')))
+
+ES_INDEX = os.getenv('ES_INDEX', 'octember_bizcard')
+#XXX: searches go through the read alias, which is swapped atomically after a reindex
+ES_READ_ALIAS = os.getenv('ES_READ_ALIAS', '{}-read'.format(ES_INDEX))
+
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '{}'.format(10*60)))
+#XXX: zero-hit results are cached for a short time, so repeated misses do not always go to ES
+SEARCH_NEGATIVE_CACHE_TTL = int(os.getenv('SEARCH_NEGATIVE_CACHE_TTL', '30'))
+#XXX: single-flight - only the request holding the lock of a cache key queries ES on a cache miss,
+# and the others wait for its result up to SEARCH_CACHE_LOCK_WAIT seconds
+SEARCH_CACHE_LOCK_TTL_MS = int(os.getenv('SEARCH_CACHE_LOCK_TTL_MS', '5000'))
+SEARCH_CACHE_LOCK_WAIT = float(os.getenv('SEARCH_CACHE_LOCK_WAIT', '2.0'))
+SEARCH_CACHE_LOCK_POLL_INTERVAL = 0.05
+
+#XXX: the cache key embeds the version of the owner (or of all owners), which UpsertBizcardToES increments
+# after indexing, so the cached results are invalidated in O(1) without scanning keys
+OWNER_VERSION_KEY_FORMAT = 'es:owner_version:{}'
+ALL_OWNERS = '__all__'
+
+#XXX: a result page of SEARCH_CACHE_PAGE_SIZE hits is fetched and cached for any limit up to it,
+# and smaller limits are sliced from the page, so limit=10 and limit=20 share one cache entry
+SEARCH_CACHE_PAGE_SIZE = int(os.getenv('SEARCH_CACHE_PAGE_SIZE', '50'))
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', '100'))
+
+#XXX: cursor pagination - hits are sorted by _score and _id (tie-breaker), and the next page starts
+# after the sort values of the last hit (search_after), so a deep page costs the same as the first page;
+# _id is the doc_id, and unlike doc_id it is sortable in the legacy index too (doc_id is a text field by dynamic mapping)
+SEARCH_SORT = [{"_score": "desc"}, {"_id": "asc"}]
+#XXX: point in time requires elasticsearch 7.10 or later; without it, every page of a query is searched on the same
+# shard copies (preference derived from the query, see search_preference), so the scores and the order of hits are
+# stable across pages, including the cached first page
+SEARCH_PIT_ENABLED = (os.getenv('SEARCH_PIT_ENABLED', 'false').lower() == 'true')
+SEARCH_PIT_KEEP_ALIVE = os.getenv('SEARCH_PIT_KEEP_ALIVE', '1m')
+
+#XXX: in-container cache tier checked before redis; the owner versions are re-read from redis
+# at most every OWNER_VERSION_CHECK_INTERVAL seconds, so a bump by UpsertBizcardToES is seen within that interval
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', '{}'.format(16*1024*1024)))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', '30'))
+OWNER_VERSION_CHECK_INTERVAL = float(os.getenv('OWNER_VERSION_CHECK_INTERVAL', '1'))
+
+LOCAL_SEARCH_CACHE = LocalCache('search', max_bytes=LOCAL_CACHE_MAX_BYTES, ttl=LOCAL_CACHE_TTL)
+LOCAL_OWNER_VERSIONS = LocalCache('owner_version', max_bytes=1024*1024, ttl=OWNER_VERSION_CHECK_INTERVAL)
+
+#XXX: response projection - only the requested _source fields (the fields query parameter) are fetched from ES,
+# and each hit is returned as a flat object of those fields and its score (without _index, _type, and so on)
+SEARCH_SOURCE_FIELDS = ['doc_id', 'name', 'job_title', 'company', 'addr', 'phone_number', 'email',
+  'owner', 'image_id', 'created_at']
+SEARCH_DEFAULT_FIELDS = [e for e in os.getenv('SEARCH_DEFAULT_FIELDS', ','.join(SEARCH_SOURCE_FIELDS)).split(',') if e]
 
-ES_INDEX, ES_TYPE = (os.getenv('ES_INDEX', 'octember_bizcard'), os.getenv('ES_TYPE', 'bizcard'))
+#XXX: the cached result pages are stored compressed in redis (zlib), which cuts the memory per cached query
+SEARCH_CACHE_COMPRESS_LEVEL = int(os.getenv('SEARCH_CACHE_COMPRESS_LEVEL', '6'))
+
+#XXX: typeahead (/suggest) - an owner's prefix is matched against the edge-ngram sub-fields (*.suggest)
+# installed by the index template, so it is a cheap term lookup on one shard instead of a full multi_match;
+# the results of short prefixes (up to SUGGEST_CACHE_PREFIX_MAX_LEN characters) are cached, and longer prefixes,
+# which are too many to cache, go to ES with a tight timeout
+SUGGEST_FIELDS = ['name.suggest^3', 'company.suggest', 'job_title.suggest']
+SUGGEST_SOURCE_FIELDS = ['doc_id', 'name', 'company', 'job_title']
+SUGGEST_MAX_LIMIT = int(os.getenv('SUGGEST_MAX_LIMIT', '10'))
+SUGGEST_CACHE_PREFIX_MAX_LEN = int(os.getenv('SUGGEST_CACHE_PREFIX_MAX_LEN', '3'))
+SUGGEST_REQUEST_TIMEOUT = float(os.getenv('SUGGEST_REQUEST_TIMEOUT', '1.0'))
+
+#XXX: batch mode (POST /search) - the cache entries of all the queries are read with one MGET,
+# the misses are sent to ES in one _msearch, and the results are written back in one pipeline
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv('SEARCH_BATCH_MAX_QUERIES', '100'))
+
+#XXX: per-client admission control (token buckets keyed by the api key and the user parameter);
+# every request takes a token from the hit budget, and a request that goes to ES also takes one from the
+# smaller miss budget, so cached responses stay cheap while the expensive misses are throttled (rate <= 0 disables)
+SEARCH_HIT_LIMITER = RateLimiter(REDIS_CACHE, 'search_hit',
+  rate=float(os.getenv('SEARCH_HIT_RATE_LIMIT', '20')),
+  capacity=float(os.getenv('SEARCH_HIT_BURST', '40')))
+SEARCH_MISS_LIMITER = RateLimiter(REDIS_CACHE, 'search_miss',
+  rate=float(os.getenv('SEARCH_MISS_RATE_LIMIT', '2')),
+  capacity=float(os.getenv('SEARCH_MISS_BURST', '10')))
+#XXX: typeahead sends a request per keystroke, so the uncached prefixes have their own (larger) budget
+SUGGEST_MISS_LIMITER = RateLimiter(REDIS_CACHE, 'suggest_miss',
+  rate=float(os.getenv('SUGGEST_MISS_RATE_LIMIT', '10')),
+  capacity=float(os.getenv('SUGGEST_MISS_BURST', '30')))
+
+_RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('del', KEYS[1])
+end
+return 0
+'''
 ES_HOST = os.getenv('ES_HOST')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 
-session = boto3.Session(region_name=AWS_REGION)
-credentials = session.get_credentials()
-credentials = credentials.get_frozen_credentials()
-access_key = credentials.access_key
-secret_key = credentials.secret_key
-token = credentials.token
-
-aws_auth = AWS4Auth(
-  access_key,
-  secret_key,
-  AWS_REGION,
-  'es',
-  session_token=token
-)
-
-es_client = Elasticsearch(
-  hosts = [{'host': ES_HOST, 'port': 443}],
-  http_auth=aws_auth,
-  use_ssl=True,
-  verify_certs=True,
-  connection_class=RequestsHttpConnection
-)
-print('[INFO] ElasticSearch Service', json.dumps(es_client.info(), indent=2), file=sys.stderr)
 
+class BadRequest(ValueError):
+  #XXX: invalid request parameters; answered with 400 Bad Request and the message
+  pass
 
-def lambda_handler(event, context):
+
+def es_connect():
+  session = boto3.Session(region_name=AWS_REGION)
+  credentials = session.get_credentials()
+  credentials = credentials.get_frozen_credentials()
+  access_key = credentials.access_key
+  secret_key = credentials.secret_key
+  token = credentials.token
+
+  aws_auth = AWS4Auth(
+    access_key,
+    secret_key,
+    AWS_REGION,
+    'es',
+    session_token=token
+  )
+
+  es_client = Elasticsearch(
+    hosts = [{'host': ES_HOST, 'port': 443}],
+    http_auth=aws_auth,
+    use_ssl=True,
+    verify_certs=True,
+    connection_class=RequestsHttpConnection
+  )
+  print('[INFO] ElasticSearch Service: {}'.format(ES_HOST), file=sys.stderr)
+  return es_client
+
+
+#XXX: the es client signs requests with the frozen credentials of the lambda role,
+# so it is re-created before the credentials expire
+ES_CLIENT = LazyConnection('elasticsearch', es_connect,
+  close=lambda es_client: es_client.transport.close(),
+  max_age=30*60,
+  reconnect_on=(ESConnectionError, AuthorizationException))
+
+
+def get_owner_version(owner=None):
+  version_key = OWNER_VERSION_KEY_FORMAT.format(owner or ALL_OWNERS)
+  version = LOCAL_OWNER_VERSIONS.get(version_key)
+  if version is None:
+    version = REDIS_CACHE.run(lambda redis_client: redis_client.get(version_key))
+    version = int(version) if version is not None else 0
+    LOCAL_OWNER_VERSIONS.set(version_key, version)
+  return version
+
+
+def get_owner_versions(owners):
+  version_keys = {owner: OWNER_VERSION_KEY_FORMAT.format(owner or ALL_OWNERS) for owner in set(owners)}
+  versions = {owner: LOCAL_OWNER_VERSIONS.get(version_key) for owner, version_key in version_keys.items()}
+  missing_owners = [owner for owner, version in versions.items() if version is None]
+  if missing_owners:
+    values = REDIS_CACHE.run(lambda redis_client: redis_client.mget([version_keys[e] for e in missing_owners]))
+    for owner, version in zip(missing_owners, values):
+      versions[owner] = int(version) if version is not None else 0
+      LOCAL_OWNER_VERSIONS.set(version_keys[owner], versions[owner])
+  return versions
+
+
+def canonicalize_keywords(text):
+  #XXX: NFKC folds the full-width/compatibility characters and composes the Hangul jamo into syllables,
+  # and casefold() and the whitespace collapsing make "Kim", "kim " and "KIM" the same query
+  text = unicodedata.normalize('NFKC', text or '')
+  return ' '.join(text.casefold().split())
+
+
+def canonicalize_search_params(query_params):
+  query_keywords = canonicalize_keywords(query_params.get('query', ''))
+  #XXX: owner is a keyword field, so it is not case folded
+  user_name = unicodedata.normalize('NFKC', query_params.get('user', '') or '').strip()
+  limit = parse_limit(query_params.get('limit'), 10, SEARCH_MAX_LIMIT)
+  fields = canonicalize_fields(query_params.get('fields', ''))
+  return (query_keywords, user_name, limit, fields)
+
+
+def parse_limit(value, default, max_limit):
+  #XXX: a limit over max_limit is capped, but a limit that is not a positive integer is rejected
+  try:
+    limit = int(value) if value is not None else default
+  except (TypeError, ValueError):
+    raise BadRequest('limit must be an integer: {}'.format(value))
+  if limit < 1:
+    raise BadRequest('limit must be positive: {}'.format(limit))
+  return min(limit, max_limit)
+
+
+def canonicalize_fields(text):
+  #XXX: doc_id is always returned because it identifies the hit
+  fields = set(e.strip().lower() for e in (text or '').split(',')) - {''}
+  unknown_fields = fields - set(SEARCH_SOURCE_FIELDS)
+  if unknown_fields:
+    raise BadRequest('unknown fields: {}'.format(','.join(sorted(unknown_fields))))
+  fields = fields or set(SEARCH_DEFAULT_FIELDS)
+  return [e for e in SEARCH_SOURCE_FIELDS if e in fields or e == 'doc_id']
+
+
+def build_es_query_body(query_keywords, user_name, fields=SEARCH_SOURCE_FIELDS):
+  es_query_body = {"query": {"bool": {}}, "_source": {"includes": list(fields)}}
+
+  if query_keywords:
+    es_query_body['query']['bool']['must'] = [{
+        "multi_match": {
+          "query": query_keywords,
+          "fields": [
+            "name^3", "company", "job_title", "addr"
+          ]
+        }
+      }
+    ]
+
+  if user_name:
+    es_query_body['query']['bool']['filter'] = [{"term": {"owner": user_name}}]
+
+  es_query_body['sort'] = SEARCH_SORT
+  return es_query_body
+
+
+def project_hit(hit):
+  projected = dict(hit['_source'])
+  projected['score'] = hit['_score']
+  if 'sort' in hit:
+    projected['sort'] = hit['sort']
+  return projected
+
+
+def dump_hits(hits):
+  return json.dumps(hits, separators=(',', ':'), ensure_ascii=False)
+
+
+def encode_response_hits(hits):
+  #XXX: the sort values are kept in the cached page to make the cursor, but are not a part of the response
+  return dump_hits([{k: v for k, v in hit.items() if k != 'sort'} for hit in hits])
+
+
+def compress_cache_value(results):
+  return zlib.compress(results.encode('utf-8'), SEARCH_CACHE_COMPRESS_LEVEL)
+
+
+def decompress_cache_value(value):
+  return zlib.decompress(value).decode('utf-8')
+
+
+def encode_cursor(cursor):
+  token = base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+  return token.decode('utf-8').rstrip('=')
+
+
+def decode_cursor(token):
+  #XXX: binascii.Error, UnicodeDecodeError and JSONDecodeError are all ValueError
+  try:
+    token = token + '=' * (-len(token) % 4)
+    cursor = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')).decode('utf-8'))
+  except ValueError:
+    raise BadRequest('invalid cursor')
+  if not isinstance(cursor, dict) or not isinstance(cursor.get('l'), int) or not isinstance(cursor.get('after'), list) \
+      or 'q' not in cursor or 'u' not in cursor or not (cursor.get('pit') or cursor.get('pref')):
+    raise BadRequest('invalid cursor')
+  return cursor
+
+
+def open_point_in_time(es_client, index_name, routing=None):
+  params = {'keep_alive': SEARCH_PIT_KEEP_ALIVE}
+  if routing:
+    params['routing'] = routing
+  res = es_client.transport.perform_request('POST', '/{}/_pit'.format(index_name), params=params)
+  return res['id']
+
+
+def next_cursor(query_keywords, user_name, limit, fields, hits, pit_id=None, preference=None):
+  if len(hits) < limit:
+    return None
+
+  if SEARCH_PIT_ENABLED and pit_id is None:
+    pit_id = ES_CLIENT.run(lambda es_client: open_point_in_time(es_client, ES_READ_ALIAS, user_name))
+
+  cursor = {'q': query_keywords, 'u': user_name, 'l': limit, 'f': fields, 'after': hits[-1]['sort']}
+  if pit_id:
+    cursor['pit'] = pit_id
+  else:
+    cursor['pref'] = preference or search_preference(build_es_query_body(query_keywords, user_name, fields))
+  return encode_cursor(cursor)
+
+
+def search_after_page(cursor):
+  query_keywords, user_name, limit = cursor['q'], cursor['u'], cursor['l']
+  fields = cursor.get('f', SEARCH_SOURCE_FIELDS)
+  es_query_body = build_es_query_body(query_keywords, user_name, fields)
+  es_query_body['search_after'] = cursor['after']
+
+  search_params = {}
+  if cursor.get('pit'):
+    #XXX: a search with point in time must not have the index and routing (they are bound to the point in time)
+    es_query_body['pit'] = {'id': cursor['pit'], 'keep_alive': SEARCH_PIT_KEEP_ALIVE}
+  else:
+    search_params = {'index': ES_READ_ALIAS, 'preference': cursor['pref']}
+    if user_name:
+      search_params['routing'] = user_name
+
+  ret = ES_CLIENT.run(lambda es_client: es_client.search(body=es_query_body, size=limit, **search_params))
+  hits = [project_hit(hit) for hit in ret['hits']['hits']]
+  return (hits, next_cursor(query_keywords, user_name, limit, fields, hits,
+    pit_id=ret.get('pit_id', cursor.get('pit')), preference=cursor.get('pref')))
+
+
+def query_hash(es_query_body):
+  #XXX: sort_keys makes the hash independent of the order of the parameters
+  return hashlib.md5(json.dumps(es_query_body, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:8]
+
+
+def search_preference(es_query_body):
+  #XXX: the first page of a query is fetched with this preference whoever fetches it (a search, a batch or the warmer),
+  # and the cursor carries it to the next pages
+  return query_hash(es_query_body)
+
+
+def search_cache_key(es_query_body, page_size, owner_version):
+  return 'es:query_id:{}:size:{}:v:{}:z'.format(query_hash(es_query_body), page_size, owner_version)
+
+
+def owner_search_cache_key(es_query_body, page_size, owner=None):
+  #XXX: a cached result can not be validated without the owner version, so the cache is bypassed (None)
+  try:
+    owner_version = get_owner_version(owner)
+  except CacheUnavailable:
+    return None
+  return search_cache_key(es_query_body, page_size, owner_version)
+
+
+def _set_local_cache(cache_key, results, total_count=None, ttl=None):
+  if ttl is None:
+    is_negative = (total_count == 0) if total_count is not None else (results == '[]')
+    ttl = SEARCH_NEGATIVE_CACHE_TTL if is_negative else None
+  LOCAL_SEARCH_CACHE.set(cache_key, results, ttl=ttl)
+
+
+def _get_cached_results(cache_key):
+  #XXX: get and ttl in one round trip; the local copy expires no later than the redis one
+  value, ttl = REDIS_CACHE.get_with_ttl(cache_key)
+  if value is None:
+    return None
+  results = decompress_cache_value(value)
+  _set_local_cache(cache_key, results, ttl=ttl)
+  return results
+
+
+def throttled(identity, search):
+  def _throttled():
+    SEARCH_MISS_LIMITER.acquire(identity)
+    return search()
+  return _throttled
+
+
+def cached_search(cache_key, search):
+  if cache_key is None:
+    results, _ = search()
+    return results
+
+  results = LOCAL_SEARCH_CACHE.get(cache_key)
+  if results is not None:
+    return results
+
+  results = _get_cached_results(cache_key)
+  if results is not None:
+    return results
+
+  lock_key, lock_token = '{}:lock'.format(cache_key), uuid.uuid4().hex
   try:
-    query_params = event['queryStringParameters']
-    query_keywords = query_params.get('query', '')
+    is_locked = REDIS_CACHE.run(lambda redis_client: redis_client.set(lock_key, lock_token, px=SEARCH_CACHE_LOCK_TTL_MS, nx=True))
+  except CacheUnavailable:
+    results, _ = search()
+    return results
+
+  if is_locked:
+    try:
+      results, total_count = search()
+      ttl = SEARCH_CACHE_TTL if total_count > 0 else SEARCH_NEGATIVE_CACHE_TTL
+      REDIS_CACHE.set(cache_key, compress_cache_value(results), ex=ttl)
+      _set_local_cache(cache_key, results, total_count)
+      return results
+    finally:
+      REDIS_CACHE.try_run(lambda redis_client: redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, lock_token))
 
-    limit = int(query_params.get('limit', '10'))
-    user_name = query_params.get('user', '')
+  #XXX: another request is querying ES for the same cache key
+  deadline = time.time() + SEARCH_CACHE_LOCK_WAIT
+  while time.time() < deadline and REDIS_CACHE.available:
+    time.sleep(SEARCH_CACHE_LOCK_POLL_INTERVAL)
+    results = _get_cached_results(cache_key)
+    if results is not None:
+      return results
 
-    es_query_body = {"query": {"bool": {}}}
+  print('[WARN] timed out waiting for the result of {}'.format(cache_key), file=sys.stderr)
+  results, _ = search()
+  return results
 
-    if query_keywords:
-      es_query_body['query']['bool']['must'] = [{
+
+def build_suggest_query_body(prefix, user_name):
+  return {
+    "query": {
+      "bool": {
+        "must": [{
           "multi_match": {
-            "query": query_keywords,
-            "fields": [
-              "name^3", "company", "job_title", "addr"
-            ]
+            "query": prefix,
+            "fields": SUGGEST_FIELDS,
+            "operator": "and"
           }
-        }
-      ]
+        }],
+        "filter": [{"term": {"owner": user_name}}]
+      }
+    },
+    "_source": {"includes": SUGGEST_SOURCE_FIELDS},
+    "track_total_hits": False
+  }
+
+
+def suggest(query_params, identity):
+  prefix = canonicalize_keywords(query_params.get('prefix', ''))
+  user_name = unicodedata.normalize('NFKC', query_params.get('user', '') or '').strip()
+  limit = parse_limit(query_params.get('limit'), 5, SUGGEST_MAX_LIMIT)
+  if not prefix:
+    raise BadRequest('prefix is required')
+  if not user_name:
+    raise BadRequest('user is required')
+
+  es_query_body = build_suggest_query_body(prefix, user_name)
+
+  def _suggest(size):
+    SUGGEST_MISS_LIMITER.acquire(identity)
+    ret = ES_CLIENT.run(lambda es_client: es_client.search(index=ES_READ_ALIAS, body=es_query_body, size=size,
+      routing=user_name, request_timeout=SUGGEST_REQUEST_TIMEOUT))
+    hits = [project_hit(hit) for hit in ret['hits']['hits']]
+    return (dump_hits(hits), len(hits))
+
+  if len(prefix) > SUGGEST_CACHE_PREFIX_MAX_LEN:
+    results, _ = _suggest(limit)
+    return json.loads(results)
+
+  query_id = owner_search_cache_key(es_query_body, SUGGEST_MAX_LIMIT, user_name)
+  results = cached_search(query_id, lambda: _suggest(SUGGEST_MAX_LIMIT))
+  return json.loads(results)[:limit]
 
+
+def msearch_pages(requests):
+  #XXX: requests of (user_name, page_size, es_query_body); a failed query returns (None, None)
+  msearch_body = []
+  for user_name, page_size, es_query_body in requests:
+    #XXX: documents are routed by owner, so a search filtered by owner hits only one shard
+    header = {'index': ES_READ_ALIAS, 'preference': search_preference(es_query_body)}
     if user_name:
-      es_query_body['query']['bool']['filter'] = [{"term": {"owner": user_name}}]
-    print('[DEBUG] elasticsearch query: {}'.format(json.dumps(es_query_body)))
-    assert query_keywords or user_name
-
-    query_hash_code = hashlib.md5(json.dumps(es_query_body).encode('utf-8')).hexdigest()[:8]
-    query_id = 'es:query_id:{}:limit:{}'.format(query_hash_code, limit)
-    print('[DEBUG] elasticsearch query id: {}'.format(query_id))
-
-    results = redis_client.get(query_id)
-    results = results.decode('utf-8') if results != None else None
-    if results is None:
-      ret = es_client.search(index=ES_INDEX, body=es_query_body, size=limit)
-      total_count = int(ret['hits']['total']['value'])
-      print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
-      results = json.dumps(ret['hits']['hits'])
-      if total_count > 0:
-        redis_client.set(query_id, results, ex=10*60, nx=True)
+      header['routing'] = user_name
+    msearch_body.extend([header, dict(es_query_body, size=page_size)])
+  ret = ES_CLIENT.run(lambda es_client: es_client.msearch(body=msearch_body))
+
+  pages = []
+  for res in ret['responses']:
+    if 'error' in res:
+      print('[ERROR] msearch: {}'.format(json.dumps(res['error'])[:1024]), file=sys.stderr)
+      pages.append((None, None))
+    else:
+      pages.append((dump_hits([project_hit(hit) for hit in res['hits']['hits']]), int(res['hits']['total']['value'])))
+  return pages
+
+
+def batch_search(queries, identity):
+  if not isinstance(queries, list) or not 0 < len(queries) <= SEARCH_BATCH_MAX_QUERIES:
+    raise BadRequest('queries must be a list of 1 to {} queries'.format(SEARCH_BATCH_MAX_QUERIES))
+
+  requests = []
+  for idx, query_params in enumerate(queries):
+    if not isinstance(query_params, dict) or \
+        not all(isinstance(query_params.get(k), (str, type(None))) for k in ('query', 'user', 'fields')):
+      raise BadRequest('queries[{}]: must be an object of query, user, limit and fields'.format(idx))
+    try:
+      query_keywords, user_name, limit, fields = canonicalize_search_params(query_params)
+    except BadRequest as ex:
+      raise BadRequest('queries[{}]: {}'.format(idx, ex))
+    if not (query_keywords or user_name):
+      raise BadRequest('queries[{}]: query or user is required'.format(idx))
+    requests.append((user_name, limit, build_es_query_body(query_keywords, user_name, fields)))
+  SEARCH_HIT_LIMITER.acquire(identity, cost=len(queries))
+
+  try:
+    owner_versions, use_cache = (get_owner_versions([user_name for user_name, _, _ in requests]), True)
+  except CacheUnavailable:
+    #XXX: the cache is bypassed, and the owner versions only name the queries
+    owner_versions, use_cache = (collections.defaultdict(int), False)
+
+  cache_keys = []
+  for user_name, limit, es_query_body in requests:
+    page_size = max(limit, SEARCH_CACHE_PAGE_SIZE)
+    cache_keys.append(search_cache_key(es_query_body, page_size, owner_versions[user_name]))
+
+  #XXX: the same query may appear more than once in a batch, so the results are looked up by cache key
+  results = {}
+  for cache_key in (set(cache_keys) if use_cache else []):
+    local_results = LOCAL_SEARCH_CACHE.get(cache_key)
+    if local_results is not None:
+      results[cache_key] = local_results
+
+  missing_keys = [e for e in dict.fromkeys(cache_keys) if e not in results]
+  if missing_keys and use_cache:
+    for cache_key, value in zip(missing_keys, REDIS_CACHE.mget(missing_keys)):
+      if value is not None:
+        results[cache_key] = decompress_cache_value(value)
+        _set_local_cache(cache_key, results[cache_key])
+
+  missing_requests = {}
+  for cache_key, (user_name, limit, es_query_body) in zip(cache_keys, requests):
+    if cache_key not in results:
+      missing_requests.setdefault(cache_key, (user_name, max(limit, SEARCH_CACHE_PAGE_SIZE), es_query_body))
+  print('[INFO] batch search: queries={}, cache misses={}'.format(len(requests), len(missing_requests)), file=sys.stderr)
+
+  if missing_requests:
+    SEARCH_MISS_LIMITER.acquire(identity, cost=len(missing_requests))
+
+    cache_items = []
+    for cache_key, (page, total_count) in zip(missing_requests.keys(), msearch_pages(missing_requests.values())):
+      if page is None:
+        #XXX: a failed query gets no hits, and is not cached
+        results[cache_key] = '[]'
+        continue
+
+      results[cache_key] = page
+      if use_cache:
+        ttl = SEARCH_CACHE_TTL if total_count > 0 else SEARCH_NEGATIVE_CACHE_TTL
+        cache_items.append((cache_key, compress_cache_value(results[cache_key]), ttl))
+        _set_local_cache(cache_key, results[cache_key], total_count)
+    if cache_items:
+      REDIS_CACHE.set_many(cache_items)
+
+  return [json.loads(results[cache_key])[:limit] for cache_key, (_, limit, _) in zip(cache_keys, requests)]
+
+
+def warm_owner_pages(owners):
+  #XXX: the owner versions are read from redis (not from the in-container tier), because they were just bumped
+  owners = sorted(set(unicodedata.normalize('NFKC', e or '').strip() for e in owners) - {''})
+  fields = canonicalize_fields('')
+  counter = collections.Counter()
+  for i in range(0, len(owners), SEARCH_BATCH_MAX_QUERIES):
+    chunk = owners[i:i + SEARCH_BATCH_MAX_QUERIES]
+    versions = REDIS_CACHE.run(lambda redis_client: redis_client.mget([OWNER_VERSION_KEY_FORMAT.format(e) for e in chunk]))
+
+    #XXX: the same query and cache key as GET /search?user={owner} without keywords (limit <= SEARCH_CACHE_PAGE_SIZE)
+    requests = [(owner, SEARCH_CACHE_PAGE_SIZE, build_es_query_body('', owner, fields)) for owner in chunk]
+    cache_items = []
+    for (owner, page_size, es_query_body), version, (page, total_count) in zip(requests, versions, msearch_pages(requests)):
+      if page is None:
+        counter['failed'] += 1
+        continue
+      cache_key = search_cache_key(es_query_body, page_size, int(version) if version is not None else 0)
+      ttl = SEARCH_CACHE_TTL if total_count > 0 else SEARCH_NEGATIVE_CACHE_TTL
+      cache_items.append((cache_key, compress_cache_value(page), ttl))
+    counter['warmed' if REDIS_CACHE.set_many(cache_items) else 'failed'] += len(cache_items)
+  return counter
+
+
+def warm_handler(event, context):
+  #XXX: invoked by the cache warming queue, which UpsertBizcardToES feeds with the owners of the indexed documents;
+  # the owners of all the messages in a batch are collapsed into one _msearch
+  owners = set()
+  for record in event['Records']:
+    owners.update(json.loads(record['body']).get('owners', []))
+  counter = warm_owner_pages(owners)
+  print('[INFO] cache warming: owners={}, {}'.format(len(owners),
+    ', '.join(['{}={}'.format(k, v) for k, v in sorted(counter.items())])), file=sys.stderr)
+  return dict(counter)
+
+
+def lambda_handler(event, context):
+  try:
+    if event.get('httpMethod') == 'POST':
+      body = event['body']
+      try:
+        if event.get('isBase64Encoded'):
+          body = base64.b64decode(body).decode('utf-8')
+        queries = json.loads(body)['queries']
+      except (ValueError, TypeError, KeyError):
+        raise BadRequest('the body must be a json object with queries')
+      hits_list = batch_search(queries, request_identity(event))
+      return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json; charset=utf-8'},
+        'body': '[{}]'.format(','.join(encode_response_hits(hits) for hits in hits_list)),
+        'isBase64Encoded': False
+      }
+
+    #XXX: queryStringParameters is null when there is no query string
+    query_params = event.get('queryStringParameters') or {}
+    identity = request_identity(event, query_params.get('user'))
+    SEARCH_HIT_LIMITER.acquire(identity)
+
+    if event.get('resource') == '/suggest':
+      hits, cursor = (suggest(query_params, identity), None)
+    elif query_params.get('cursor'):
+      SEARCH_MISS_LIMITER.acquire(identity)
+      hits, cursor = search_after_page(decode_cursor(query_params['cursor']))
+    else:
+      query_keywords, user_name, limit, fields = canonicalize_search_params(query_params)
+      if not (query_keywords or user_name):
+        raise BadRequest('query or user is required')
+
+      es_query_body = build_es_query_body(query_keywords, user_name, fields)
+      print('[DEBUG] elasticsearch query: {}'.format(json.dumps(es_query_body)))
+
+      page_size = max(limit, SEARCH_CACHE_PAGE_SIZE)
+      query_id = owner_search_cache_key(es_query_body, page_size, user_name)
+      print('[DEBUG] elasticsearch query id: {}'.format(query_id))
+
+      def _search():
+        #XXX: documents are routed by owner, so a search filtered by owner hits only one shard
+        search_params = {'preference': search_preference(es_query_body)}
+        if user_name:
+          search_params['routing'] = user_name
+        ret = ES_CLIENT.run(lambda es_client: es_client.search(index=ES_READ_ALIAS, body=es_query_body, size=page_size, **search_params))
+        total_count = int(ret['hits']['total']['value'])
+        print("[INFO] Got {} Hits:".format(total_count), file=sys.stderr)
+        return (dump_hits([project_hit(hit) for hit in ret['hits']['hits']]), total_count)
+
+      results = cached_search(query_id, throttled(identity, _search))
+      print('[DEBUG] {}, {}'.format(LOCAL_SEARCH_CACHE.stats_summary(), REDIS_CACHE.stats_summary()), file=sys.stderr)
+
+      hits = json.loads(results)[:limit]
+      cursor = next_cursor(query_keywords, user_name, limit, fields, hits)
 
     #XXX: https://aws.amazon.com/ko/premiumsupport/knowledge-center/malformed-502-api-gateway/
     response = {
       'statusCode': 200,
-      'body': results,
+      'headers': {'Content-Type': 'application/json; charset=utf-8'},
+      'body': encode_response_hits(hits),
       'isBase64Encoded': False
     }
+    #XXX: the continuation token of the next page; pass it as the cursor query parameter
+    if cursor:
+      response['headers']['X-Next-Cursor'] = cursor
     return response
+  except BadRequest as ex:
+    print('[WARN] bad request: {}'.format(ex), file=sys.stderr)
+    return {
+      'statusCode': 400,
+      'headers': {'Content-Type': 'application/json; charset=utf-8'},
+      'body': json.dumps({'message': str(ex)}),
+      'isBase64Encoded': False
+    }
+  except RateLimited as ex:
+    print('[WARN] {}'.format(ex), file=sys.stderr)
+    return {
+      'statusCode': 429,
+      'headers': {'Content-Type': 'application/json; charset=utf-8', 'Retry-After': str(ex.retry_after)},
+      'body': json.dumps({'message': 'Too Many Requests', 'retry_after_ms': ex.retry_after_ms}),
+      'isBase64Encoded': False
+    }
   except Exception as ex:
     traceback.print_exc()
 
@@ -162,6 +745,7 @@ if __name__ == '__main__':
   }
 
   query_params_list = [{"query": "sungmin", "user": "hyouk"},
+    {"query": "sungmin", "fields": "name,company,job_title"},
     {"query": "kim"}, {"user": "hyouk"}, {}]
 
   for params in query_params_list:
@@ -171,3 +755,18 @@ if __name__ == '__main__':
     res = lambda_handler(event, {})
     pprint.pprint(res)
 
+  event['httpMethod'] = 'POST'
+  event['queryStringParameters'] = event['multiValueQueryStringParameter'] = None
+  event['body'] = json.dumps({'queries': query_params_list[:-1]})
+  res = lambda_handler(event, {})
+  pprint.pprint(res)
+
+  event['httpMethod'] = 'GET'
+  event['resource'] = event['path'] = '/suggest'
+  for params in [{"prefix": "s", "user": "hyouk"}, {"prefix": "sung", "user": "hyouk"}]:
+    event['queryStringParameters'] = params
+    event['multiValueQueryStringParameter'] = {k: [v] for k, v in params.items()}
+
+    res = lambda_handler(event, {})
+    pprint.pprint(res)
+
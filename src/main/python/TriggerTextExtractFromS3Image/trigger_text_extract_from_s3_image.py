@@ -11,40 +11,25 @@ import datetime
 
 import boto3
 
+from octember_connections import LazyConnection
+from octember_kinesis import write_records_to_kinesis
+
 DRY_RUN = (os.getenv('DRY_RUN', 'false') == 'true')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 KINESIS_STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'octember-bizcard-img')
 DDB_TABLE_NAME = os.getenv('DDB_TABLE_NAME', 'OctemberBizcardImg')
 
+#XXX: images whose ETag has already been processed are re-emitted into the text stream without OCR
+DEDUP_ENABLED = (os.getenv('DEDUP_ENABLED', 'true') == 'true')
+DDB_ETAG_INDEX_NAME = os.getenv('DDB_ETAG_INDEX_NAME', 's3_etag-index')
+TEXT_KINESIS_STREAM_NAME = os.getenv('TEXT_KINESIS_STREAM_NAME', 'octember-bizcard-txt')
 
-def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records):
-  import random
-  random.seed(47)
+KINESIS_PARTITION_KEY_STRATEGY = os.getenv('KINESIS_PARTITION_KEY_STRATEGY', 'spread')
 
-  def gen_records():
-    record_list = []
-    for rec in records:
-      payload = json.dumps(rec, ensure_ascii=False)
-      partition_key = 'part-{:05}'.format(random.randint(1, 1024))
-      record_list.append({'Data': payload, 'PartitionKey': partition_key})
-    return record_list
-
-  MAX_RETRY_COUNT = 3
- 
-  record_list = gen_records()
-  for _ in range(MAX_RETRY_COUNT):
-    try:
-      response = kinesis_client.put_records(Records=record_list, StreamName=kinesis_stream_name)
-      print("[DEBUG]", response, file=sys.stderr)
-      break
-    except Exception as ex:
-      import time
-
-      traceback.print_exc()
-      time.sleep(2)
-  else:
-    raise RuntimeError('[ERROR] Failed to put_records into kinesis stream: {}'.format(kinesis_stream_name))
+KINESIS_CLIENT = LazyConnection('kinesis', lambda: boto3.client('kinesis', region_name=AWS_REGION))
+DDB_CLIENT = LazyConnection('dynamodb', lambda: boto3.client('dynamodb', region_name=AWS_REGION))
+S3_CLIENT = LazyConnection('s3', lambda: boto3.client('s3', region_name=AWS_REGION))
 
 
 def update_process_status(ddb_client, table_name, item):
@@ -55,6 +40,29 @@ def update_process_status(ddb_client, table_name, item):
     status = item['status']
     modified_time = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
 
+    update_expression = "SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status"
+    expression_attribute_values = {
+      ":s3_bucket": {
+        "S": s3_bucket
+      },
+      ":s3_key": {
+        "S":  s3_key
+      },
+      ":mts": {
+        "N": "{}".format(modified_time)
+      },
+      ":status": {
+        "S": status
+      }
+    }
+
+    #XXX: s3_etag is the partition key of the sparse ETag index used to find duplicate images,
+    # and text_data keeps the extracted document so that duplicates can be re-emitted without OCR
+    for attr_name in ('s3_etag', 'text_data'):
+      if item.get(attr_name):
+        update_expression += ", {attr_name} = :{attr_name}".format(attr_name=attr_name)
+        expression_attribute_values[":{}".format(attr_name)] = {"S": item[attr_name]}
+
     response = ddb_client.update_item(
       TableName=table_name,
       Key={
@@ -62,24 +70,11 @@ def update_process_status(ddb_client, table_name, item):
           "S": image_id
         }
       },
-      UpdateExpression="SET s3_bucket = :s3_bucket, s3_key = :s3_key, mts = :mts, #status = :status",
+      UpdateExpression=update_expression,
       ExpressionAttributeNames={
         '#status': 'status'
       },
-      ExpressionAttributeValues={
-        ":s3_bucket": {
-          "S": s3_bucket
-        },
-        ":s3_key": {
-          "S":  s3_key
-        },
-        ":mts": {
-          "N": "{}".format(modified_time)
-        },
-        ":status": {
-          "S": status
-        }
-      }
+      ExpressionAttributeValues=expression_attribute_values
     )
     return response
 
@@ -92,22 +87,121 @@ def update_process_status(ddb_client, table_name, item):
     raise ex
 
 
+def find_processed_image(ddb_client, table_name, index_name, etag):
+  response = ddb_client.query(
+    TableName=table_name,
+    IndexName=index_name,
+    KeyConditionExpression="s3_etag = :s3_etag",
+    FilterExpression="#status = :status",
+    ExpressionAttributeNames={
+      '#status': 'status'
+    },
+    ExpressionAttributeValues={
+      ":s3_etag": {
+        "S": etag
+      },
+      ":status": {
+        "S": "END"
+      }
+    }
+  )
+  for item in response['Items']:
+    if 'text_data' in item:
+      return {'image_id': item['image_id']['S'], 'data': json.loads(item['text_data']['S'])}
+  return None
+
+
+def copy_bizcard_to_user_photo_album(s3_client, params):
+  src_bucket, src_key, owner = params['s3_bucket'], params['s3_key'], params['owner']
+  copy_source = {
+    'Bucket': src_bucket,
+    'Key': src_key
+  }
+
+  image_id = os.path.basename(src_key)
+  dest_s3_bucket = src_bucket
+  dest_s3_key = 'bizcard-by-user/{owner}/{image_id}'.format(owner=owner, image_id=image_id)
+  s3_client.copy_object(CopySource=copy_source, Bucket=dest_s3_bucket, Key=dest_s3_key)
+  return {'s3_bucket': dest_s3_bucket, 's3_key': dest_s3_key, 'owner': owner}
+
+
 def lambda_handler(event, context):
-  kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
-  ddb_client = boto3.client('dynamodb', region_name=AWS_REGION)
+  import collections
+
+  kinesis_client = KINESIS_CLIENT.get()
+  ddb_client = DDB_CLIENT.get()
 
+  counter = collections.OrderedDict([('reads', 0),
+      ('writes', 0), ('duplicates', 0), ('errors', 0)])
+
+  s3_objects, duplicates = [], []
   for record in event['Records']:
     try:
+      counter['reads'] += 1
       bucket = record['s3']['bucket']['name']
       key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+      etag = record['s3']['object'].get('eTag')
 
       record = {'s3_bucket': bucket, 's3_key': key}
+      if etag:
+        record['s3_etag'] = etag
       print("[INFO] object created: ", record, file=sys.stderr)
-      write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, [record])
-      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': bucket, 's3_key': key, 'status': 'START'})
+
+      processed_image = None
+      if DEDUP_ENABLED and etag:
+        try:
+          processed_image = find_processed_image(ddb_client, DDB_TABLE_NAME, DDB_ETAG_INDEX_NAME, etag)
+        except Exception as ex:
+          traceback.print_exc()
+
+      if processed_image:
+        print("[INFO] duplicate of {}: {}".format(processed_image['image_id'], record), file=sys.stderr)
+        doc = processed_image['data']
+        doc['created_at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        owner = os.path.basename(key).split('_')[0]
+        duplicates.append(dict(record, owner=owner, data=doc))
+      else:
+        s3_objects.append(record)
+    except Exception as ex:
+      counter['errors'] += 1
+      traceback.print_exc()
+
+  outcomes = write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, s3_objects,
+    partition_key_strategy=KINESIS_PARTITION_KEY_STRATEGY) if s3_objects else []
+  for record, outcome in zip(s3_objects, outcomes):
+    if not outcome['ok']:
+      counter['errors'] += 1
+      print('[ERROR] Failed to put record: {}, {}'.format(record, outcome), file=sys.stderr)
+      continue
+
+    try:
+      update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': record['s3_bucket'], 's3_key': record['s3_key'], 'status': 'START'})
+      counter['writes'] += 1
     except Exception as ex:
+      counter['errors'] += 1
       traceback.print_exc()
 
+  if duplicates:
+    s3_client = S3_CLIENT.get()
+    dup_outcomes = write_records_to_kinesis(kinesis_client, TEXT_KINESIS_STREAM_NAME, duplicates,
+      partition_key_strategy=KINESIS_PARTITION_KEY_STRATEGY)
+    for text_data, outcome in zip(duplicates, dup_outcomes):
+      if not outcome['ok']:
+        counter['errors'] += 1
+        print('[ERROR] Failed to put record: {}, {}'.format(text_data, outcome), file=sys.stderr)
+        continue
+
+      try:
+        ret = copy_bizcard_to_user_photo_album(s3_client, text_data)
+        update_process_status(ddb_client, DDB_TABLE_NAME, {'s3_bucket': ret['s3_bucket'], 's3_key': ret['s3_key'], 'status': 'END',
+          's3_etag': text_data['s3_etag'], 'text_data': json.dumps(text_data['data'], ensure_ascii=False)})
+        counter['duplicates'] += 1
+      except Exception as ex:
+        counter['errors'] += 1
+        traceback.print_exc()
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+  return outcomes
+
 
 if __name__ == '__main__':
   s3_event = '''{
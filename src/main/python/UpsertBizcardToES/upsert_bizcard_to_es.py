@@ -8,52 +8,174 @@ import os
 import base64
 import traceback
 import hashlib
+import collections
+import random
+import re
+import time
 
 import boto3
 from elasticsearch import Elasticsearch
 from elasticsearch import RequestsHttpConnection
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, AuthorizationException, TransportError
 from requests_aws4auth import AWS4Auth
+import redis
 
-ES_INDEX, ES_TYPE = (os.getenv('ES_INDEX', 'octember_bizcard'), os.getenv('ES_TYPE', 'bizcard'))
+from octember_connections import LazyConnection
+
+ES_INDEX = os.getenv('ES_INDEX', 'octember_bizcard')
+#XXX: documents are written through the write alias, so the index behind it can be rolled over or reindexed
+ES_WRITE_ALIAS = os.getenv('ES_WRITE_ALIAS', '{}-write'.format(ES_INDEX))
 ES_HOST = os.getenv('ES_HOST')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 
-session = boto3.Session(region_name=AWS_REGION)
-credentials = session.get_credentials()
-credentials = credentials.get_frozen_credentials()
-access_key = credentials.access_key
-secret_key = credentials.secret_key
-token = credentials.token
+#XXX: the default http.max_content_length of Amazon Elasticsearch Service is 10 MB
+ES_BULK_MAX_ACTIONS = int(os.getenv('ES_BULK_MAX_ACTIONS', '500'))
+ES_BULK_MAX_BYTES = int(os.getenv('ES_BULK_MAX_BYTES', '{}'.format(5 * 1024 * 1024)))
+ES_BULK_MAX_RETRY_COUNT = int(os.getenv('ES_BULK_MAX_RETRY_COUNT', '3'))
+#XXX: a bulk request with refresh=wait_for is held until the next refresh, so it is bounded by a request timeout
+# well below the lambda timeout; the default timeout of the client (10s) is shorter than a usual refresh interval
+ES_BULK_REQUEST_TIMEOUT = int(os.getenv('ES_BULK_REQUEST_TIMEOUT', '60'))
+
+#XXX: refresh policy of the bulk requests
+# - false: do not refresh (documents become searchable after the index refresh_interval);
+#   the bulk requests still wait_for the refresh when the owner versions of the search cache are bumped,
+#   unless the refresh interval of the write index is -1 or too long to wait for (see lambda_handler)
+# - wait_for: wait until the documents become searchable without forcing a refresh
+# - true: force a refresh (expensive; it makes a new segment on every bulk request)
+# - a time value such as 30s: set the index refresh_interval once, and then the same as false
+ES_REFRESH_POLICY = os.getenv('ES_REFRESH_POLICY', 'false').lower()
+
+ES_REFRESH_INTERVAL_RE = re.compile(r'^-1$|^\d+(ms|s|m|h)$')
+#XXX: the refresh interval of the index behind the write alias can be changed outside this function
+# (ex: a reindex or a bulk load), so it is re-read at most every REFRESH_INTERVAL_CHECK_INTERVAL seconds
+REFRESH_INTERVAL_CHECK_INTERVAL = int(os.getenv('REFRESH_INTERVAL_CHECK_INTERVAL', '60'))
+
+#XXX: the bulk items rejected because the write thread pool queue of the cluster is full, which can be retried
+ES_RETRYABLE_STATUS_CODES = (429,)
+ES_RETRYABLE_ERROR_TYPES = ('es_rejected_execution_exception',)
+
+#XXX: change detection - documents whose content hash is the same as the last indexed one are not sent to ES,
+# so that replays of the text stream and backfills cost (almost) nothing on the ES side
+SKIP_UNCHANGED_ENABLED = (os.getenv('SKIP_UNCHANGED_ENABLED', 'true').lower() == 'true')
+CONTENT_HASH_TTL = int(os.getenv('CONTENT_HASH_TTL', '{}'.format(7*24*60*60)))
+CONTENT_HASH_LRU_SIZE = int(os.getenv('CONTENT_HASH_LRU_SIZE', '10000'))
+#XXX: fields that change on every emission of the same document (ex: re-parsed OCR results)
+CONTENT_HASH_EXCLUDED_FIELDS = ('created_at',)
+
+#XXX: the doc_id -> content hash map is kept in the search query cache (ElastiCache Redis),
+# and an in-container LRU in front of it absorbs the repeated lookups of a warm container
+ELASTICACHE_HOST = os.getenv('ELASTICACHE_HOST')
+REDIS_CLIENT = LazyConnection('redis',
+  lambda: redis.Redis(host=ELASTICACHE_HOST, port=6379, db=0, socket_timeout=1),
+  close=lambda redis_client: redis_client.connection_pool.disconnect(),
+  reconnect_on=(redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)) if ELASTICACHE_HOST else None
+
+_CONTENT_HASH_LRU = collections.OrderedDict()
 
-aws_auth = AWS4Auth(
+#XXX: the cache keys of SearchBizcard embed these versions, so incrementing them invalidates the cached search results
+OWNER_VERSION_KEY_FORMAT = 'es:owner_version:{}'
+ALL_OWNERS = '__all__'
+
+#XXX: the owners of the indexed documents are sent to the cache warming queue, and the warmer (SearchBizcard)
+# stores their owner-only search result pages under the new owner versions, so "my cards" is always a cache hit;
+# the message is delayed until the new documents are searchable (see cache_warm_delay_seconds)
+CACHE_WARM_QUEUE_URL = os.getenv('CACHE_WARM_QUEUE_URL')
+CACHE_WARM_MAX_OWNERS_PER_MESSAGE = 500
+#XXX: the default index refresh_interval of elasticsearch, and the max DelaySeconds of SQS
+ES_DEFAULT_REFRESH_INTERVAL_SECONDS = 1
+SQS_MAX_DELAY_SECONDS = 15*60
+SQS_CLIENT = LazyConnection('sqs', lambda: boto3.client('sqs', region_name=AWS_REGION)) if CACHE_WARM_QUEUE_URL else None
+
+
+def es_connect():
+  session = boto3.Session(region_name=AWS_REGION)
+  credentials = session.get_credentials()
+  credentials = credentials.get_frozen_credentials()
+  access_key = credentials.access_key
+  secret_key = credentials.secret_key
+  token = credentials.token
+
+  aws_auth = AWS4Auth(
     access_key,
     secret_key,
     AWS_REGION,
     'es',
     session_token=token
-)
+  )
 
-es_client = Elasticsearch(
+  es_client = Elasticsearch(
     hosts = [{'host': ES_HOST, 'port': 443}],
     http_auth=aws_auth,
     use_ssl=True,
     verify_certs=True,
     connection_class=RequestsHttpConnection
-)
-print('[INFO] ElasticSearch Service', json.dumps(es_client.info(), indent=2), file=sys.stderr)
+  )
+  print('[INFO] ElasticSearch Service: {}'.format(ES_HOST), file=sys.stderr)
+  return es_client
 
 
-def lambda_handler(event, context):
-  import collections
+#XXX: the es client signs requests with the frozen credentials of the lambda role,
+# so it is re-created before the credentials expire
+ES_CLIENT = LazyConnection('elasticsearch', es_connect,
+  close=lambda es_client: es_client.transport.close(),
+  max_age=30*60,
+  reconnect_on=(ESConnectionError, AuthorizationException))
 
-  counter = collections.OrderedDict([('reads', 0),
-      ('writes', 0),
-      ('invalid', 0),
-      ('errors', 0)])
 
-  doc_list = []
-  for record in event['Records']:
+_REFRESH_INTERVAL_APPLIED = False
+_WRITE_INDEX_REFRESH_INTERVAL = {'value': None, 'checked_at': 0}
+
+
+def bulk_refresh_param(es_client, index_name, refresh_policy=ES_REFRESH_POLICY):
+  global _REFRESH_INTERVAL_APPLIED
+
+  if refresh_policy in ('true', 'false', 'wait_for'):
+    return refresh_policy
+
+  if not ES_REFRESH_INTERVAL_RE.match(refresh_policy):
+    print('[WARN] Unknown refresh policy: {}, so no refresh'.format(refresh_policy), file=sys.stderr)
+    return 'false'
+
+  #XXX: the refresh interval is an index setting, so it is applied once per container
+  if not _REFRESH_INTERVAL_APPLIED:
+    es_client.indices.put_settings(index=index_name, body={"index": {"refresh_interval": refresh_policy}})
+    _REFRESH_INTERVAL_APPLIED = True
+    print('[INFO] index={}, refresh_interval={}'.format(index_name, refresh_policy), file=sys.stderr)
+  return 'false'
+
+
+def refresh_interval_seconds(refresh_interval):
+  #XXX: None for -1 (no scheduled refresh)
+  m = ES_REFRESH_INTERVAL_RE.match(refresh_interval or '')
+  if not m:
+    return ES_DEFAULT_REFRESH_INTERVAL_SECONDS
+  if refresh_interval == '-1':
+    return None
+  unit_seconds = {'ms': 0.001, 's': 1, 'm': 60, 'h': 60*60}[m.group(1)]
+  return int(refresh_interval[:-len(m.group(1))]) * unit_seconds
+
+
+def write_index_refresh_interval(es_client, index_name, check_interval=REFRESH_INTERVAL_CHECK_INTERVAL):
+  now = time.time()
+  if now - _WRITE_INDEX_REFRESH_INTERVAL['checked_at'] < check_interval:
+    return _WRITE_INDEX_REFRESH_INTERVAL['value']
+
+  res = es_client.indices.get_settings(index=index_name, name='index.refresh_interval', include_defaults=True)
+  refresh_intervals = []
+  for settings in res.values():
+    refresh_intervals.append(settings.get('settings', {}).get('index', {}).get('refresh_interval') or
+      settings.get('defaults', {}).get('index', {}).get('refresh_interval'))
+
+  #XXX: the slowest one, if several indices are behind the alias
+  refresh_interval = '-1' if '-1' in refresh_intervals else \
+    max(refresh_intervals, key=refresh_interval_seconds, default=None)
+  _WRITE_INDEX_REFRESH_INTERVAL.update(value=refresh_interval, checked_at=now)
+  return refresh_interval
+
+
+def gen_bulk_actions(records, counter):
+  for record in records:
     try:
       counter['reads'] += 1
       payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
@@ -74,24 +196,281 @@ def lambda_handler(event, context):
       content_id = ':'.join('{}'.format(doc.get(k, '').lower()) for k in ('name', 'email', 'phone_number'))
       doc['content_id'] = hashlib.md5(content_id.encode('utf-8')).hexdigest()[:8]
 
-      es_index_action_meta = {"index": {"_index": ES_INDEX, "_type": ES_TYPE, "_id": doc['doc_id']}}
-      doc_list.append(es_index_action_meta)
-      doc_list.append(doc)
-
-      counter['writes'] += 1
+      #XXX: documents are routed by owner (see the index template of BootstrapBizcardES),
+      # and the mapping types are removed in elasticsearch 7
+      es_index_action_meta = {"index": {"_index": ES_WRITE_ALIAS, "_id": doc['doc_id'], "routing": doc['owner']}}
+      yield (es_index_action_meta, doc)
     except Exception as ex:
       counter['errors'] += 1
       traceback.print_exc()
 
-  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+
+def doc_content_hash(doc):
+  content = {k: v for k, v in doc.items() if k not in CONTENT_HASH_EXCLUDED_FIELDS}
+  return hashlib.md5(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _content_hash_key(doc_id):
+  return 'es:content_hash:{}'.format(doc_id)
+
+
+def _lru_put_content_hash(doc_id, content_hash):
+  _CONTENT_HASH_LRU[doc_id] = content_hash
+  _CONTENT_HASH_LRU.move_to_end(doc_id)
+  while len(_CONTENT_HASH_LRU) > CONTENT_HASH_LRU_SIZE:
+    _CONTENT_HASH_LRU.popitem(last=False)
+
+
+def lookup_content_hashes(doc_ids):
+  content_hashes, misses = {}, []
+  for doc_id in doc_ids:
+    if doc_id in _CONTENT_HASH_LRU:
+      _CONTENT_HASH_LRU.move_to_end(doc_id)
+      content_hashes[doc_id] = _CONTENT_HASH_LRU[doc_id]
+    else:
+      misses.append(doc_id)
+
+  if misses and REDIS_CLIENT is not None:
+    #XXX: fail open - if the cache is unavailable, the documents are just indexed
+    try:
+      values = REDIS_CLIENT.run(lambda redis_client: redis_client.mget([_content_hash_key(e) for e in misses]))
+      for doc_id, value in zip(misses, values):
+        if value is not None:
+          content_hashes[doc_id] = value.decode('utf-8')
+          _lru_put_content_hash(doc_id, content_hashes[doc_id])
+    except Exception as ex:
+      traceback.print_exc()
+  return content_hashes
+
+
+def save_content_hashes(content_hashes):
+  if not content_hashes:
+    return
+
+  for doc_id, content_hash in content_hashes.items():
+    _lru_put_content_hash(doc_id, content_hash)
+
+  if REDIS_CLIENT is None:
+    return
+
+  def _save(redis_client):
+    pipeline = redis_client.pipeline(transaction=False)
+    for doc_id, content_hash in content_hashes.items():
+      pipeline.set(_content_hash_key(doc_id), content_hash, ex=CONTENT_HASH_TTL)
+    return pipeline.execute()
 
   try:
-    es_bulk_body = '\n'.join([json.dumps(e) for e in doc_list])
-    res = es_client.bulk(body=es_bulk_body, index=ES_INDEX, refresh=True)
+    REDIS_CLIENT.run(_save)
   except Exception as ex:
     traceback.print_exc()
 
 
+def bump_owner_versions(owners):
+  if not owners or REDIS_CLIENT is None:
+    return
+
+  def _bump(redis_client):
+    pipeline = redis_client.pipeline(transaction=False)
+    for owner in sorted(owners) + [ALL_OWNERS]:
+      pipeline.incr(OWNER_VERSION_KEY_FORMAT.format(owner))
+    return pipeline.execute()
+
+  try:
+    REDIS_CLIENT.run(_bump)
+  except Exception as ex:
+    traceback.print_exc()
+
+
+def cache_warm_delay_seconds(refresh, refresh_interval=None):
+  #XXX: wait_for and true return after the documents are searchable, otherwise they are searchable
+  # within the refresh interval (None with refresh_interval -1, where they are not searchable until a refresh)
+  if refresh in ('true', 'wait_for'):
+    return 0
+  interval = refresh_interval_seconds(refresh_interval)
+  if interval is None:
+    return None
+  return min(SQS_MAX_DELAY_SECONDS, int(-(-interval // 1)))
+
+
+def enqueue_cache_warming(owners, delay_seconds=0):
+  if not owners or SQS_CLIENT is None or delay_seconds is None:
+    return
+
+  owners = sorted(owners)
+  try:
+    for i in range(0, len(owners), CACHE_WARM_MAX_OWNERS_PER_MESSAGE):
+      message = json.dumps({'owners': owners[i:i + CACHE_WARM_MAX_OWNERS_PER_MESSAGE]}, ensure_ascii=False)
+      SQS_CLIENT.run(lambda sqs_client: sqs_client.send_message(QueueUrl=CACHE_WARM_QUEUE_URL,
+        MessageBody=message, DelaySeconds=delay_seconds))
+  except Exception as ex:
+    traceback.print_exc()
+
+
+def skip_unchanged_actions(actions, counter, indexed_content_hashes, batch_size=ES_BULK_MAX_ACTIONS):
+  def _flush(batch):
+    last_content_hashes = lookup_content_hashes([action_meta['index']['_id'] for action_meta, _ in batch])
+    for action_meta, doc in batch:
+      doc_id = action_meta['index']['_id']
+      content_hash = doc_content_hash(doc)
+      if last_content_hashes.get(doc_id) == content_hash:
+        counter['unchanged'] += 1
+        continue
+      indexed_content_hashes[doc_id] = content_hash
+      yield (action_meta, doc)
+
+  batch = []
+  for action in actions:
+    batch.append(action)
+    if len(batch) >= batch_size:
+      yield from _flush(batch)
+      batch = []
+  if batch:
+    yield from _flush(batch)
+
+
+def _chunk_bulk_actions(actions, max_count=ES_BULK_MAX_ACTIONS, max_bytes=ES_BULK_MAX_BYTES):
+  #XXX: a bulk request is split by both the number of actions and the size of the request body,
+  # so the whole kinesis batch is never materialized as a single giant body
+  chunk, chunk_bytes = [], 0
+  for action_meta, doc in actions:
+    action_lines = '{}\n{}\n'.format(json.dumps(action_meta), json.dumps(doc, ensure_ascii=False))
+    action_size = len(action_lines.encode('utf-8'))
+    if chunk and (len(chunk) >= max_count or chunk_bytes + action_size > max_bytes):
+      yield chunk
+      chunk, chunk_bytes = [], 0
+    chunk.append(action_lines)
+    chunk_bytes += action_size
+  if chunk:
+    yield chunk
+
+
+def _is_retryable_bulk_item(item):
+  if item.get('status') in ES_RETRYABLE_STATUS_CODES:
+    return True
+  error = item.get('error') or {}
+  return isinstance(error, dict) and error.get('type') in ES_RETRYABLE_ERROR_TYPES
+
+
+def streaming_bulk_index(es_conn, actions, refresh='false', on_indexed=None,
+    max_retry_count=ES_BULK_MAX_RETRY_COUNT, base_backoff=0.2, max_backoff=5.0):
+  outcomes = collections.Counter()
+  for chunk in _chunk_bulk_actions(actions):
+    pending = chunk
+    for attempt in range(max_retry_count + 1):
+      es_bulk_body = ''.join(pending)
+      try:
+        res = es_conn.run(lambda es_client: es_client.bulk(body=es_bulk_body, index=ES_WRITE_ALIAS, refresh=refresh,
+          request_timeout=ES_BULK_REQUEST_TIMEOUT))
+      except TransportError as ex:
+        if ex.status_code not in ES_RETRYABLE_STATUS_CODES:
+          traceback.print_exc()
+          outcomes['failed'] += len(pending)
+          pending = []
+        else:
+          print('[WARN] bulk request rejected: status={}'.format(ex.status_code), file=sys.stderr)
+      except Exception as ex:
+        traceback.print_exc()
+        outcomes['failed'] += len(pending)
+        pending = []
+      else:
+        #XXX: bulk items are returned in the same order as the actions
+        failed, indexed = [], []
+        for action_lines, res_item in zip(pending, res['items']):
+          op_type, item = next(iter(res_item.items()))
+          if 'error' not in item:
+            outcomes[item.get('result', op_type)] += 1
+            indexed.append(item.get('_id'))
+          elif _is_retryable_bulk_item(item):
+            failed.append(action_lines)
+          else:
+            outcomes['failed'] += 1
+            print('[ERROR] bulk {}: _id={}, status={}, error={}'.format(op_type, item.get('_id'),
+              item.get('status'), json.dumps(item['error'])), file=sys.stderr)
+        pending = failed
+
+        if indexed and on_indexed is not None:
+          on_indexed(indexed)
+
+      if not pending:
+        break
+
+      if attempt < max_retry_count:
+        #XXX: exponential backoff with full jitter - only the rejected items are resent
+        outcomes['retried'] += len(pending)
+        time.sleep(random.uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+    if pending:
+      outcomes['rejected'] += len(pending)
+      print('[ERROR] Failed to index {} documents after {} retries'.format(len(pending), max_retry_count), file=sys.stderr)
+  return outcomes
+
+
+def lambda_handler(event, context):
+  counter = collections.OrderedDict([('reads', 0),
+      ('writes', 0),
+      ('invalid', 0),
+      ('unchanged', 0),
+      ('errors', 0)])
+
+  try:
+    refresh = ES_CLIENT.run(lambda es_client: bulk_refresh_param(es_client, ES_WRITE_ALIAS))
+  except Exception as ex:
+    traceback.print_exc()
+    refresh = 'false'
+
+  try:
+    refresh_interval = ES_CLIENT.run(lambda es_client: write_index_refresh_interval(es_client, ES_WRITE_ALIAS))
+  except Exception as ex:
+    traceback.print_exc()
+    refresh_interval = None
+
+  #XXX: the owner versions are bumped right after the bulk requests return, so the bulk requests wait until the
+  # documents are searchable; otherwise a search between the bump and the next refresh caches the stale results
+  # under the new versions. wait_for does not force a refresh, it only holds the response until the scheduled one.
+  # With refresh_interval -1 (or an interval longer than the request timeout allows) the refresh can not be waited
+  # for, so the owner versions are not bumped rather than bumped before the documents are searchable.
+  interval = refresh_interval_seconds(refresh_interval)
+  can_wait_for_refresh = interval is not None and interval * 2 <= ES_BULK_REQUEST_TIMEOUT
+  if refresh == 'wait_for' and not can_wait_for_refresh:
+    refresh = 'false'
+  elif refresh == 'false' and REDIS_CLIENT is not None and can_wait_for_refresh:
+    refresh = 'wait_for'
+  bump_versions = refresh in ('true', 'wait_for')
+
+  actions = gen_bulk_actions(event['Records'], counter)
+
+  indexed_content_hashes = {}
+  if SKIP_UNCHANGED_ENABLED:
+    actions = skip_unchanged_actions(actions, counter, indexed_content_hashes)
+
+  doc_owners, indexed_owners = {}, set()
+
+  def _track_owners(actions):
+    for action_meta, doc in actions:
+      doc_owners[action_meta['index']['_id']] = doc['owner']
+      yield (action_meta, doc)
+
+  def _on_indexed(doc_ids):
+    #XXX: the content hash of a document is saved only after it is indexed successfully
+    save_content_hashes({e: indexed_content_hashes[e] for e in doc_ids if e in indexed_content_hashes})
+    indexed_owners.update(doc_owners[e] for e in doc_ids if e in doc_owners)
+
+  outcomes = streaming_bulk_index(ES_CLIENT, _track_owners(actions), refresh=refresh, on_indexed=_on_indexed)
+
+  if bump_versions:
+    bump_owner_versions(indexed_owners)
+    enqueue_cache_warming(indexed_owners, cache_warm_delay_seconds(refresh, refresh_interval))
+  elif indexed_owners:
+    print('[WARN] refresh={}, refresh_interval={}, so the owner versions are not bumped'.format(refresh,
+      refresh_interval), file=sys.stderr)
+  counter['writes'] = sum(v for k, v in outcomes.items() if k not in ('retried', 'failed', 'rejected'))
+
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+  print('[INFO] bulk', ', '.join(['{}={}'.format(k, v) for k, v in sorted(outcomes.items())]), file=sys.stderr)
+  #XXX: the records failed to parse are returned too, so callers (ex: BackfillBizcardText) can tell they are not indexed
+  return dict(outcomes, errors=counter['errors'])
+
+
 if __name__ == '__main__':
   kinesis_data = [
     '''{"s3_bucket": "octember-use1", "s3_key": "bizcard-raw-img/edy_bizcard_0046.jpg", "owner": "edy", "data": {"addr": "1 2Floor GS Tower, 508 Nonhyeon-ro, Gangnam-gu, Seoul 06141, Korea", "email": "edy@amazon.com", "phone_number": "(+82 10) 1025 7049", "company": "aws", "name": "Edy Kim", "job_title": "Specialist Solutions Architect", "created_at": "2019-10-25T01:12:54Z"}}''',
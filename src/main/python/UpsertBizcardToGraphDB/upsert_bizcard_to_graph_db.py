@@ -17,6 +17,12 @@ from gremlin_python.process.strategies import *
 from gremlin_python.process.traversal import T, P, Operator
 from gremlin_python.process.anonymous_traversal import traversal
 from gremlin_python.driver.driver_remote_connection import DriverRemoteConnection
+from tornado.httpclient import HTTPError
+from tornado.websocket import WebSocketClosedError
+from tornado.iostream import StreamClosedError
+from tornado.gen import TimeoutError as TornadoTimeoutError
+
+from octember_connections import LazyConnection, close_all
 
 random.seed(47)
 
@@ -25,30 +31,42 @@ NEPTUNE_ENDPOINT = os.getenv('NEPTUNE_ENDPOINT')
 NEPTUNE_PORT = int(os.getenv('NEPTUNE_PORT', '8182'))
 
 
-def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
-  def _remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
-    neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='ws',
-      neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
-
-    if show_endpoint:
-      print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
-    retry_count = 0
-    while True:
-      try:
-        return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
-      except HTTPError as ex:
-        exc_info = sys.exc_info()
-        if retry_count < 3:
-          retry_count += 1
-          print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
-        else:
-          raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
+def remote_connection(neptune_endpoint=None, neptune_port=None, show_endpoint=True):
+  neptune_gremlin_endpoint = '{protocol}://{neptune_endpoint}:{neptune_port}/{suffix}'.format(protocol='ws',
+    neptune_endpoint=neptune_endpoint, neptune_port=neptune_port, suffix='gremlin')
+
+  if show_endpoint:
+    print('[INFO] gremlin: {}'.format(neptune_gremlin_endpoint), file=sys.stderr)
+  retry_count = 0
+  while True:
+    try:
+      return DriverRemoteConnection(neptune_gremlin_endpoint, 'g')
+    except HTTPError as ex:
+      exc_info = sys.exc_info()
+      if retry_count < 3:
+        retry_count += 1
+        print('[DEBUG] Connection timeout. Retrying...', file=sys.stderr)
+      else:
+        raise exc_info[0].with_traceback(exc_info[1], exc_info[2])
+
 
+def graph_traversal(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, show_endpoint=True, connection=None):
   if connection is None:
-    connection = _remote_connection(neptune_endpoint, neptune_port, show_endpoint)
+    connection = remote_connection(neptune_endpoint, neptune_port, show_endpoint)
   return traversal().withRemote(connection)
 
 
+#XXX: one websocket connection per container; it is checked at most once a minute,
+# re-opened when the check fails or a traversal fails on the transport, and closed by close();
+# a traversal that fails on the server (ex: GremlinServerError) is not retried on a new connection
+NEPTUNE_CONN = LazyConnection('neptune',
+  lambda: remote_connection(NEPTUNE_ENDPOINT, NEPTUNE_PORT),
+  close=lambda conn: conn.close(),
+  health_check=lambda conn: graph_traversal(connection=conn).V().limit(1).count().next() is not None,
+  health_check_interval=60,
+  reconnect_on=(HTTPError, WebSocketClosedError, StreamClosedError, TornadoTimeoutError, OSError))
+
+
 def clear_graph(neptune_endpoint=None, neptune_port=NEPTUNE_PORT, batch_size=200, edge_batch_size=None, vertex_batch_size=None):
   if edge_batch_size is None:
     edge_batch_size = batch_size
@@ -128,9 +146,6 @@ def lambda_handler(event, context):
       ('invalid', 0),
       ('errors', 0)])
 
-  neptune_endpoint, neptune_port = (NEPTUNE_ENDPOINT, NEPTUNE_PORT)
-  graph_db = graph_traversal(neptune_endpoint, neptune_port)
-
   for record in event['Records']:
     try:
       counter['reads'] += 1
@@ -152,13 +167,16 @@ def lambda_handler(event, context):
         "owner": json_data['owner']
       }
       #print(json.dumps(person, indent=2))
-      upsert_person(graph_db, person)
+      NEPTUNE_CONN.run(lambda conn: upsert_person(graph_traversal(connection=conn), person))
 
       counter['writes'] += 1
     except Exception as _:
       counter['errors'] += 1
       traceback.print_exc()
 
+  print('[INFO]', ', '.join(['{}={}'.format(k, v) for k, v in counter.items()]), file=sys.stderr)
+  return counter
+
 
 if __name__ == '__main__':
   # pylint: disable=invalid-name
@@ -197,4 +215,4 @@ if __name__ == '__main__':
     } for e in kinesis_data]
   event = {"Records": records}
   lambda_handler(event, {})
-
+  close_all()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: each lambda function is a directory of top-level modules, and the common modules are deployed as a layer,
+# so their directories are put on sys.path the same way the lambda runtime does
+
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'main', 'python')
+
+for module_dir in ('OctemberCommonLib/python', 'GetTextFromS3Image', 'TriggerTextExtractFromS3Image',
+    'BootstrapBizcardES', 'UpsertBizcardToES', 'BackfillBizcardText', 'SearchBizcard'):
+  sys.path.insert(0, os.path.join(SRC_DIR, module_dir))
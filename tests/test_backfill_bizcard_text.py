@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import itertools
+import threading
+
+import pytest
+
+import backfill_bizcard_text as m
+
+
+def read_ahead_threads():
+  return [e for e in threading.enumerate() if e.name == 'read-ahead' and e.is_alive()]
+
+
+def test_reader_thread_stops_when_the_consumer_stops_early():
+  #XXX: an endless source keeps the queue full, so the reader is blocked on put when the consumer stops
+  records = m.read_ahead(itertools.count(), max_size=2, put_timeout=0.01)
+  assert [next(records) for _ in range(3)] == [0, 1, 2]
+  records.close()
+  assert read_ahead_threads() == []
+
+
+def test_reader_thread_stops_when_the_consumer_fails():
+  def _consume():
+    for record in m.read_ahead(itertools.count(), max_size=2, put_timeout=0.01):
+      if record == 3:
+        raise RuntimeError('bulk failed')
+
+  with pytest.raises(RuntimeError):
+    _consume()
+  assert read_ahead_threads() == []
+
+
+def test_reader_error_is_raised_to_the_consumer():
+  def _records():
+    yield {'name': 'Edy Kim'}
+    raise ValueError('truncated object')
+
+  records = m.read_ahead(_records())
+  assert next(records) == {'name': 'Edy Kim'}
+  with pytest.raises(ValueError):
+    next(records)
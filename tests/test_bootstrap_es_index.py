@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+
+import bootstrap_es_index as m
+
+READ_ALIAS, WRITE_ALIAS = 'octember_bizcard-read', 'octember_bizcard-write'
+
+
+class FakeIndices:
+  def __init__(self, es):
+    self.es = es
+
+  def exists_alias(self, name):
+    return any(name in v['aliases'] for v in self.es.indices_state.values())
+
+  def get_alias(self, name):
+    return {k: {'aliases': {name: v['aliases'][name]}} for k, v in self.es.indices_state.items() if name in v['aliases']}
+
+  def get(self, index):
+    prefix = index.rstrip('*')
+    return {k: {} for k in self.es.indices_state if k.startswith(prefix)}
+
+  def create(self, index, body):
+    self.es.indices_state[index] = {'aliases': {}, 'settings': dict(body['settings']['index'])}
+    self.es.log.append(('create', index, dict(body['settings']['index'])))
+
+  def get_settings(self, index, name):
+    settings = self.es.indices_state[index]['settings']
+    return {index: {'settings': {'index': {'refresh_interval': settings.get('refresh_interval')}}}}
+
+  def put_settings(self, index, body):
+    self.es.indices_state[index]['settings'].update(body['index'])
+    self.es.log.append(('put_settings', index, dict(body['index'])))
+
+  def update_aliases(self, body):
+    for action in body['actions']:
+      (op, params), = action.items()
+      aliases = self.es.indices_state[params['index']]['aliases']
+      if op == 'remove':
+        aliases.pop(params['alias'])
+      else:
+        aliases[params['alias']] = {'is_write_index': True} if params.get('is_write_index') else {}
+    self.es.log.append(('update_aliases', body['actions']))
+    self.es.check_write_index_refreshes()
+
+  def refresh(self, index):
+    self.es.log.append(('refresh', index))
+
+  def exists(self, index):
+    return index in self.es.indices_state
+
+  def get_mapping(self, index):
+    return {index: {'mappings': self.es.indices_state[index].get('mappings', {})}}
+
+
+class FakeCluster:
+  def health(self, **kwargs):
+    return {'status': 'green'}
+
+
+class FakeTasks:
+  def get(self, task_id):
+    return {'completed': True, 'task': {'status': {'total': 10}}, 'response': {'failures': []}}
+
+
+class FakeElasticsearch:
+  def __init__(self):
+    self.log = []
+    self.indices_state = {
+      'octember_bizcard-000001': {'aliases': {READ_ALIAS: {}, WRITE_ALIAS: {'is_write_index': True}},
+        'settings': {'refresh_interval': '30s'}}
+    }
+    self.indices = FakeIndices(self)
+    self.cluster = FakeCluster()
+    self.tasks = FakeTasks()
+
+  def check_write_index_refreshes(self):
+    #XXX: a live bulk request with refresh=wait_for never returns from an index that does not refresh
+    for name, state in self.indices_state.items():
+      if WRITE_ALIAS in state['aliases']:
+        assert state['settings'].get('refresh_interval') != '-1', '{} takes writes without refresh'.format(name)
+        assert state['settings'].get('number_of_replicas', 1) != 0
+
+  def reindex(self, body, **kwargs):
+    self.log.append(('reindex', body['source']['index'], body['dest']['op_type'], 'query' in body['source']))
+    return {'task': 'task-{}'.format(len(self.log))}
+
+
+def test_reindex_moves_the_write_alias_after_the_settings_are_restored():
+  es = FakeElasticsearch()
+  res = m.reindex(es, number_of_shards=2, number_of_replicas=1)
+
+  dest = 'octember_bizcard-000002'
+  assert res['index'] == dest
+  assert es.indices_state[dest]['aliases'] == {READ_ALIAS: {}, WRITE_ALIAS: {'is_write_index': True}}
+  assert es.indices_state['octember_bizcard-000001']['aliases'] == {}
+  assert es.indices_state[dest]['settings']['refresh_interval'] == '30s'
+
+  ops = [e[0] if e[0] != 'reindex' else e[1:] for e in es.log]
+  assert ops == [
+    'create',
+    ('octember_bizcard-000001', 'create', False),
+    'put_settings',
+    ('octember_bizcard-000001', 'index', True),
+    'update_aliases',
+    ('octember_bizcard-000001', 'create', True),
+    'refresh',
+    'update_aliases'
+  ]
+  write_alias_actions = es.log[ops.index('update_aliases')][1]
+  assert {'add': {'index': dest, 'alias': WRITE_ALIAS, 'is_write_index': True}} in write_alias_actions
+
+
+def test_reindex_failure_keeps_the_writes_on_the_source_index():
+  es = FakeElasticsearch()
+  es.tasks.get = lambda task_id: {'completed': True, 'task': {'status': {}}, 'response': {'failures': [{'cause': 'x'}]}}
+
+  with pytest.raises(RuntimeError):
+    m.reindex(es)
+  assert es.indices_state['octember_bizcard-000001']['aliases'][WRITE_ALIAS] == {'is_write_index': True}
+  assert es.indices_state['octember_bizcard-000002']['aliases'] == {}
+
+
+def test_index_created_before_the_template_is_reindexed_before_it_gets_the_aliases():
+  es = FakeElasticsearch()
+  es.indices_state = {'octember_bizcard': {'aliases': {}, 'settings': {},
+    'mappings': {'properties': {'name': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}}}}}}
+
+  res = m.create_index(es)
+  assert res == {'index': 'octember_bizcard-000001', 'created': True}
+  assert es.indices_state['octember_bizcard']['aliases'] == {}
+  assert es.indices_state['octember_bizcard-000001']['aliases'] == {READ_ALIAS: {}, WRITE_ALIAS: {'is_write_index': True}}
+  assert [e[1] for e in es.log if e[0] == 'reindex'] == ['octember_bizcard'] * 3
+
+
+def test_index_with_the_template_mappings_gets_the_aliases():
+  es = FakeElasticsearch()
+  es.indices_state = {'octember_bizcard': {'aliases': {}, 'settings': {},
+    'mappings': m.gen_index_template()['mappings']}}
+
+  res = m.create_index(es)
+  assert res == {'index': 'octember_bizcard', 'created': False}
+  assert es.indices_state['octember_bizcard']['aliases'] == {READ_ALIAS: {}, WRITE_ALIAS: {'is_write_index': True}}
+  assert not [e for e in es.log if e[0] == 'reindex']
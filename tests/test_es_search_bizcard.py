@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import base64
+import json
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+pytest.importorskip('redis')
+
+import es_search_bizcard as m
+
+
+class FakeLimiter:
+  def acquire(self, identity, cost=1):
+    pass
+
+
+class UnreachableConnection:
+  def run(self, func):
+    raise AssertionError('a bad request must not be sent to elasticsearch or redis')
+
+
+@pytest.fixture(autouse=True)
+def no_backends(monkeypatch):
+  for name in ('SEARCH_HIT_LIMITER', 'SEARCH_MISS_LIMITER', 'SUGGEST_MISS_LIMITER'):
+    monkeypatch.setattr(m, name, FakeLimiter())
+  monkeypatch.setattr(m, 'ES_CLIENT', UnreachableConnection())
+
+
+def get_event(resource, query_params):
+  return {'resource': resource, 'httpMethod': 'GET', 'queryStringParameters': query_params,
+    'requestContext': {'identity': {'apiKey': 'test-api-key', 'sourceIp': '127.0.0.1'}}}
+
+
+def post_event(body):
+  return {'resource': '/search', 'httpMethod': 'POST', 'body': body,
+    'requestContext': {'identity': {'apiKey': 'test-api-key', 'sourceIp': '127.0.0.1'}}}
+
+
+@pytest.mark.parametrize('event', [
+  get_event('/search', None),
+  get_event('/search', {'limit': '10'}),
+  get_event('/search', {'user': 'edy', 'limit': 'ten'}),
+  get_event('/search', {'user': 'edy', 'limit': '0'}),
+  get_event('/search', {'user': 'edy', 'fields': 'name,password'}),
+  get_event('/search', {'cursor': 'not a cursor'}),
+  get_event('/search', {'cursor': m.encode_cursor({'q': 'kim', 'u': 'edy'})}),
+  get_event('/suggest', {'user': 'edy'}),
+  get_event('/suggest', {'prefix': '  ', 'user': 'edy'}),
+  get_event('/suggest', {'prefix': 'ki'}),
+  get_event('/suggest', {'prefix': 'ki', 'user': 'edy', 'limit': '-1'}),
+  post_event('{"queries": []}'),
+  post_event('{"queries": {"query": "kim"}}'),
+  post_event(json.dumps({'queries': [{'query': 'kim'}] * (m.SEARCH_BATCH_MAX_QUERIES + 1)})),
+  post_event('{"queries": [{"query": "kim"}, {"limit": 1}]}'),
+  post_event('{"queries": [{"query": "kim", "fields": "name,password"}]}'),
+  post_event('{"queries": [{"query": ["kim"]}]}'),
+  post_event('not json'),
+  post_event(None)
+])
+def test_bad_request_returns_400_with_the_message(event):
+  res = m.lambda_handler(event, {})
+  assert res['statusCode'] == 400
+  assert json.loads(res['body'])['message']
+
+
+def test_cursor_round_trip():
+  cursor = {'q': 'kim', 'u': 'edy', 'l': 10, 'f': ['doc_id', 'name'], 'after': [1.5, 'a1b2'], 'pref': 'c0ffee00'}
+  assert m.decode_cursor(m.encode_cursor(cursor)) == cursor
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import io
+import json
+
+import pytest
+
+PIL = pytest.importorskip('PIL')
+from PIL import Image, ImageDraw
+
+import get_text_from_s3_image as m
+
+CARD_A = ['aws', 'Edy Kim', 'Solutions Architect', 'edy@amazon.com', '(+82 10) 1025 7049']
+CARD_B = ['aws', 'Poby Kim', 'Solutions Architect', 'poby@amazon.com', '(+82 10) 6430 0671']
+
+
+def draw_card(lines):
+  #XXX: the same template (logo, rule, layout) for every card; only the text differs
+  image = Image.new('RGB', (1011, 638), 'white')
+  draw = ImageDraw.Draw(image)
+  draw.rectangle((40, 40, 200, 160), fill='orange')
+  draw.rectangle((40, 560, 971, 580), fill='navy')
+  for idx, line in enumerate(lines):
+    draw.text((260, 60 + idx * 40), line, fill='black')
+  output = io.BytesIO()
+  image.save(output, format='JPEG', quality=90)
+  return output.getvalue()
+
+
+class FakeS3:
+  def __init__(self, objects):
+    self.objects = objects
+
+  def get_object(self, Bucket, Key):
+    return {'Body': io.BytesIO(self.objects[Key])}
+
+
+class FakeTextract:
+  def __init__(self, lines):
+    self.lines = lines
+    self.calls = 0
+
+  def detect_document_text(self, Document):
+    self.calls += 1
+    return {'Blocks': [{'BlockType': 'LINE', 'Text': e} for e in self.lines]}
+
+
+class FakeDynamoDB:
+  #XXX: the candidate has exactly the same dHash as the new image - the worst case of a near-duplicate match
+  def __init__(self, candidate_id, candidate_dhash, candidate_doc):
+    self.candidate_id = candidate_id
+    self.candidate_dhash = candidate_dhash
+    self.candidate_doc = candidate_doc
+
+  def query(self, **kwargs):
+    return {'Items': [{'image_id': {'S': self.candidate_id},
+      'dhash': {'S': '{:064x}'.format(self.candidate_dhash)}}]}
+
+  def get_item(self, TableName, Key):
+    return {'Item': {'image_id': {'S': self.candidate_id}, 'status': {'S': 'END'},
+      'text_data': {'S': json.dumps(self.candidate_doc)}}}
+
+
+def extract(monkeypatch, candidate_lines, new_lines):
+  monkeypatch.setattr(m, 'PHASH_ENABLED', True)
+  monkeypatch.setattr(m, 'OCR_STORE_ENABLED', False)
+
+  key = 'bizcard-raw-img/edy_card_b.jpg'
+  image_bytes = draw_card(new_lines)
+  candidate_doc = m.build_text_data('bucket', 'bizcard-raw-img/edy_card_a.jpg', m.parse_textract_data(candidate_lines))['data']
+  textract_client = FakeTextract(new_lines)
+  clients = (textract_client, None,
+    FakeDynamoDB('edy_card_a.jpg', m.compute_dhash(image_bytes), candidate_doc), FakeS3({key: image_bytes}))
+  res = m.extract_text_data(clients, m.AdaptiveConcurrencyLimiter(1), {'s3_bucket': 'bucket', 's3_key': key})
+  return res, textract_client
+
+
+def test_template_identical_cards_with_different_text_are_not_merged(monkeypatch):
+  assert m.hamming_distance(m.compute_dhash(draw_card(CARD_A)), m.compute_dhash(draw_card(CARD_B))) <= 8
+
+  res, textract_client = extract(monkeypatch, CARD_A, CARD_B)
+  assert textract_client.calls == 1
+  assert res['duplicate_of'] is None
+  assert res['dhash'] is not None
+  assert res['text_data']['s3_key'] == 'bizcard-raw-img/edy_card_b.jpg'
+  assert res['text_data']['data']['name'] == 'Poby Kim'
+  assert res['text_data']['data']['email'] == 'poby@amazon.com'
+
+
+def test_near_duplicate_with_the_same_text_is_merged(monkeypatch):
+  res, textract_client = extract(monkeypatch, CARD_A, CARD_A)
+  assert res['duplicate_of'] == 'edy_card_a.jpg'
+  assert res['dhash'] is None
+  assert res['text_data']['s3_key'] == 'bizcard-raw-img/edy_card_b.jpg'
+  assert res['text_data']['data']['name'] == 'Edy Kim'
+
+
+class FakeStatusTable:
+  #XXX: applies the SET actions of UpdateItem to the stored item, the way DynamoDB does
+  def __init__(self, items):
+    self.items = items
+
+  def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+    item = self.items.setdefault(Key['image_id']['S'], dict(Key))
+    assert UpdateExpression.startswith('SET ')
+    for action in UpdateExpression[len('SET '):].split(', '):
+      attr_name, value_name = action.split(' = ')
+      item[ExpressionAttributeNames.get(attr_name, attr_name)] = ExpressionAttributeValues[value_name]
+
+  def batch_write_item(self, RequestItems):
+    raise AssertionError('PutRequest replaces the whole item')
+
+
+def test_status_update_keeps_the_attributes_of_the_item():
+  ddb_client = FakeStatusTable({'edy_card_a.jpg': {'image_id': {'S': 'edy_card_a.jpg'},
+    's3_etag': {'S': 'etag-a'}, 'status': {'S': 'START'}}})
+
+  m.batch_update_process_status(ddb_client, 'OctemberBizcardImg', [
+    {'s3_bucket': 'bucket', 's3_key': 'bizcard-raw-img/edy_card_a.jpg', 'status': 'PROCESS'},
+    {'s3_bucket': 'bucket', 's3_key': 'bizcard-raw-img/edy_card_b.jpg', 'status': 'PROCESS'}])
+  item = ddb_client.items['edy_card_a.jpg']
+  assert item['status'] == {'S': 'PROCESS'}
+  assert item['s3_etag'] == {'S': 'etag-a'}
+
+  m.batch_update_process_status(ddb_client, 'OctemberBizcardImg', [
+    {'s3_bucket': 'bucket', 's3_key': 'bizcard-by-user/edy/edy_card_a.jpg', 'status': 'END', 'text_data': '{}'}])
+  m.batch_update_process_status(ddb_client, 'OctemberBizcardImg', [
+    {'s3_bucket': 'bucket', 's3_key': 'bizcard-raw-img/edy_card_a.jpg', 'status': 'PROCESS'}])
+  item = ddb_client.items['edy_card_a.jpg']
+  assert item['status'] == {'S': 'PROCESS'}
+  assert item['s3_etag'] == {'S': 'etag-a'}
+  assert item['text_data'] == {'S': '{}'}
+  assert ddb_client.items['edy_card_b.jpg']['status'] == {'S': 'PROCESS'}
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import itertools
+
+import pytest
+
+import octember_connections as m
+
+
+class FakeClock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = FakeClock()
+  monkeypatch.setattr(m.time, 'time', clock.time)
+  return clock
+
+
+def lazy_connection(**kwargs):
+  ids, closed = itertools.count(), []
+  conn = m.LazyConnection('test', lambda: next(ids), close=closed.append, **kwargs)
+  return conn, closed
+
+
+def test_connection_recycled_by_max_age_is_closed(clock):
+  conn, closed = lazy_connection(max_age=60)
+  assert conn.get() == 0
+  clock.now += 30
+  assert conn.get() == 0
+  clock.now += 30
+  assert conn.get() == 1
+  assert closed == [0]
+
+
+def test_connection_failed_the_health_check_is_closed(clock):
+  healthy = {0: False}
+  conn, closed = lazy_connection(health_check=lambda e: healthy.get(e, True), health_check_interval=10)
+  assert conn.get() == 0
+  clock.now += 5
+  assert conn.get() == 0
+  clock.now += 5
+  assert conn.get() == 1
+  assert closed == [0]
+
+
+def test_connection_failed_a_call_is_closed_before_the_retry(clock):
+  conn, closed = lazy_connection(reconnect_on=(OSError,))
+
+  def _call(e):
+    if e == 0:
+      raise OSError('connection reset')
+    return e
+  assert conn.run(_call) == 1
+  assert closed == [0]
+
+
+def test_close_all_closes_every_open_connection(clock):
+  conn, closed = lazy_connection()
+  conn.get()
+  m.close_all()
+  assert closed == [0]
+  assert not conn.connected
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+
+import octember_kinesis as m
+
+
+class FakeKinesis:
+  #XXX: fails the first put of every odd record
+  def __init__(self):
+    self.requests = []
+    self.failed = set()
+
+  def put_records(self, Records, StreamName):
+    self.requests.append(Records)
+    results = []
+    for rec in Records:
+      idx = json.loads(rec['Data'])['idx']
+      if idx % 2 and idx not in self.failed:
+        self.failed.add(idx)
+        results.append({'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'})
+      else:
+        results.append({'ShardId': 'shardId-000000000000', 'SequenceNumber': str(idx)})
+    return {'FailedRecordCount': sum(1 for e in results if 'ErrorCode' in e), 'Records': results}
+
+
+def test_write_records_to_kinesis_resends_only_the_failed_records(monkeypatch):
+  monkeypatch.setattr(m.time, 'sleep', lambda seconds: None)
+  kinesis_client = FakeKinesis()
+  records = [{'idx': idx, 's3_key': 'bizcard-raw-img/edy_{}.jpg'.format(idx)} for idx in range(m.KINESIS_MAX_RECORDS_PER_REQUEST + 2)]
+
+  outcomes = m.write_records_to_kinesis(kinesis_client, 'octember-bizcard-img', records)
+  assert all(e['ok'] for e in outcomes)
+  assert [e['sequence_number'] for e in outcomes] == [str(idx) for idx in range(len(records))]
+  assert [len(e) for e in kinesis_client.requests] == [m.KINESIS_MAX_RECORDS_PER_REQUEST, m.KINESIS_MAX_RECORDS_PER_REQUEST // 2, 2, 1]
+
+
+def test_owner_partition_key_keeps_the_records_of_an_owner_together():
+  keys = {m.gen_partition_key({'s3_key': 'bizcard-raw-img/edy_{}.jpg'.format(idx)}, 'owner') for idx in range(10)}
+  assert len(keys) == 1
+  spread_keys = [m.gen_partition_key({'s3_key': 'bizcard-raw-img/edy_{}.jpg'.format(idx)}) for idx in range(1000)]
+  assert len(set(spread_keys)) == 1000
+  assert min(m.partition_key_distribution(spread_keys, 4)) > 200
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import base64
+import json
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+pytest.importorskip('redis')
+
+import upsert_bizcard_to_es as m
+
+
+class FakeConnection:
+  def __init__(self, client):
+    self.client = client
+
+  def run(self, func):
+    return func(self.client)
+
+
+class FakeIndices:
+  def __init__(self, refresh_interval):
+    self.refresh_interval = refresh_interval
+
+  def get_settings(self, index, name, include_defaults=False):
+    settings = {'settings': {'index': {}}, 'defaults': {'index': {'refresh_interval': '1s'}}}
+    if self.refresh_interval:
+      settings['settings']['index']['refresh_interval'] = self.refresh_interval
+    return {'octember_bizcard-000002': settings}
+
+
+class FakeElasticsearch:
+  def __init__(self, refresh_interval):
+    self.indices = FakeIndices(refresh_interval)
+    self.bulk_calls = []
+
+  def bulk(self, body, index, refresh, request_timeout):
+    self.bulk_calls.append({'refresh': refresh, 'request_timeout': request_timeout})
+    actions = [json.loads(e) for e in body.splitlines()[0::2]]
+    return {'items': [{'index': {'_id': e['index']['_id'], 'result': 'created', 'status': 201}} for e in actions]}
+
+
+class FakePipeline:
+  def __init__(self, redis_client):
+    self.redis_client = redis_client
+
+  def incr(self, key):
+    self.redis_client.incremented.append(key)
+
+  def set(self, key, value, ex=None):
+    pass
+
+  def execute(self):
+    return []
+
+
+class FakeRedis:
+  def __init__(self):
+    self.incremented = []
+
+  def pipeline(self, transaction=True):
+    return FakePipeline(self)
+
+
+def kinesis_event(owner='edy'):
+  record = {'s3_bucket': 'bucket', 's3_key': 'bizcard-raw-img/{}_bizcard_0001.jpg'.format(owner), 'owner': owner,
+    'data': {'name': 'Edy Kim', 'email': 'edy@amazon.com', 'phone_number': '(+82 10) 1025 7049'}}
+  return {'Records': [{'kinesis': {'data': base64.b64encode(json.dumps(record).encode('utf-8'))}}]}
+
+
+def upsert(monkeypatch, refresh_interval):
+  es_client, redis_client = FakeElasticsearch(refresh_interval), FakeRedis()
+  monkeypatch.setattr(m, 'ES_CLIENT', FakeConnection(es_client))
+  monkeypatch.setattr(m, 'REDIS_CLIENT', FakeConnection(redis_client))
+  monkeypatch.setattr(m, 'SKIP_UNCHANGED_ENABLED', False)
+  monkeypatch.setattr(m, 'ES_REFRESH_POLICY', 'false')
+  monkeypatch.setattr(m, '_WRITE_INDEX_REFRESH_INTERVAL', {'value': None, 'checked_at': 0})
+  m.lambda_handler(kinesis_event(), {})
+  return es_client, redis_client
+
+
+@pytest.mark.parametrize('refresh_interval', [None, '1s', '30s'])
+def test_bulk_waits_for_refresh_before_the_owner_versions_are_bumped(monkeypatch, refresh_interval):
+  es_client, redis_client = upsert(monkeypatch, refresh_interval)
+  assert es_client.bulk_calls == [{'refresh': 'wait_for', 'request_timeout': m.ES_BULK_REQUEST_TIMEOUT}]
+  assert redis_client.incremented == ['es:owner_version:edy', 'es:owner_version:__all__']
+
+
+@pytest.mark.parametrize('refresh_interval', ['-1', '5m'])
+def test_owner_versions_are_not_bumped_without_a_refresh_to_wait_for(monkeypatch, refresh_interval):
+  es_client, redis_client = upsert(monkeypatch, refresh_interval)
+  assert es_client.bulk_calls == [{'refresh': 'false', 'request_timeout': m.ES_BULK_REQUEST_TIMEOUT}]
+  assert redis_client.incremented == []